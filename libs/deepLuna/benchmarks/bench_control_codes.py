@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Compare RubyUtils.apply_control_codes against the character-at-a-time
+# reference translator on synthetic translated lines with control codes,
+# with and without PUA glyph regions, checking that the output is
+# identical.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_control_codes
+import argparse
+import random
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.ruby_utils import RubyUtils
+
+
+def time_translator(translator, lines, runs):
+    best = None
+    outputs = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        outputs = [translator(line) for line in lines]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control code benchmark")
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    lines = [SyntheticCorpus.en_control_code_line(rng, rng.randrange(3, 30))
+             for _ in range(args.lines)]
+    print(f"{len(lines)} lines, {sum(len(line) for line in lines)} chars")
+
+    for enable_pua in (False, True):
+        RubyUtils.ENABLE_PUA_CODES = enable_pua
+        ref_time, ref_out = time_translator(
+            RubyUtils.apply_control_codes_reference, lines, args.runs)
+        fast_time, fast_out = time_translator(
+            RubyUtils.apply_control_codes, lines, args.runs)
+        assert ref_out == fast_out, "Control code outputs differ"
+        print(f"PUA {'on' if enable_pua else 'off':>3}: "
+              f"reference {ref_time:.3f}s, compiled {fast_time:.3f}s "
+              f"({ref_time / fast_time:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
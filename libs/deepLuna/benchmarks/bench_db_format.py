@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Compare loading a full-game translation DB from the JSON format against
+# the binary format: file size, load time and peak RSS. Each load runs in
+# its own interpreter so the RSS high-water marks don't mix. The lazy row
+# loads the segmented file on demand, and also times decoding one scene
+# (with its lines) on first access.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_db_format
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.translation_db import TranslationDb
+
+
+def max_rss_kb():
+    # On Linux ru_maxrss survives exec, so the child would inherit the
+    # parent's high-water mark. VmHWM is per address space, use that.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def load_once(path, runs, columnar, lazy):
+    # Child mode: report load time, first scene access time and peak RSS
+    # above the baseline
+    baseline = max_rss_kb()
+    best = None
+    best_access = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        tl_db = TranslationDb.from_file(path, columnar=columnar, lazy=lazy)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+        start = time.perf_counter()
+        scene_name = tl_db.scene_names()[0]
+        for cmd in tl_db.lines_for_scene(scene_name):
+            tl_db.tl_line_for_cmd(cmd)
+        elapsed = time.perf_counter() - start
+        best_access = elapsed if best_access is None \
+            else min(best_access, elapsed)
+        del tl_db
+    print(best, best_access, max_rss_kb() - baseline)
+
+
+def measure(path, runs, columnar=False, lazy=False):
+    out = subprocess.check_output([
+        sys.executable, '-m', 'libs.deepLuna.benchmarks.bench_db_format',
+        '--load', path, '--runs', str(runs)
+    ] + (['--columnar'] if columnar else []) +
+        (['--lazy'] if lazy else []))
+    load_time, access_time, rss = out.split()
+    return float(load_time), float(access_time), int(rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DB format benchmark")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--lines-per-scene', type=int,
+                        default=SyntheticCorpus.LINES_PER_SCENE)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--load', help=argparse.SUPPRESS)
+    parser.add_argument('--columnar', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--lazy', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        load_once(args.load, args.runs, args.columnar, args.lazy)
+        return
+
+    tl_db = SyntheticCorpus.translated_db(
+        scene_count=args.scenes, lines_per_scene=args.lines_per_scene)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        json_path = os.path.join(tmpdir, "db.json")
+        binary_path = os.path.join(tmpdir, "db.ldb")
+
+        start = time.perf_counter()
+        tl_db.to_file(json_path)
+        json_save = time.perf_counter() - start
+        start = time.perf_counter()
+        tl_db.to_file(binary_path)
+        binary_save = time.perf_counter() - start
+
+        assert TranslationDb.from_file(binary_path).as_json() == \
+            tl_db.as_json(), "Binary DB does not round-trip"
+
+        json_load = measure(json_path, args.runs)
+        binary_load = measure(binary_path, args.runs)
+        columnar_load = measure(binary_path, args.runs, columnar=True)
+        lazy_load = measure(binary_path, args.runs, lazy=True)
+
+        command_count = sum(
+            len(tl_db.lines_for_scene(name))
+            for name in tl_db.scene_names(include_empty=True))
+        print(f"{args.scenes} scenes, {command_count} commands")
+        for name, path, save, (load, access, rss) in [
+            ("json", json_path, json_save, json_load),
+            ("binary", binary_path, binary_save, binary_load),
+            ("binary (columnar scenes)", binary_path, binary_save,
+             columnar_load),
+            ("binary (lazy)", binary_path, binary_save, lazy_load),
+        ]:
+            print(f"{name:>24}: {os.path.getsize(path) / 1024:8.0f} KB, "
+                  f"save {save:.3f}s, load {load:.3f}s, "
+                  f"first scene {access * 1000:.1f}ms, "
+                  f"peak RSS +{rss / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
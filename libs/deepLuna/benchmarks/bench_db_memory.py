@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# tracemalloc report of translation DB memory use: the memory retained by
+# a loaded full-game DB, the peak while loading it, and the peak while
+# generating script_text.mrg from it. Also breaks the retained memory down
+# by allocating source line, to see what the DB objects cost.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_db_memory
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.translation_db import TranslationDb
+
+
+def mb(size):
+    return f"{size / (1024 * 1024):7.2f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DB memory report")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--lines-per-scene', type=int,
+                        default=SyntheticCorpus.LINES_PER_SCENE)
+    parser.add_argument('--format', choices=['json', 'ldb'], default='json')
+    parser.add_argument('--top', type=int, default=8,
+                        help="Number of allocation sites to list")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, f"db.{args.format}")
+        SyntheticCorpus.translated_db(
+            scene_count=args.scenes, lines_per_scene=args.lines_per_scene
+        ).to_file(db_path)
+        gc.collect()
+
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot()
+        tl_db = TranslationDb.from_file(db_path)
+        gc.collect()
+        load_retained, load_peak = tracemalloc.get_traced_memory()
+        loaded = tracemalloc.take_snapshot()
+
+        tracemalloc.reset_peak()
+        tl_db.generate_script_text_mrg()
+        gc.collect()
+        _, mrg_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    command_count = sum(
+        len(tl_db.lines_for_scene(name))
+        for name in tl_db.scene_names(include_empty=True))
+    print(f"{args.scenes} scenes, {command_count} commands, "
+          f"{args.format} DB")
+    print(f"retained after load:         {mb(load_retained)}")
+    print(f"peak during load:            {mb(load_peak)}")
+    print(f"peak during script_text gen: {mb(mrg_peak)}")
+
+    print(f"\nTop {args.top} allocation sites retained by the loaded DB:")
+    stats = loaded.compare_to(baseline, 'lineno')
+    for stat in stats[:args.top]:
+        frame = stat.traceback[0]
+        print(f"{mb(stat.size_diff)} {stat.count_diff:>8} blocks  "
+              f"{os.path.basename(frame.filename)}:{frame.lineno}")
+
+
+if __name__ == '__main__':
+    main()
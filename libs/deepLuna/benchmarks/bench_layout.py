@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Time laying out a full-game translation DB (generate_linebroken_text_map)
+# serially and on an MzxPool with increasing worker counts, checking that
+# the parallel output is identical. The layout cache and RubyUtils' width
+# caches are cleared before each run, so every scene is laid out from
+# scratch every time. Prints the width cache hit rates, for tuning
+# RubyUtils.CACHE_SIZE with --cache-size.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_layout
+import argparse
+import multiprocessing
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.mzx_pool import MzxPool
+from libs.deepLuna.luna.ruby_utils import RubyUtils
+
+
+def time_layout(tl_db, runs, pool=None):
+    best = None
+    result = None
+    for _ in range(runs):
+        tl_db._layout_cache.clear()
+        RubyUtils.clear_caches()
+        start = time.perf_counter()
+        result = tl_db.generate_linebroken_text_map(pool=pool)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Layout benchmark")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--lines-per-scene', type=int,
+                        default=SyntheticCorpus.LINES_PER_SCENE)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--cache-size', type=int,
+                        default=RubyUtils.CACHE_SIZE,
+                        help="Strings per width cache (0 disables them)")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help="Worker counts to try (default: 1, 2, 4 ... "
+                             "up to the CPU count)")
+    args = parser.parse_args()
+
+    workers = args.workers
+    if not workers:
+        workers = [1]
+        while workers[-1] * 2 <= multiprocessing.cpu_count():
+            workers.append(workers[-1] * 2)
+
+    RubyUtils.set_cache_size(args.cache_size)
+    tl_db = SyntheticCorpus.translated_db(
+        scene_count=args.scenes, lines_per_scene=args.lines_per_scene)
+    print(f"{args.scenes} scenes, {multiprocessing.cpu_count()} CPUs")
+
+    serial, expected = time_layout(tl_db, args.runs)
+    print(f"{'serial':>12}: {serial:.3f}s")
+    for name, stats in RubyUtils.cache_stats().items():
+        hit_rate = stats['hit_rate'] or 0
+        print(f"{name:>16}: {hit_rate:.1%} hits of "
+              f"{stats['hits'] + stats['misses']}, "
+              f"{stats['size']}/{stats['max_size']} entries, "
+              f"{stats['compute_seconds']:.3f}s computing misses")
+    for worker_count in workers:
+        with MzxPool(worker_count) as pool:
+            elapsed, result = time_layout(tl_db, args.runs, pool)
+        assert result == expected and list(result) == list(expected), \
+            "Parallel layout differs from serial"
+        print(f"{worker_count:>4} workers: {elapsed:.3f}s "
+              f"({serial / elapsed:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
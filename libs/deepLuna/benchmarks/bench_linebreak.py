@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Compare RubyUtils.linebreak_text against the reference breaker, which
+# re-measures the whole line for every word, on long synthetic lines heavy
+# in ruby groups and PUA glyphs, checking that the output is identical.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_linebreak
+import argparse
+import random
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.constants import Constants
+from libs.deepLuna.luna.ruby_utils import RubyUtils
+
+
+def time_breaker(breaker, lines, runs):
+    best = None
+    outputs = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        outputs = [breaker(line, Constants.CHARS_PER_LINE) for line in lines]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Line breaker benchmark")
+    parser.add_argument('--lines', type=int, default=200)
+    parser.add_argument('--words', type=int, nargs='+',
+                        default=[10, 50, 200, 1000])
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for word_count in args.words:
+        lines = [SyntheticCorpus.en_layout_line(rng, word_count)
+                 for _ in range(args.lines)]
+        ref_time, ref_out = time_breaker(
+            RubyUtils.linebreak_text_reference, lines, args.runs)
+        fast_time, fast_out = time_breaker(
+            RubyUtils.linebreak_text, lines, args.runs)
+        assert ref_out == fast_out, "Line breaker outputs differ"
+        print(f"{word_count:>5} words/line: reference {ref_time:.3f}s, "
+              f"incremental {fast_time:.3f}s ({ref_time / fast_time:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
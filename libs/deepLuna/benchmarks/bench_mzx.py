@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Compare the bytearray MZX decoder against the BytesIO reference decoder
+# over a synthetic allscr-sized corpus, and time the compressor at each
+# compression level over synthetic scene scripts.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_mzx
+import argparse
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.mzx import Mzx
+
+
+def time_decoder(decoder, streams):
+    start = time.perf_counter()
+    outputs = [decoder(stream) for stream in streams]
+    return time.perf_counter() - start, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MZX decoder benchmark")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--scene-size', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_SIZE)
+    parser.add_argument('--levels', type=int, nargs='+',
+                        default=[0, 1, 3, 6, 9])
+    args = parser.parse_args()
+
+    streams = SyntheticCorpus.allscr_mzx_streams(
+        scene_count=args.scenes, scene_size=args.scene_size)
+    total_in = sum(len(s) for s in streams)
+
+    ref_time, ref_out = time_decoder(Mzx.decompress_reference, streams)
+    fast_time, fast_out = time_decoder(Mzx.decompress, streams)
+    assert ref_out == fast_out, "Decoder outputs differ"
+
+    total_out = sum(len(s) for s in fast_out)
+    print(f"{len(streams)} scenes, {total_in} bytes in, {total_out} bytes out")
+    print(f"reference: {ref_time:.3f}s")
+    print(f"bytearray: {fast_time:.3f}s ({ref_time / fast_time:.1f}x)")
+
+    # Compression over synthetic scene scripts
+    _, scripts, _ = SyntheticCorpus.game(scene_count=args.scenes)
+    script_bytes = sum(len(s) for s in scripts)
+    print(f"\ncompress: {len(scripts)} scripts, {script_bytes} bytes")
+    for level in args.levels:
+        start = time.perf_counter()
+        compressed = [Mzx.compress(s, level=level) for s in scripts]
+        elapsed = time.perf_counter() - start
+        ratio = sum(len(c) for c in compressed) / script_bytes
+        print(f"level {level}: {elapsed:.3f}s, ratio {ratio:.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Compare allscr decompression through MzxPool (shared memory hand-off,
+# optionally with a persistent pool) against the previous path, which
+# pickled every compressed and decompressed script through a fresh
+# multiprocessing.Pool on each call.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_mzx_pool
+import argparse
+import multiprocessing
+import tempfile
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.mrg_parser import Mzp
+from libs.deepLuna.luna.mzx import Mzx
+from libs.deepLuna.luna.mzx_pool import MzxPool
+
+
+def pickled_pool_path(allscr_path):
+    allscr_mzp = Mzp(allscr_path)
+    with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+        return pool.map(Mzx.decompress, allscr_mzp.data[3:])
+
+
+def mzx_pool_path(allscr_path, pool=None):
+    if pool is None:
+        with MzxPool() as temp_pool:
+            return temp_pool.decompress_mzp(allscr_path, first=3)
+    return pool.decompress_mzp(allscr_path, first=3)
+
+
+def best_of(runs, func, *args):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MzxPool benchmark")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--lines-per-scene', type=int,
+                        default=SyntheticCorpus.LINES_PER_SCENE)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        allscr_path, _ = SyntheticCorpus.write_game(
+            tmpdir, scene_count=args.scenes,
+            lines_per_scene=args.lines_per_scene)
+
+        legacy_time, legacy_out = best_of(
+            args.runs, pickled_pool_path, allscr_path)
+        fresh_time, fresh_out = best_of(
+            args.runs, mzx_pool_path, allscr_path)
+        with MzxPool() as pool:
+            # Warm the pool once so only steady-state calls are timed
+            mzx_pool_path(allscr_path, pool)
+            reused_time, reused_out = best_of(
+                args.runs, mzx_pool_path, allscr_path, pool)
+
+    assert legacy_out == fresh_out == reused_out, "Outputs differ"
+    print(f"{len(legacy_out)} scripts, "
+          f"{sum(len(s) for s in legacy_out)} bytes decompressed, "
+          f"{multiprocessing.cpu_count()} workers")
+    print(f"pickled Pool.map:    {legacy_time:.3f}s")
+    print(f"MzxPool (fresh):     {fresh_time:.3f}s")
+    print(f"MzxPool (reused):    {reused_time:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
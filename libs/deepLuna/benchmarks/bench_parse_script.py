@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Compare the single-pass script tokenizer behind
+# TranslationDb.parse_script_cmds against the previous per-command regex
+# implementation, over every scene of a synthetic game.
+#
+# Run from the repository root:
+#   python -m libs.deepLuna.benchmarks.bench_parse_script
+import argparse
+import re
+import sys
+import time
+
+from libs.deepLuna.benchmarks.synthetic import SyntheticCorpus
+from libs.deepLuna.luna.translation_db import TranslationDb
+
+
+def legacy_parse_script_cmds(script, strings_by_content_hash,
+                             content_hash_by_offset):
+    # The previous implementation, kept here as the performance baseline
+    raw_cmds = [
+        cmd.strip() for cmd in script.decode('utf-8').split(';')
+        if cmd.strip()
+    ]
+    command_regex = re.compile(
+        r"_(\w+)\(([\w 　a-zA-Z0-9-,`@$:.+^_]*)\)\Z")
+    script_commands = []
+    for cmd in raw_cmds:
+        match = command_regex.match(cmd)
+        if not match:
+            sys.stderr.write(f"Failed to parse command {cmd}\n")
+            continue
+        groups = match.groups()
+        script_commands.append(
+            TranslationDb.AllscrCmd(groups[0])
+            if len(groups) == 1
+            else TranslationDb.AllscrCmd(groups[0], groups[1].split(','))
+        )
+
+    text_offsets = []
+    page_number = 0
+    seen_offsets = set()
+    for cmd in script_commands:
+        if cmd.opcode == 'PGST':
+            page_number = int(cmd.arguments[0])
+            continue
+        is_zm = cmd.opcode.startswith('ZM')
+        is_msad = cmd.opcode == 'MSAD'
+        is_selr = cmd.opcode == 'SELR'
+        if not any([is_zm, is_msad, is_selr]):
+            continue
+        if not cmd.arguments:
+            continue
+        for arg in cmd.arguments:
+            text_refs = re.compile(r"(\$\d+)").findall(arg)
+            text_modifiers = re.compile(r"(\@\w)").findall(arg)
+            offsets = [int(ref[1:]) for ref in text_refs]
+            for offset in offsets:
+                if offset in seen_offsets:
+                    continue
+                fmt_off = f"${offset:06}"
+                offset_pos = arg.find(fmt_off)
+                next_offset_pos = arg.find("$", offset_pos + len(fmt_off))
+                caret_pos = arg.find("^", offset_pos, next_offset_pos)
+                has_forced_newline = caret_pos != -1
+                has_x_modifier = '@x' in text_modifiers
+                prev_line_forces_break = (
+                    bool(text_offsets)
+                    and text_offsets[-1].page_number == page_number
+                    and text_offsets[-1].has_forced_newline
+                )
+                is_glued = (
+                    (is_msad or has_x_modifier)
+                    and not prev_line_forces_break
+                )
+                jp_line = strings_by_content_hash[
+                    content_hash_by_offset[offset]]
+                has_ruby = '<' in jp_line.jp_text
+                seen_offsets.add(offset)
+                text_offsets.append(TranslationDb.TextCommand(
+                    offset,
+                    content_hash_by_offset[offset],
+                    page_number,
+                    has_ruby=has_ruby,
+                    is_glued=is_glued,
+                    is_choice=is_selr,
+                    modifiers=text_modifiers,
+                    has_forced_newline=has_forced_newline
+                ))
+
+    return text_offsets
+
+
+def time_parser(runs, parser, scripts, strings_by_content_hash,
+                content_hash_by_offset):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = [
+            parser(script, strings_by_content_hash, content_hash_by_offset)
+            for script in scripts
+        ]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Script parser benchmark")
+    parser.add_argument('--scenes', type=int,
+                        default=SyntheticCorpus.ALLSCR_SCENE_COUNT)
+    parser.add_argument('--lines-per-scene', type=int,
+                        default=SyntheticCorpus.LINES_PER_SCENE)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    _, scripts, strings = SyntheticCorpus.game(
+        scene_count=args.scenes, lines_per_scene=args.lines_per_scene)
+    lines = [TranslationDb.TLLine(jp) for jp in strings]
+    content_hash_by_offset = {
+        i: line.content_hash() for i, line in enumerate(lines)}
+    strings_by_content_hash = {line.content_hash(): line for line in lines}
+
+    legacy_time, legacy_out = time_parser(
+        args.runs, legacy_parse_script_cmds, scripts,
+        strings_by_content_hash, content_hash_by_offset)
+    new_time, new_out = time_parser(
+        args.runs, TranslationDb.parse_script_cmds, scripts,
+        strings_by_content_hash, content_hash_by_offset)
+    assert legacy_out == new_out, "Parser outputs differ"
+
+    print(f"{len(scripts)} scenes, "
+          f"{sum(len(cmds) for cmds in new_out)} text commands")
+    print(f"legacy:    {legacy_time:.3f}s")
+    print(f"tokenizer: {new_time:.3f}s ({legacy_time / new_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
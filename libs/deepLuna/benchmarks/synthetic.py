@@ -0,0 +1,276 @@
+import os
+import random
+import struct
+
+from libs.deepLuna.luna.mrg_parser import Mzp
+from libs.deepLuna.luna.mzx import Mzx
+from libs.deepLuna.luna.translation_db import TranslationDb
+
+
+class SyntheticCorpus:
+    """
+    Generators for synthetic stand-ins of the game data, so that benchmarks
+    and tests can run without the real allscr.mrg/script_text.mrg.
+    Roughly sized to match the retail allscr: a few hundred scenes of some
+    tens of KB of decompressed script each.
+    """
+
+    ALLSCR_SCENE_COUNT = 400
+    ALLSCR_SCENE_SIZE = 40 * 1024
+    LINES_PER_SCENE = 120
+
+    KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめも"
+    KANJI = "月姫遠野志貴秋葉翡翠琥珀弓塚夜空街学校"
+    FILLER_OPCODES = ["WKST", "BGL", "SEPL", "BGMPL", "FFADE", "WAIT"]
+    EN_WORDS = [
+        "the", "moon", "night", "Shiki", "Akiha", "said", "I", "you",
+        "quiet", "school", "street", "blood", "...", "really", "again",
+    ]
+
+    @staticmethod
+    def mzx_stream(rng, decompressed_size, invert=True):
+        # Emit a valid MZX command stream using a random mix of all four
+        # command types. The content is meaningless, but the command mix
+        # exercises every decoder path.
+        out = bytearray(struct.pack("<4sI", b"MZX0", decompressed_size))
+        shorts_written = 0
+        shorts_needed = (decompressed_size + 1) // 2
+        while shorts_written < shorts_needed:
+            roll = rng.random()
+            length = rng.randrange(64)
+            if roll < 0.1:
+                out.append(Mzx.CMD_RLE | (length << 2))
+            elif roll < 0.4 and shorts_written:
+                lookback = rng.randrange(min(shorts_written, 256))
+                out.append(Mzx.CMD_BACKREF | (length << 2))
+                out.append(lookback)
+            elif roll < 0.55:
+                out.append(Mzx.CMD_RINGBUF | (length << 2))
+                length = 0
+            else:
+                out.append(Mzx.CMD_LITERAL | (length << 2))
+                out += rng.randbytes(2 * (length + 1))
+            shorts_written += length + 1
+
+        return bytes(out)
+
+    @classmethod
+    def allscr_mzx_streams(cls, seed=0, scene_count=None, scene_size=None):
+        rng = random.Random(seed)
+        scene_count = scene_count or cls.ALLSCR_SCENE_COUNT
+        scene_size = scene_size or cls.ALLSCR_SCENE_SIZE
+        return [
+            cls.mzx_stream(
+                rng, rng.randrange(scene_size // 2, scene_size * 3 // 2))
+            for _ in range(scene_count)
+        ]
+
+    @classmethod
+    def jp_line(cls, rng):
+        # A line of JP-ish text, occasionally with a ruby group
+        text = ''.join(
+            rng.choice(cls.KANA) for _ in range(rng.randrange(4, 40)))
+        if rng.random() < 0.1:
+            base = ''.join(rng.choice(cls.KANJI) for _ in range(2))
+            reading = ''.join(rng.choice(cls.KANA) for _ in range(4))
+            split = rng.randrange(len(text))
+            text = f"{text[:split]}<{base}|{reading}>{text[split:]}"
+        return text + "\r\n"
+
+    @classmethod
+    def en_layout_line(cls, rng, word_count):
+        # A long line of English-ish text for the line breaker, heavy in
+        # ruby groups (whose tops contain spaces), PUA glyphs from the
+        # control code regions, double-width characters, forced newlines
+        # and the odd word too long to fit on a line
+        words = []
+        for _ in range(word_count):
+            roll = rng.random()
+            if roll < 0.2:
+                top = ' '.join(rng.choice(cls.EN_WORDS) for _ in range(3))
+                words.append(f"<{rng.choice(cls.EN_WORDS)}|{top}>")
+            elif roll < 0.35:
+                region = 0xE000 + 128 * rng.choice([0, 1, 2, 3, 5])
+                words.append(''.join(
+                    chr(region + ord(c)) for c in rng.choice(cls.EN_WORDS)))
+            elif roll < 0.45:
+                words.append(''.join(
+                    rng.choice(cls.KANA) for _ in range(rng.randrange(1, 6))))
+            elif roll < 0.48:
+                words.append('\n')
+            elif roll < 0.5:
+                words.append('a' * rng.randrange(56, 130))
+            else:
+                words.append(rng.choice(cls.EN_WORDS))
+        return ' '.join(words)
+
+    @classmethod
+    def en_control_code_line(cls, rng, word_count):
+        # A line of English-ish text as entered by translators, with forced
+        # newlines and spaces, literal %s and words set in the PUA glyph
+        # regions with %{i}...%{/i} style tags
+        words = []
+        for _ in range(word_count):
+            roll = rng.random()
+            word = rng.choice(cls.EN_WORDS)
+            if roll < 0.15:
+                tag = rng.choice(['i', 'r', 'ri', 'g', 'flip_vertical'])
+                words.append(f"%{{{tag}}}{word}%{{/{tag}}}")
+            elif roll < 0.2:
+                words.append(f"{word}%{{n}}")
+            elif roll < 0.23:
+                words.append(f"{word}%{{s}}")
+            elif roll < 0.25:
+                words.append(f"{rng.randrange(100)}%")
+            else:
+                words.append(word)
+        return ' '.join(words)
+
+    @classmethod
+    def game_strings(cls, rng, count):
+        # Script text strings. Short exclamations repeat across the game,
+        # so reuse some lines to get shared content hashes.
+        strings = []
+        for _ in range(count):
+            if strings and rng.random() < 0.05:
+                strings.append(rng.choice(strings))
+            else:
+                strings.append(cls.jp_line(rng))
+        return strings
+
+    @classmethod
+    def scene_script(cls, rng, offsets):
+        # Build an allscr scene script emitting the given string offsets
+        # with a plausible mix of page, text, glue, choice and filler
+        # commands.
+        cmds = []
+        page = 0
+        idx = 0
+        while idx < len(offsets):
+            if rng.random() < 0.15:
+                page += 1
+                cmds.append(f"_PGST({page})")
+            if rng.random() < 0.3:
+                opcode = rng.choice(cls.FILLER_OPCODES)
+                cmds.append(f"_{opcode}({rng.randrange(100)},ev{idx:03})")
+
+            roll = rng.random()
+            if roll < 0.1 and idx + 1 < len(offsets):
+                cmds.append(
+                    f"_SELR({page},${offsets[idx]:06},${offsets[idx+1]:06})")
+                idx += 2
+            elif roll < 0.3:
+                caret = '^' if rng.random() < 0.3 else ''
+                cmds.append(f"_MSAD(${offsets[idx]:06}{caret})")
+                idx += 1
+            elif roll < 0.45 and idx + 1 < len(offsets):
+                cmds.append(
+                    f"_ZM{rng.randrange(0x10000):04x}a("
+                    f"${offsets[idx]:06}^${offsets[idx+1]:06}@n)")
+                idx += 2
+            else:
+                mods = rng.choice(["@n", "@k@e", "@x", ""])
+                cmds.append(
+                    f"_ZM{rng.randrange(0x10000):04x}b("
+                    f"{mods}${offsets[idx]:06})")
+                idx += 1
+
+        return (';'.join(cmds) + ';').encode('utf-8')
+
+    @staticmethod
+    def scene_name(index):
+        route = ["ARC", "CIEL", "QA", "COMMON"][index % 4]
+        day = index // 16 + 1
+        if route == "QA":
+            return f"QA_{index:03}"
+        if route == "COMMON":
+            return f"{day:02}_{index:03}"
+        return f"{day:02}_{index:03}_{route}"
+
+    @staticmethod
+    def pack_string_table(strings):
+        # script_text.mrg layout: BE offset table followed by string data
+        offsets = []
+        data = bytearray()
+        for string in strings:
+            offsets.append(len(data))
+            data += string.encode('utf-8')
+        offsets += [len(data), len(data), 0xFFFFFFFF]
+        return struct.pack(f">{len(offsets)}I", *offsets), bytes(data)
+
+    @classmethod
+    def game(cls, seed=0, scene_count=None, lines_per_scene=None,
+             orphan_count=16):
+        # Generate (scene names, scene scripts, jp strings) for a synthetic
+        # game. Every string is referenced by exactly one scene, apart from
+        # a tail of orphans.
+        rng = random.Random(seed)
+        scene_count = scene_count or cls.ALLSCR_SCENE_COUNT
+        lines_per_scene = lines_per_scene or cls.LINES_PER_SCENE
+        strings = cls.game_strings(
+            rng, scene_count * lines_per_scene + orphan_count)
+        names = [cls.scene_name(i) for i in range(scene_count)]
+        scripts = [
+            cls.scene_script(rng, list(range(
+                i * lines_per_scene, (i + 1) * lines_per_scene)))
+            for i in range(scene_count)
+        ]
+        return names, scripts, strings
+
+    @classmethod
+    def write_game(cls, directory, seed=0, scene_count=None,
+                   lines_per_scene=None, level=1):
+        # Write allscr.mrg and script_text.mrg for a synthetic game into
+        # the given directory. Returns (allscr path, script_text path).
+        names, scripts, strings = cls.game(seed, scene_count, lines_per_scene)
+        allscr_path = os.path.join(directory, "allscr.mrg")
+        script_text_path = os.path.join(directory, "script_text.mrg")
+
+        name_table = b''.join(
+            name.encode('utf-8').ljust(32, b'\0') for name in names)
+        with open(allscr_path, 'wb') as f:
+            f.write(Mzp.pack(
+                [name_table, b'\0' * 64, b'\0' * 64] +
+                [Mzx.compress(script, level=level) for script in scripts]
+            ))
+
+        with open(script_text_path, 'wb') as f:
+            f.write(Mzp.pack(list(cls.pack_string_table(strings))))
+
+        return allscr_path, script_text_path
+
+    @classmethod
+    def translated_db(cls, seed=0, scene_count=None, lines_per_scene=None,
+                      translated=0.8, commented=0.1, override_count=32):
+        # A TranslationDb for a synthetic game, as if it were partway
+        # through translation: most lines have English text, some have
+        # comments, and a few offsets are overridden.
+        names, scripts, strings = cls.game(seed, scene_count, lines_per_scene)
+        content_hash_by_offset, line_by_hash = TranslationDb.hash_strings(
+            dict(enumerate(strings)))
+
+        scene_map = {
+            name: TranslationDb.parse_script_cmds(
+                script, line_by_hash, content_hash_by_offset)
+            for name, script in zip(names, scripts)
+        }
+        scene_map['ORPHANED_LINES'] = TranslationDb.orphaned_commands(
+            scene_map, content_hash_by_offset)
+
+        rng = random.Random(seed)
+        for line in line_by_hash.values():
+            if rng.random() < translated:
+                line.en_text = ' '.join(
+                    rng.choice(cls.EN_WORDS)
+                    for _ in range(rng.randrange(3, 20)))
+            if rng.random() < commented:
+                line.comment = f"TL note {rng.randrange(1000)}"
+
+        overrides_by_offset = {
+            offset: TranslationDb.TLLine(
+                strings[offset], f"Override {offset}", None)
+            for offset in rng.sample(
+                range(len(strings)), min(override_count, len(strings)))
+        }
+
+        return TranslationDb(scene_map, line_by_hash, overrides_by_offset)
@@ -0,0 +1,159 @@
+import itertools
+import sys
+from array import array
+from collections.abc import Sequence
+
+
+class SceneTables:
+    """
+    Tables shared by all the ColumnarScenes of a DB: each distinct content
+    hash and modifier tuple is stored once, and scenes refer to them by
+    index.
+    """
+
+    def __init__(self):
+        self.hashes = []
+        self._hash_ids = {}
+        self.modifiers = [()]
+        self._modifier_ids = {(): 0}
+
+    def hash_id(self, jp_hash):
+        hash_id = self._hash_ids.get(jp_hash)
+        if hash_id is None:
+            hash_id = len(self.hashes)
+            self.hashes.append(sys.intern(jp_hash))
+            self._hash_ids[jp_hash] = hash_id
+        return hash_id
+
+    def modifier_id(self, modifiers):
+        modifiers = tuple(modifiers) if modifiers else ()
+        modifier_id = self._modifier_ids.get(modifiers)
+        if modifier_id is None:
+            modifier_id = len(self.modifiers)
+            self.modifiers.append(modifiers)
+            self._modifier_ids[modifiers] = modifier_id
+        return modifier_id
+
+
+class ColumnarScene(Sequence):
+    """
+    Compact stand-in for a scene's list of TextCommands. The command fields
+    are stored as parallel arrays rather than as one object per command:
+        - offsets: int32 script_text offsets
+        - pages: int16 page numbers
+        - flags: uint8 FLAG_* bits
+        - hash_ids/modifier_ids: indices into the shared SceneTables
+    Bulk consumers can read the columns directly. Indexing or iterating
+    builds TextCommand views on demand, so the scene can be used anywhere
+    a list of commands is expected. Views are copies: the scene itself is
+    read-only.
+    """
+
+    FLAG_RUBY = 1
+    FLAG_GLUED = 2
+    FLAG_CHOICE = 4
+    FLAG_FORCED_NEWLINE = 8
+
+    OFFSET_TYPECODE = 'i' if array('i').itemsize == 4 else 'l'
+    # Same range as the page numbers in the binary DB format (int32)
+    PAGE_TYPECODE = 'i' if array('i').itemsize == 4 else 'l'
+    FLAG_TYPECODE = 'B'
+    ID_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+
+    def __init__(self, tables, text_command_cls, offsets, pages, flags,
+                 hash_ids, modifier_ids):
+        self.tables = tables
+        self._text_command_cls = text_command_cls
+        self.offsets = offsets
+        self.pages = pages
+        self.flags = flags
+        self.hash_ids = hash_ids
+        self.modifier_ids = modifier_ids
+
+    @classmethod
+    def empty(cls, tables, text_command_cls):
+        return cls(
+            tables,
+            text_command_cls,
+            array(cls.OFFSET_TYPECODE),
+            array(cls.PAGE_TYPECODE),
+            array(cls.FLAG_TYPECODE),
+            array(cls.ID_TYPECODE),
+            array(cls.ID_TYPECODE)
+        )
+
+    @classmethod
+    def from_commands(cls, commands, tables, text_command_cls):
+        scene = cls.empty(tables, text_command_cls)
+        for cmd in commands:
+            scene.append_fields(
+                cmd.offset, cmd.jp_hash, cmd.page_number,
+                cls.command_flags(cmd), cmd.modifiers)
+        return scene
+
+    @classmethod
+    def command_flags(cls, cmd):
+        return (
+            (cls.FLAG_RUBY if cmd.has_ruby else 0) |
+            (cls.FLAG_GLUED if cmd.is_glued else 0) |
+            (cls.FLAG_CHOICE if cmd.is_choice else 0) |
+            (cls.FLAG_FORCED_NEWLINE if cmd.has_forced_newline else 0)
+        )
+
+    def append_fields(self, offset, jp_hash, page_number, flags, modifiers):
+        self.offsets.append(offset)
+        self.pages.append(page_number)
+        self.flags.append(flags)
+        self.hash_ids.append(self.tables.hash_id(jp_hash))
+        self.modifier_ids.append(self.tables.modifier_id(modifiers))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._view(i) for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("scene index out of range")
+        return self._view(idx)
+
+    def __iter__(self):
+        return map(self._view, range(len(self)))
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or len(other) != len(self):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def _view(self, idx):
+        flags = self.flags[idx]
+        return self._text_command_cls(
+            self.offsets[idx],
+            self.tables.hashes[self.hash_ids[idx]],
+            self.pages[idx],
+            bool(flags & self.FLAG_RUBY),
+            bool(flags & self.FLAG_GLUED),
+            bool(flags & self.FLAG_CHOICE),
+            self.tables.modifiers[self.modifier_ids[idx]],
+            bool(flags & self.FLAG_FORCED_NEWLINE)
+        )
+
+    def jp_hashes(self):
+        hashes = self.tables.hashes
+        return [hashes[hash_id] for hash_id in self.hash_ids]
+
+    def glued(self):
+        return [bool(flags & self.FLAG_GLUED) for flags in self.flags]
+
+    def page_spans(self):
+        # (start, end) index ranges of the commands on each page
+        spans = []
+        start = 0
+        for _, group in itertools.groupby(self.pages):
+            end = start + sum(1 for _ in group)
+            spans.append((start, end))
+            start = end
+        return spans
@@ -0,0 +1,692 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+
+from libs.deepLuna.luna.columnar_scene import ColumnarScene, SceneTables
+
+
+class BinaryDbFormat:
+    """
+    Compact binary serialization of the translation DB, used alongside the
+    JSON format. Loading and saving round-trips exactly to the JSON form.
+    All integers are little endian. File layout:
+        - Header: magic, format version
+        - String table: every JP/EN/comment/scene name/modifier string,
+          deduplicated. Index 0 is reserved for None.
+        - Hash table: 20 byte binary SHA1 of every content hash
+        - Line table: fixed width (hash, jp, en, comment) records
+        - Override table: fixed width (offset, jp, en, comment) records
+        - Scene table: (name, command count) followed by that many fixed
+          width text command records with the flags packed into a byte
+        - Extras: JSON blob of the small maps (charswap, source hashes)
+    That is the flat layout (version 1), which has to be decoded in full.
+    The segmented layout (version 2, written by default) instead starts
+    with an index of byte ranges, and splits the lines and scenes into
+    self-contained segments which can each be decoded on their own:
+        - Header: magic, format version, counts, and the byte ranges of
+          the override segment and the extras
+        - Hash table: 20 byte binary SHA1 of every content hash, line
+          table hashes first
+        - Hash order: line indices sorted by hash, to look lines up by
+          binary search without decoding the hash table
+        - Line segment index: byte range of each segment of
+          LINES_PER_SEGMENT lines
+        - Scene index: byte range and command count of each scene
+        - Segments: each a string table of its own followed by fixed width
+          records, as in the flat layout
+    Loading it lazily (see unpack) only reads the index up front, so a
+    scene or line is decoded on first access. Files are mapped rather than
+    read where possible, so idle processes sharing a DB share its pages.
+    """
+
+    MAGIC = b"LUNADB\0\0"
+    FLAT_VERSION = 1
+    VERSION = 2
+    EXTENSION = ".ldb"
+
+    HEADER_FORMAT = "<8sI"
+    COUNT_FORMAT = "<I"
+    # String offsets are in code points into the decoded string blob, so
+    # the blob only needs to be decoded once on load
+    STRING_HEADER_FORMAT = "<II"  # string count, blob size in bytes
+    HASH_SIZE = 20
+    LINE_FORMAT = "<IIII"  # hash index, jp, en, comment
+    OVERRIDE_FORMAT = "<IIII"  # offset, jp, en, comment
+    SCENE_FORMAT = "<II"  # name, command count
+    COMMAND_FORMAT = "<IIiBI"  # offset, hash index, page, flags, modifiers
+
+    # Segmented layout: hash count, line count, lines per segment, scene
+    # count, override segment (position, size), extras (position, size)
+    SEGMENTED_HEADER_FORMAT = "<IIIIIIII"
+    HASH_ORDER_FORMAT = "<I"
+    SEGMENT_FORMAT = "<II"  # position, size
+    SCENE_INDEX_FORMAT = "<III"  # position, size, command count
+    SEGMENT_LINE_FORMAT = "<III"  # jp, en, comment. Hash is by position.
+    LINES_PER_SEGMENT = 512
+
+    # Text command flag bits, shared with the columnar scene layout
+    FLAG_RUBY = ColumnarScene.FLAG_RUBY
+    FLAG_GLUED = ColumnarScene.FLAG_GLUED
+    FLAG_CHOICE = ColumnarScene.FLAG_CHOICE
+    FLAG_FORCED_NEWLINE = ColumnarScene.FLAG_FORCED_NEWLINE
+
+    # Modifier lists are stored as a single string with this separator
+    MODIFIER_SEPARATOR = '\0'
+
+    @classmethod
+    def is_binary_db(cls, data):
+        return bytes(data[:len(cls.MAGIC)]) == cls.MAGIC
+
+    @classmethod
+    def is_segmented_db(cls, data):
+        header_size = struct.calcsize(cls.HEADER_FORMAT)
+        return cls.is_binary_db(data) and len(data) >= header_size and \
+            struct.unpack_from(cls.HEADER_FORMAT, data)[1] == cls.VERSION
+
+    @staticmethod
+    def map_file(input_file):
+        # Read-only mapping of a DB file. It stays valid after the file is
+        # closed, and after the file is atomically replaced. Windows can't
+        # replace a mapped file, so read it in there.
+        if os.name == 'nt':
+            return input_file.read()
+        try:
+            return mmap.mmap(
+                input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return input_file.read()
+
+    class _StringTable:
+        # Deduplicating string table builder. Index 0 is None.
+        def __init__(self):
+            self._index_by_string = {}
+            self._strings = []
+
+        def index(self, string):
+            if string is None:
+                return 0
+            idx = self._index_by_string.get(string)
+            if idx is None:
+                self._strings.append(string)
+                idx = len(self._strings)
+                self._index_by_string[string] = idx
+            return idx
+
+        def pack(self):
+            offsets = [0]
+            for string in self._strings:
+                offsets.append(offsets[-1] + len(string))
+            blob = ''.join(self._strings).encode('utf-8')
+            return (
+                struct.pack(BinaryDbFormat.STRING_HEADER_FORMAT,
+                            len(self._strings), len(blob)) +
+                struct.pack(f"<{len(offsets)}I", *offsets) +
+                blob
+            )
+
+    @classmethod
+    def pack_hashes(cls, hashes):
+        # All the keys must be lowercase hex SHA1 digests to round-trip
+        joined = ''.join(hashes)
+        packed = bytes.fromhex(joined)
+        if len(packed) != cls.HASH_SIZE * len(hashes) or \
+                packed.hex() != joined:
+            raise ValueError("Content hashes must be hex SHA1 digests")
+        return struct.pack(cls.COUNT_FORMAT, len(hashes)) + packed
+
+    @classmethod
+    def hash_index(cls, scene_map, line_by_hash):
+        # Commands should only reference hashes in the line table, but
+        # keep any strays so the DB round-trips regardless
+        hash_index = {h: i for i, h in enumerate(line_by_hash)}
+        for scene_commands in scene_map.values():
+            for cmd in scene_commands:
+                if cmd.jp_hash not in hash_index:
+                    hash_index[cmd.jp_hash] = len(hash_index)
+        return hash_index
+
+    @classmethod
+    def command_record(cls, cmd, hash_index, strings):
+        return (
+            cmd.offset,
+            hash_index[cmd.jp_hash],
+            cmd.page_number,
+            (cls.FLAG_RUBY if cmd.has_ruby else 0) |
+            (cls.FLAG_GLUED if cmd.is_glued else 0) |
+            (cls.FLAG_CHOICE if cmd.is_choice else 0) |
+            (cls.FLAG_FORCED_NEWLINE if cmd.has_forced_newline else 0),
+            strings.index(
+                cls.MODIFIER_SEPARATOR.join(cmd.modifiers)
+                if cmd.modifiers else None)
+        )
+
+    @classmethod
+    def pack(cls, scene_map, line_by_hash, overrides_by_offset,
+             charswap_map, source_hashes):
+        # Flat layout
+        strings = cls._StringTable()
+        out = []
+        hash_index = cls.hash_index(scene_map, line_by_hash)
+
+        # Line table
+        line_struct = struct.Struct(cls.LINE_FORMAT)
+        out.append(struct.pack(cls.COUNT_FORMAT, len(line_by_hash)))
+        for idx, line in enumerate(line_by_hash.values()):
+            out.append(line_struct.pack(
+                idx,
+                strings.index(line.jp_text),
+                strings.index(line.en_text),
+                strings.index(line.comment)
+            ))
+
+        # Override table
+        override_struct = struct.Struct(cls.OVERRIDE_FORMAT)
+        out.append(struct.pack(cls.COUNT_FORMAT, len(overrides_by_offset)))
+        for offset, line in overrides_by_offset.items():
+            out.append(override_struct.pack(
+                offset,
+                strings.index(line.jp_text),
+                strings.index(line.en_text),
+                strings.index(line.comment)
+            ))
+
+        # Scene table
+        scene_struct = struct.Struct(cls.SCENE_FORMAT)
+        command_struct = struct.Struct(cls.COMMAND_FORMAT)
+        out.append(struct.pack(cls.COUNT_FORMAT, len(scene_map)))
+        for scene_name, scene_commands in scene_map.items():
+            out.append(scene_struct.pack(
+                strings.index(scene_name), len(scene_commands)))
+            for cmd in scene_commands:
+                out.append(command_struct.pack(
+                    *cls.command_record(cmd, hash_index, strings)))
+
+        # The remaining maps are tiny, so just store them as JSON
+        extras = json.dumps({
+            'charswap_map': charswap_map,
+            'source_hashes': source_hashes,
+        }).encode('utf-8')
+        out.append(struct.pack(cls.COUNT_FORMAT, len(extras)))
+        out.append(extras)
+
+        return b''.join([
+            struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.FLAT_VERSION),
+            strings.pack(),
+            cls.pack_hashes(list(hash_index)),
+        ] + out)
+
+    @classmethod
+    def pack_segmented(cls, scene_map, line_by_hash, overrides_by_offset,
+                       charswap_map, source_hashes):
+        hash_index = cls.hash_index(scene_map, line_by_hash)
+        hash_table = cls.pack_hashes(list(hash_index))[
+            struct.calcsize(cls.COUNT_FORMAT):]
+        line_count = len(line_by_hash)
+        hash_order = sorted(
+            range(line_count),
+            key=lambda i: hash_table[i * cls.HASH_SIZE:
+                                     (i + 1) * cls.HASH_SIZE])
+
+        # Segment bodies, positioned once the size of the index is known
+        segments = []
+
+        lines = list(line_by_hash.values())
+        line_struct = struct.Struct(cls.SEGMENT_LINE_FORMAT)
+        for start in range(0, line_count, cls.LINES_PER_SEGMENT):
+            strings = cls._StringTable()
+            records = [
+                line_struct.pack(
+                    strings.index(line.jp_text),
+                    strings.index(line.en_text),
+                    strings.index(line.comment))
+                for line in lines[start:start + cls.LINES_PER_SEGMENT]
+            ]
+            segments.append(strings.pack() + b''.join(records))
+        line_segment_count = len(segments)
+
+        command_struct = struct.Struct(cls.COMMAND_FORMAT)
+        for scene_commands in scene_map.values():
+            strings = cls._StringTable()
+            records = [
+                command_struct.pack(
+                    *cls.command_record(cmd, hash_index, strings))
+                for cmd in scene_commands
+            ]
+            segments.append(strings.pack() + b''.join(records))
+
+        strings = cls._StringTable()
+        override_struct = struct.Struct(cls.OVERRIDE_FORMAT)
+        records = [
+            override_struct.pack(
+                offset,
+                strings.index(line.jp_text),
+                strings.index(line.en_text),
+                strings.index(line.comment))
+            for offset, line in overrides_by_offset.items()
+        ]
+        segments.append(
+            strings.pack() +
+            struct.pack(cls.COUNT_FORMAT, len(records)) +
+            b''.join(records))
+
+        segments.append(json.dumps({
+            'charswap_map': charswap_map,
+            'source_hashes': source_hashes,
+            'scene_names': list(scene_map),
+        }).encode('utf-8'))
+
+        # Lay the segments out after the index
+        pos = (
+            struct.calcsize(cls.HEADER_FORMAT) +
+            struct.calcsize(cls.SEGMENTED_HEADER_FORMAT) +
+            len(hash_table) +
+            struct.calcsize(cls.HASH_ORDER_FORMAT) * line_count +
+            struct.calcsize(cls.SEGMENT_FORMAT) * line_segment_count +
+            struct.calcsize(cls.SCENE_INDEX_FORMAT) * len(scene_map)
+        )
+        ranges = []
+        for segment in segments:
+            ranges.append((pos, len(segment)))
+            pos += len(segment)
+
+        return b''.join([
+            struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION),
+            struct.pack(
+                cls.SEGMENTED_HEADER_FORMAT,
+                len(hash_index), line_count, cls.LINES_PER_SEGMENT,
+                len(scene_map), *ranges[-2], *ranges[-1]),
+            hash_table,
+            struct.pack(f"<{line_count}I", *hash_order),
+        ] + [
+            struct.pack(cls.SEGMENT_FORMAT, *segment_range)
+            for segment_range in ranges[:line_segment_count]
+        ] + [
+            struct.pack(cls.SCENE_INDEX_FORMAT, *segment_range,
+                        len(scene_commands))
+            for segment_range, scene_commands in zip(
+                ranges[line_segment_count:], scene_map.values())
+        ] + segments)
+
+    class _Reader:
+        def __init__(self, data):
+            self.view = memoryview(data)
+            self.pos = 0
+
+        def unpack(self, fmt):
+            ret = struct.unpack_from(fmt, self.view, self.pos)
+            self.pos += struct.calcsize(fmt)
+            return ret
+
+        def count(self):
+            return self.unpack(BinaryDbFormat.COUNT_FORMAT)[0]
+
+        def take(self, size):
+            ret = self.view[self.pos:self.pos + size]
+            if len(ret) != size:
+                raise ValueError("Truncated DB file")
+            self.pos += size
+            return ret
+
+        def records(self, fmt, count):
+            return struct.iter_unpack(
+                fmt, self.take(struct.calcsize(fmt) * count))
+
+        def strings(self):
+            # String table. Decode the blob once and slice it up.
+            string_count, blob_size = self.unpack(
+                BinaryDbFormat.STRING_HEADER_FORMAT)
+            offsets = self.unpack(f"<{string_count + 1}I")
+            text = str(self.take(blob_size), 'utf-8')
+            strings = [None]
+            strings += [
+                text[start:end] for start, end in zip(offsets, offsets[1:])
+            ]
+            return strings
+
+    @classmethod
+    def unpack(cls, data, text_command_cls, tl_line_cls, columnar=False,
+               lazy=False):
+        # Returns (scene_map, line_by_hash, overrides_by_offset,
+        # charswap_map, source_hashes). With columnar, the scenes are
+        # ColumnarScenes rather than lists of text commands. With lazy,
+        # a segmented DB's scene and line maps are LazySceneMap and
+        # LazyLineMap views over data, which must then stay unchanged.
+        reader = cls._Reader(data)
+        magic, version = reader.unpack(cls.HEADER_FORMAT)
+        if magic != cls.MAGIC:
+            raise ValueError("Not a binary translation DB")
+        if version == cls.VERSION:
+            segmented = cls.SegmentedDb(
+                data, text_command_cls, tl_line_cls, columnar)
+            scene_map = cls.LazySceneMap(segmented)
+            line_by_hash = cls.LazyLineMap(segmented)
+            if not lazy:
+                scene_map = scene_map.materialize()
+                line_by_hash = line_by_hash.materialize()
+            return (
+                scene_map,
+                line_by_hash,
+                segmented.overrides(),
+                segmented.extras['charswap_map'],
+                segmented.extras['source_hashes'],
+            )
+        if version != cls.FLAT_VERSION:
+            raise ValueError(f"Unsupported binary DB version {version}")
+
+        strings = reader.strings()
+
+        # Hash table, hexed in one go. Interned like the JSON loader's.
+        hash_count = reader.count()
+        hex_hashes = reader.take(hash_count * cls.HASH_SIZE).hex()
+        hashes = [
+            sys.intern(hex_hashes[i:i + 40])
+            for i in range(0, len(hex_hashes), 40)
+        ]
+
+        line_by_hash = {
+            hashes[hash_idx]: tl_line_cls(
+                strings[jp], strings[en], strings[comment])
+            for hash_idx, jp, en, comment
+            in reader.records(cls.LINE_FORMAT, reader.count())
+        }
+
+        overrides_by_offset = {
+            offset: tl_line_cls(strings[jp], strings[en], strings[comment])
+            for offset, jp, en, comment
+            in reader.records(cls.OVERRIDE_FORMAT, reader.count())
+        }
+
+        if columnar:
+            scene_map = cls.unpack_columnar_scenes(
+                reader, strings, hashes, text_command_cls)
+        else:
+            scene_map = {}
+            for _ in range(reader.count()):
+                name, command_count = reader.unpack(cls.SCENE_FORMAT)
+                scene_map[strings[name]] = cls.text_commands(
+                    reader.records(cls.COMMAND_FORMAT, command_count),
+                    strings, hashes.__getitem__, text_command_cls)
+
+        extras = json.loads(str(reader.take(reader.count()), 'utf-8'))
+
+        return (
+            scene_map,
+            line_by_hash,
+            overrides_by_offset,
+            extras['charswap_map'],
+            extras['source_hashes'],
+        )
+
+    @classmethod
+    def text_commands(cls, records, strings, hash_at, text_command_cls):
+        separator = cls.MODIFIER_SEPARATOR
+        return [
+            text_command_cls(
+                offset,
+                hash_at(hash_idx),
+                page_number,
+                bool(flags & cls.FLAG_RUBY),
+                bool(flags & cls.FLAG_GLUED),
+                bool(flags & cls.FLAG_CHOICE),
+                strings[modifiers].split(separator) if modifiers else None,
+                bool(flags & cls.FLAG_FORCED_NEWLINE)
+            )
+            for offset, hash_idx, page_number, flags, modifiers in records
+        ]
+
+    @classmethod
+    def unpack_columnar_scenes(cls, reader, strings, hashes,
+                               text_command_cls):
+        # The file's hash table becomes the shared hash table, so hash
+        # indices and flag bits carry over to the columns unchanged
+        tables = SceneTables()
+        for jp_hash in hashes:
+            tables.hash_id(jp_hash)
+
+        modifier_ids = {0: 0}
+        scene_map = {}
+        for _ in range(reader.count()):
+            name, command_count = reader.unpack(cls.SCENE_FORMAT)
+            records = list(
+                reader.records(cls.COMMAND_FORMAT, command_count))
+            offsets, hash_ids, pages, flags, modifiers = \
+                zip(*records) if records else ([],) * 5
+
+            for modifier in modifiers:
+                if modifier not in modifier_ids:
+                    modifier_ids[modifier] = tables.modifier_id(
+                        strings[modifier].split(cls.MODIFIER_SEPARATOR))
+
+            scene_map[strings[name]] = ColumnarScene(
+                tables,
+                text_command_cls,
+                array(ColumnarScene.OFFSET_TYPECODE, offsets),
+                array(ColumnarScene.PAGE_TYPECODE, pages),
+                array(ColumnarScene.FLAG_TYPECODE, flags),
+                array(ColumnarScene.ID_TYPECODE, hash_ids),
+                array(ColumnarScene.ID_TYPECODE,
+                      [modifier_ids[m] for m in modifiers])
+            )
+
+        return scene_map
+
+    class SegmentedDb:
+        # Index of a segmented DB, decoding segments from it on request
+
+        def __init__(self, data, text_command_cls, tl_line_cls, columnar):
+            self._view = memoryview(data)
+            self._text_command_cls = text_command_cls
+            self._tl_line_cls = tl_line_cls
+            self._scene_tables = SceneTables() if columnar else None
+
+            fmt = BinaryDbFormat
+            reader = fmt._Reader(data)
+            reader.unpack(fmt.HEADER_FORMAT)
+            (hash_count, self.line_count, self._lines_per_segment,
+             scene_count, overrides_pos, overrides_size, extras_pos,
+             extras_size) = reader.unpack(fmt.SEGMENTED_HEADER_FORMAT)
+
+            # The tables are kept as views into the data and read on demand
+            self._hash_table = reader.take(hash_count * fmt.HASH_SIZE)
+            self._hash_order_pos = reader.pos
+            reader.take(
+                struct.calcsize(fmt.HASH_ORDER_FORMAT) * self.line_count)
+            segment_count = -(-self.line_count // self._lines_per_segment) \
+                if self._lines_per_segment else 0
+            self._line_segments = list(
+                reader.records(fmt.SEGMENT_FORMAT, segment_count))
+            self._scene_index = list(
+                reader.records(fmt.SCENE_INDEX_FORMAT, scene_count))
+            self._overrides_range = (overrides_pos, overrides_size)
+            self.extras = json.loads(
+                str(self._segment(extras_pos, extras_size).take(
+                    extras_size), 'utf-8'))
+            self.scene_names = self.extras['scene_names']
+
+        def _segment(self, pos, size):
+            if pos + size > len(self._view):
+                raise ValueError("Truncated DB file")
+            return BinaryDbFormat._Reader(self._view[pos:pos + size])
+
+        def hash_at(self, idx):
+            size = BinaryDbFormat.HASH_SIZE
+            return sys.intern(
+                self._hash_table[idx * size:(idx + 1) * size].hex())
+
+        def line_index(self, jp_hash):
+            # Binary search of the sorted hash order. None if not a line.
+            size = BinaryDbFormat.HASH_SIZE
+            try:
+                key = bytes.fromhex(jp_hash)
+            except (TypeError, ValueError):
+                return None
+
+            lo, hi = 0, self.line_count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                idx = struct.unpack_from(
+                    BinaryDbFormat.HASH_ORDER_FORMAT, self._view,
+                    self._hash_order_pos + 4 * mid)[0]
+                candidate = bytes(self._hash_table[idx * size:
+                                                   (idx + 1) * size])
+                if candidate == key:
+                    return idx
+                if candidate < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return None
+
+        def segment_of_line(self, idx):
+            return divmod(idx, self._lines_per_segment)
+
+        def line_segment(self, segment_idx):
+            reader = self._segment(*self._line_segments[segment_idx])
+            strings = reader.strings()
+            return [
+                self._tl_line_cls(
+                    strings[jp], strings[en], strings[comment])
+                for jp, en, comment in struct.iter_unpack(
+                    BinaryDbFormat.SEGMENT_LINE_FORMAT,
+                    reader.view[reader.pos:])
+            ]
+
+        def line_segment_count(self):
+            return len(self._line_segments)
+
+        def command_count(self, scene_idx):
+            return self._scene_index[scene_idx][2]
+
+        def scene(self, scene_idx):
+            pos, size, command_count = self._scene_index[scene_idx]
+            reader = self._segment(pos, size)
+            strings = reader.strings()
+            records = reader.records(
+                BinaryDbFormat.COMMAND_FORMAT, command_count)
+            if self._scene_tables is None:
+                return BinaryDbFormat.text_commands(
+                    records, strings, self.hash_at, self._text_command_cls)
+
+            scene = ColumnarScene.empty(
+                self._scene_tables, self._text_command_cls)
+            separator = BinaryDbFormat.MODIFIER_SEPARATOR
+            for offset, hash_idx, page_number, flags, modifiers in records:
+                scene.append_fields(
+                    offset, self.hash_at(hash_idx), page_number, flags,
+                    strings[modifiers].split(separator)
+                    if modifiers else None)
+            return scene
+
+        def overrides(self):
+            reader = self._segment(*self._overrides_range)
+            strings = reader.strings()
+            return {
+                offset: self._tl_line_cls(
+                    strings[jp], strings[en], strings[comment])
+                for offset, jp, en, comment in reader.records(
+                    BinaryDbFormat.OVERRIDE_FORMAT, reader.count())
+            }
+
+    class LazySceneMap(Mapping):
+        # Scene name -> commands view of a segmented DB, decoding each
+        # scene on first access. Decoded scenes are kept.
+        def __init__(self, segmented):
+            self._segmented = segmented
+            self._index_by_name = {
+                name: i for i, name in enumerate(segmented.scene_names)
+            }
+            self._scenes = {}
+
+        def __getitem__(self, scene_name):
+            scene = self._scenes.get(scene_name)
+            if scene is None:
+                # If two threads race to decode a scene, both get the copy
+                # stored first
+                scene = self._scenes.setdefault(
+                    scene_name,
+                    self._segmented.scene(self._index_by_name[scene_name]))
+            return scene
+
+        def __contains__(self, scene_name):
+            return scene_name in self._index_by_name
+
+        def __iter__(self):
+            return iter(self._index_by_name)
+
+        def __len__(self):
+            return len(self._index_by_name)
+
+        def command_count(self, scene_name):
+            # Without decoding the scene
+            return self._segmented.command_count(
+                self._index_by_name[scene_name])
+
+        def decoded_count(self):
+            return len(self._scenes)
+
+        def materialize(self):
+            return {name: self[name] for name in self._index_by_name}
+
+    class LazyLineMap(Mapping):
+        # Hash -> TLLine view of a segmented DB, decoding a segment of
+        # lines on first access to any of them. Decoded lines are kept, and
+        # can be replaced by edits.
+        def __init__(self, segmented):
+            self._segmented = segmented
+            self._segments = {}
+
+        def _segment(self, segment_idx):
+            lines = self._segments.get(segment_idx)
+            if lines is None:
+                # As for scenes, the first decoded copy stored wins, so an
+                # edit can't be lost to a racing decode
+                lines = self._segments.setdefault(
+                    segment_idx, self._segmented.line_segment(segment_idx))
+            return lines
+
+        def __getitem__(self, jp_hash):
+            idx = self._segmented.line_index(jp_hash)
+            if idx is None:
+                raise KeyError(jp_hash)
+            segment_idx, line_idx = self._segmented.segment_of_line(idx)
+            return self._segment(segment_idx)[line_idx]
+
+        def __setitem__(self, jp_hash, line):
+            # Replace an existing line. Lines can't be added.
+            idx = self._segmented.line_index(jp_hash)
+            if idx is None:
+                raise KeyError(jp_hash)
+            segment_idx, line_idx = self._segmented.segment_of_line(idx)
+            self._segment(segment_idx)[line_idx] = line
+
+        def __contains__(self, jp_hash):
+            return self._segmented.line_index(jp_hash) is not None
+
+        def __iter__(self):
+            return map(self._segmented.hash_at,
+                       range(self._segmented.line_count))
+
+        def __len__(self):
+            return self._segmented.line_count
+
+        def items(self):
+            # One pass over the segments rather than a search per hash
+            return list(zip(self, self.values()))
+
+        def values(self):
+            return [
+                line
+                for segment_idx in range(self._segmented.line_segment_count())
+                for line in self._segment(segment_idx)
+            ]
+
+        def decoded_count(self):
+            return sum(len(lines) for lines in self._segments.values())
+
+        def materialize(self):
+            return dict(self.items())
@@ -0,0 +1,303 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+from libs.deepLuna.luna.save_service import DbSaveService
+from libs.deepLuna.luna.sqlite_db import SqliteTranslationDb
+from libs.deepLuna.luna.translation_db import BinaryDbFormat, TranslationDb
+
+
+class DbJournal:
+    """
+    Append-only write-ahead journal of edits to a TranslationDb, kept next
+    to the DB file as <db path>.journal, so that edits are durable without
+    rewriting the whole DB.
+    Each edit is appended as one small record as it happens. Records are
+    fsynced in batches: every `sync_batch` records, every `sync_interval`
+    seconds, or on sync()/close().
+    Loading replays the journal over the last snapshot (the DB file).
+    Once the journal grows past `compact_threshold` bytes, it is rotated to
+    <db path>.journal.old and a new snapshot is written in the background by
+    a DbSaveService, after which the old journal is deleted. If that is
+    interrupted, the next load just replays both journals: replaying an
+    edit twice, in order, is harmless. Records that no longer apply are
+    skipped.
+    Edits that can't be replayed from a record (re-extraction from the MRG
+    files) are not journaled: a new snapshot is written there and then,
+    and the journal of the edits before it is discarded.
+    """
+
+    SUFFIX = ".journal"
+    OLD_SUFFIX = ".journal.old"
+    # Snapshot taken after a re-extraction, until it replaces the DB file
+    STAGED_SUFFIX = ".staged"
+
+    # Each record is a (payload size, crc32) header followed by a compact
+    # JSON [edit code, args...] payload
+    RECORD_HEADER_FORMAT = "<II"
+    RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+
+    # Journal codes for the TranslationDb edit methods
+    EDIT_CODES = {
+        'set_translation_and_comment_for_hash': 't',
+        'override_translation_and_comment_for_offset': 'o',
+        'clear_offset_overrides': 'c',
+        'set_charswap_map': 's',
+    }
+    EDITS_BY_CODE = {v: k for k, v in EDIT_CODES.items()}
+
+    # Edits which can't be replayed from a record, as they read other
+    # files. A new snapshot is written in their place.
+    SNAPSHOT_EDITS = {'update_from_mrg'}
+
+    DEFAULT_SYNC_BATCH = 256
+    DEFAULT_SYNC_INTERVAL = 1.0
+    DEFAULT_COMPACT_THRESHOLD = 4 * 1024 * 1024
+
+    def __init__(self, db_path, sync_batch=DEFAULT_SYNC_BATCH,
+                 sync_interval=DEFAULT_SYNC_INTERVAL,
+                 compact_threshold=DEFAULT_COMPACT_THRESHOLD):
+        # Load the snapshot and replay any outstanding edits over it
+        self._db_path = db_path
+        self._recover_staged_snapshot()
+        self.tl_db = TranslationDb.from_file(db_path)
+        if isinstance(self.tl_db, SqliteTranslationDb):
+            raise ValueError("SQLite DBs are already written per edit")
+
+        self._sync_batch = sync_batch
+        self._sync_interval = sync_interval
+        self._compact_threshold = compact_threshold
+
+        self._lock = threading.RLock()
+        self._unsynced = 0
+        self._closed = False
+        # Held from rotating the journal until the snapshot taken then is
+        # written, so snapshots are written one at a time, in order
+        self._save_lock = threading.Lock()
+        self._saver_holds_save_lock = False
+        self._saver = DbSaveService(
+            db_path, self._rotate_and_snapshot, self._remove_old_journal,
+            self._release_save_lock)
+
+        self.replay(self.tl_db, self.old_journal_path())
+        journal_size = self.replay(self.tl_db, self.journal_path())
+        self._file = open(self.journal_path(), 'ab', buffering=0)
+        self._file.truncate(journal_size)
+
+        self.tl_db.add_edit_listener(self._on_edit)
+
+        # Background fsync of trickling edits
+        self._stop = threading.Event()
+        self._flusher = None
+        if sync_interval:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="DbJournal flusher",
+                daemon=True)
+            self._flusher.start()
+
+    @classmethod
+    def create(cls, db_path, tl_db, **kwargs):
+        # Start a journal for tl_db, writing it out as the initial snapshot.
+        # Any existing journal for db_path is discarded.
+        tl_db.to_file(db_path)
+        for path in [db_path + cls.OLD_SUFFIX, db_path + cls.SUFFIX,
+                     db_path + cls.STAGED_SUFFIX]:
+            if os.path.exists(path):
+                os.remove(path)
+        return cls(db_path, **kwargs)
+
+    def journal_path(self):
+        return self._db_path + self.SUFFIX
+
+    def old_journal_path(self):
+        return self._db_path + self.OLD_SUFFIX
+
+    def staged_snapshot_path(self):
+        return self._db_path + self.STAGED_SUFFIX
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+        self.wait_for_compaction()
+        self.tl_db.remove_edit_listener(self._on_edit)
+        with self._lock:
+            self._sync_locked()
+            self._file.close()
+            self._closed = True
+
+    @classmethod
+    def pack_record(cls, edit, args):
+        payload = json.dumps(
+            [cls.EDIT_CODES[edit], *args],
+            ensure_ascii=False, separators=(',', ':')
+        ).encode('utf-8')
+        return struct.pack(
+            cls.RECORD_HEADER_FORMAT, len(payload), zlib.crc32(payload)
+        ) + payload
+
+    @classmethod
+    def replay(cls, tl_db, path):
+        # Apply the edits in a journal file to tl_db. Stops at the first
+        # torn or corrupt record (an interrupted append), and returns the
+        # size of the intact part of the journal. Records that can't be
+        # applied, e.g. for lines a re-extraction dropped, are skipped.
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+
+        pos = 0
+        while pos + cls.RECORD_HEADER_SIZE <= len(data):
+            size, crc = struct.unpack_from(cls.RECORD_HEADER_FORMAT, data, pos)
+            start = pos + cls.RECORD_HEADER_SIZE
+            payload = data[start:start + size]
+            if len(payload) != size or zlib.crc32(payload) != crc:
+                break
+
+            try:
+                code, *args = json.loads(payload)
+                getattr(tl_db, cls.EDITS_BY_CODE[code])(*args)
+            except (AssertionError, KeyError, IndexError, TypeError,
+                    ValueError) as e:
+                print(f"Skipping journal record at {pos} of {path}: "
+                      f"{e!r}")
+            pos = start + size
+
+        return pos
+
+    def _on_edit(self, edit, args):
+        if edit in self.SNAPSHOT_EDITS:
+            self._snapshot_now()
+            return
+
+        record = self.pack_record(edit, args)
+        with self._lock:
+            self._file.write(record)
+            self._unsynced += 1
+            if self._unsynced >= self._sync_batch:
+                self._sync_locked()
+
+            if self._file.tell() >= self._compact_threshold and \
+                    self._saver.is_idle():
+                self._saver.request_save()
+
+    def sync(self):
+        # Make all edits so far durable
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _flush_loop(self):
+        while not self._stop.wait(self._sync_interval):
+            self.sync()
+
+    # Compaction
+
+    def compact(self):
+        # Write a new snapshot now and wait for it
+        self._saver.save()
+
+    def request_compaction(self):
+        # Write a new snapshot in the background. Requests made while one
+        # is being written collapse into one more.
+        self._saver.request_save()
+
+    def wait_for_compaction(self):
+        self._saver.wait()
+
+    def compaction_status(self):
+        # See DbSaveService.status
+        return self._saver.status()
+
+    def _rotate_and_snapshot(self):
+        # Called on the save thread. Rotate the journal: anything in it
+        # goes into the snapshot taken below, anything after goes into the
+        # new journal. Edits hold the DB's edit lock while journaling, so
+        # take it first.
+        with self.tl_db.edit_lock:
+            self._save_lock.acquire()
+            try:
+                snapshot = self._rotate_locked()
+            except BaseException:
+                self._save_lock.release()
+                raise
+            # The snapshot is written while edits continue
+            self._saver_holds_save_lock = True
+            return snapshot
+
+    def _release_save_lock(self, error):
+        # Called on the save thread once the snapshot is written (or not)
+        if self._saver_holds_save_lock:
+            self._saver_holds_save_lock = False
+            self._save_lock.release()
+
+    def _snapshot_now(self):
+        # Called for edits that can't be journaled, with the DB's edit lock
+        # held, so nothing later is journaled until the snapshot is written.
+        # A compaction still writing an earlier snapshot is waited out
+        # first.
+        # The rotated journal holds edits from before the re-extraction,
+        # which the snapshot already has, and which may not replay over it.
+        # So it is removed before the snapshot replaces the DB file. In
+        # between, the snapshot is staged next to the DB file, and a load
+        # finishes the job (see _recover_staged_snapshot).
+        with self._save_lock:
+            snapshot = self._rotate_locked()
+            staged_path = self.staged_snapshot_path()
+            snapshot.to_file(
+                staged_path,
+                binary=self._db_path.endswith(BinaryDbFormat.EXTENSION))
+            self._remove_old_journal()
+            os.replace(staged_path, self._db_path)
+
+    def _recover_staged_snapshot(self):
+        # A staged snapshot is only complete once the old journal is gone.
+        # Before that, the DB file and its journals are still the latest
+        # complete state.
+        staged_path = self.staged_snapshot_path()
+        if not os.path.exists(staged_path):
+            return
+        if os.path.exists(self.old_journal_path()):
+            os.remove(staged_path)
+        else:
+            os.replace(staged_path, self._db_path)
+
+    def _rotate_locked(self):
+        # Call with the DB's edit lock held
+        with self._lock:
+            self._sync_locked()
+            self._file.close()
+            old_path = self.old_journal_path()
+            if os.path.exists(old_path):
+                # Left behind by an interrupted compaction. Keep it, and the
+                # edit order, by appending this journal to it.
+                with open(self.journal_path(), 'rb') as src, \
+                        open(old_path, 'ab') as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.journal_path())
+            else:
+                os.replace(self.journal_path(), old_path)
+            self._file = open(self.journal_path(), 'ab', buffering=0)
+            return self.tl_db.snapshot()
+
+    def _remove_old_journal(self):
+        os.remove(self.old_journal_path())
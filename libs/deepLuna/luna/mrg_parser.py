@@ -1,4 +1,5 @@
 import io
+import mmap
 import struct
 
 
@@ -28,73 +29,257 @@ class Mzp:
             upper_bound = self._size_sectors * self.SECTOR_SIZE
             return (upper_bound & ~(0xFFFF)) | self._size_bytes
 
-    def __init__(self, input_path):
-        with open(input_path, 'rb') as input_file:
-            raw_data = input_file.read()
+        @classmethod
+        def pack_for(cls, start_offset, size):
+            # Packed header for an entry of `size` bytes starting at
+            # `start_offset` relative to the start of the data area
+            size_sectors = size // cls.SECTOR_SIZE
+            if size % cls.SECTOR_SIZE:
+                size_sectors += 1
+            return struct.pack(
+                cls.HEADER_FORMAT,
+                start_offset // cls.SECTOR_SIZE,
+                start_offset % cls.SECTOR_SIZE,
+                size_sectors,
+                size & 0xFFFF
+            )
+
+    class LazyEntries:
+        """
+        Read-only sequence of entry data for a memory-mapped archive.
+        Entries are returned as memoryview slices of the mapping, created on
+        demand, so nothing is copied until the caller does so.
+        """
+
+        def __init__(self, mzp):
+            self._mzp = mzp
+
+        def __len__(self):
+            return len(self._mzp.headers)
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [
+                    self[i] for i in range(*index.indices(len(self)))
+                ]
+
+            start, size = self._mzp.entry_range(index)
+            return memoryview(self._mzp._mmap)[start:start + size]
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield self[i]
+
+    def __init__(self, input_path, use_mmap=False):
+        # In mmap mode only the header table is parsed up front; entry data
+        # is sliced out of the mapping on access. Otherwise the whole file
+        # is read and every entry copied into self.data.
+        self._mmap = None
+        if use_mmap:
+            with open(input_path, 'rb') as input_file:
+                self._mmap = mmap.mmap(
+                    input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            raw_data = self._mmap
+        else:
+            with open(input_path, 'rb') as input_file:
+                raw_data = input_file.read()
 
         # Data are LE
         # 6 byte magic, uint16_t entry count
-        (self._magic, self._entry_count) = struct.unpack("<6sH", raw_data[0:8])
+        (self._magic, self._entry_count) = struct.unpack_from(
+            "<6sH", raw_data, 0)
 
         assert self._magic == self.MAGIC, self._magic
 
         # Parse the headers
-        data_view = memoryview(raw_data)
         self.headers = []
         for i in range(self._entry_count):
-            self.headers.append(Mzp.EntryHeader(data_view[8 + 8 * i:]))
+            self.headers.append(
+                Mzp.EntryHeader(raw_data[8 + 8 * i:16 + 8 * i]))
+        self._data_start_offset = 8 + 8 * self._entry_count
 
         # Load the data
+        if use_mmap:
+            self.data = Mzp.LazyEntries(self)
+            return
+
         self.data = []
-        data_start_offset = 8 + 8 * self._entry_count
-        for header in self.headers:
-            entry_start = data_start_offset + header.relative_start_offset()
-            self.data.append(raw_data[
-                entry_start:entry_start+header.data_size()])
+        for i in range(self._entry_count):
+            entry_start, entry_size = self.entry_range(i)
+            self.data.append(raw_data[entry_start:entry_start+entry_size])
+
+    def __len__(self):
+        return self._entry_count
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # Unmap the archive in mmap mode. Any memoryviews handed out must
+        # have been released first.
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def entry_range(self, index):
+        # Absolute (file offset, size) of an entry's data
+        header = self.headers[index]
+        return (
+            self._data_start_offset + header.relative_start_offset(),
+            header.data_size()
+        )
+
+    # Section starts are aligned to this many bytes, and the archive is
+    # padded to a multiple of FILE_ALIGNMENT.
+    SECTION_ALIGNMENT = 16
+    FILE_ALIGNMENT = 8
+
+    # Block size used when moving archive data around on disk
+    COPY_CHUNK_SIZE = 1 << 20
+
+    @classmethod
+    def replace_entry(cls, path, index, data):
+        # Replace the data of entry `index` in an existing archive file.
+        # If the new data fit in the space allocated to the entry (up to the
+        # start of the next entry), only that data and its header are
+        # rewritten. Otherwise the entries after it are shifted back on
+        # disk and their headers updated; nothing before the entry is
+        # touched. Returns True if the entry was replaced in place.
+        with open(path, 'r+b') as archive:
+            (magic, entry_count) = struct.unpack("<6sH", archive.read(8))
+            assert magic == cls.MAGIC, magic
+            if not 0 <= index < entry_count:
+                raise IndexError(
+                    f"Entry {index} out of range for {entry_count} entries")
+
+            header_table = archive.read(8 * entry_count)
+            headers = [
+                cls.EntryHeader(header_table[8 * i:8 * i + 8])
+                for i in range(entry_count)
+            ]
+            data_start = 8 + 8 * entry_count
+            entry_start = headers[index].relative_start_offset()
+            old_size = headers[index].data_size()
+            new_end = entry_start + len(data)
+
+            # The last entry can always be rewritten in place; the file is
+            # just resized around it.
+            if index == entry_count - 1:
+                archive.seek(data_start + entry_start)
+                archive.write(data)
+                cls._pad_file_end(archive, data_start + new_end)
+                archive.seek(8 + 8 * index)
+                archive.write(cls.EntryHeader.pack_for(entry_start, len(data)))
+                return True
+
+            next_start = headers[index + 1].relative_start_offset()
+            if new_end <= next_start:
+                archive.seek(data_start + entry_start)
+                archive.write(data)
+                # Blank out whatever is left of the old data
+                if old_size > len(data):
+                    archive.write(b"\xff" * (old_size - len(data)))
+                archive.seek(8 + 8 * index)
+                archive.write(cls.EntryHeader.pack_for(entry_start, len(data)))
+                return True
+
+            # Shift every following entry back by the same aligned amount,
+            # so their relative layout is preserved.
+            shift = (
+                new_end + (-new_end % cls.SECTION_ALIGNMENT)
+            ) - next_start
+            tail_end = max(
+                header.relative_start_offset() + header.data_size()
+                for header in headers[index + 1:]
+            )
+            cls._move_block(
+                archive,
+                data_start + next_start,
+                data_start + tail_end,
+                shift
+            )
+
+            # Write the new entry data, then pad up to the moved tail
+            archive.seek(data_start + entry_start)
+            archive.write(data)
+            archive.write(b"\xff" * (next_start + shift - new_end))
+            cls._pad_file_end(archive, data_start + tail_end + shift)
+
+            # Rewrite the headers of this entry and everything after it
+            updated_headers = [cls.EntryHeader.pack_for(entry_start, len(data))]
+            for header in headers[index + 1:]:
+                updated_headers.append(cls.EntryHeader.pack_for(
+                    header.relative_start_offset() + shift,
+                    header.data_size()
+                ))
+            archive.seek(8 + 8 * index)
+            archive.write(b''.join(updated_headers))
+            return False
+
+    @classmethod
+    def _move_block(cls, archive, start, end, shift):
+        # Move the bytes in [start, end) forward by `shift` bytes, copying
+        # from the end backwards so the ranges may overlap.
+        position = end
+        while position > start:
+            chunk_size = min(cls.COPY_CHUNK_SIZE, position - start)
+            position -= chunk_size
+            archive.seek(position)
+            chunk = archive.read(chunk_size)
+            archive.seek(position + shift)
+            archive.write(chunk)
+
+    @classmethod
+    def _pad_file_end(cls, archive, data_end):
+        # Truncate the archive after its last entry and pad to boundary
+        archive.truncate(data_end)
+        archive.seek(data_end)
+        archive.write(b"\xff" * (-data_end % cls.FILE_ALIGNMENT))
 
     @classmethod
     def pack(cls, sections):
-        # Generate header
-        header = struct.pack("<6sH", cls.MAGIC, len(sections))
-        packed_header = io.BytesIO()
-        packed_header.write(header)
+        packed = io.BytesIO()
+        cls.pack_to(sections, packed)
+        return packed.getvalue()
 
-        # Process each section
-        packed_data = io.BytesIO()
-        for section in sections:
-            # Round the start of each section to a word boundary
-            while packed_data.tell() % 16 != 0:
-                packed_data.write(b"\xff")
-
-            # Calculate the header info
-            section_start_offset = packed_data.tell()
-            section_sector_offset = \
-                section_start_offset // cls.EntryHeader.SECTOR_SIZE
-            section_byte_offset = \
-                section_start_offset % cls.EntryHeader.SECTOR_SIZE
-            size_sectors = len(section) // cls.EntryHeader.SECTOR_SIZE
-            size_bytes = len(section) & 0xFFFF
-            if len(section) % cls.EntryHeader.SECTOR_SIZE:
-                size_sectors += 1
-            packed_header.write(struct.pack(
-                cls.EntryHeader.HEADER_FORMAT,
-                section_sector_offset,
-                section_byte_offset,
-                size_sectors,
-                size_bytes
-            ))
+    @classmethod
+    def pack_to(cls, sections, target):
+        # Stream an archive to any writable binary target (file, socket
+        # file, BytesIO). Only the section lengths are needed to build the
+        # header table, so section data are written straight through
+        # afterwards without being copied.
+        sections = list(sections)
+        header = bytearray(struct.pack("<6sH", cls.MAGIC, len(sections)))
 
-            # Append the section data to the data buffer
-            packed_data.write(section)
+        # Lay out each section, rounding its start to the section alignment
+        data_offset = 0
+        paddings = []
+        for section in sections:
+            padding = -data_offset % cls.SECTION_ALIGNMENT
+            data_offset += padding
+            header += cls.EntryHeader.pack_for(data_offset, len(section))
+            paddings.append(padding)
+            data_offset += len(section)
 
-        # Consolidate data onto header buffer
-        packed_data.seek(0, io.SEEK_SET)
-        packed_header.write(packed_data.read())
+        target.write(header)
+        for padding, section in zip(paddings, sections):
+            if padding:
+                target.write(b"\xff" * padding)
+            target.write(section)
 
         # Pad total file size to boundary
-        while packed_header.tell() % 8 != 0:
-            packed_header.write(b"\xff")
+        total_size = len(header) + data_offset
+        file_padding = -total_size % cls.FILE_ALIGNMENT
+        if file_padding:
+            target.write(b"\xff" * file_padding)
 
-        # Return accumulated data
-        packed_header.seek(0, io.SEEK_SET)
-        return packed_header.read()
+        return total_size + file_padding
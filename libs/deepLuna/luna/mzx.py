@@ -1,5 +1,6 @@
 import os
 import struct
+from array import array
 from io import BytesIO
 
 
@@ -9,12 +10,280 @@ class Mzx:
     CMD_RINGBUF = 2
     CMD_LITERAL = 3
 
+    # Largest number of bytes a single command can emit. Used as slack on the
+    # preallocated output buffer, since the final command may overshoot.
+    MAX_CMD_OUTPUT = 2 * 64
+
+    # Byte translation table for inverted literals
+    _INVERT_TABLE = bytes(0xFF ^ i for i in range(256))
+
+    # Format limits: runs are 1-64 shorts, backrefs reach 1-256 shorts back
+    MAX_RUN = 64
+    MAX_LOOKBACK = 256
+    RING_BUFFER_SIZE = 64
+
+    # Compression levels map to (hash chain search depth, lazy matching).
+    # Level 0 disables backreferences entirely; higher levels search more
+    # candidate matches and defer matches when the next position is better.
+    COMPRESSION_LEVELS = {
+        0: (0, False),
+        1: (1, False),
+        2: (2, False),
+        3: (4, False),
+        4: (8, False),
+        5: (16, False),
+        6: (32, True),
+        7: (64, True),
+        8: (128, True),
+        9: (256, True),
+    }
+    DEFAULT_COMPRESSION_LEVEL = 6
+
+    @classmethod
+    def compress(cls, data, invert=True, level=DEFAULT_COMPRESSION_LEVEL):
+        if level not in cls.COMPRESSION_LEVELS:
+            raise ValueError(f"Invalid MZX compression level {level}")
+        max_chain, lazy = cls.COMPRESSION_LEVELS[level]
+
+        # The format works in shorts, so pad odd-length input. The header
+        # size lets the decoder drop the padding again.
+        decompressed_size = len(data)
+        padded = bytes(data) + (b'\x00' if decompressed_size % 2 else b'')
+        shorts = array('H', padded)
+        short_count = len(shorts)
+        invert_table = cls._INVERT_TABLE if invert else None
+
+        out = bytearray(struct.pack("<4sI", b"MZX0", decompressed_size))
+
+        # Mirror the decoder state. The reference decoder's initial
+        # last-short is not usable without inversion, so RLE can only be
+        # used after something has been written in that mode.
+        initial_short = 0xFFFF if invert else 0x0000
+        last_short = initial_short if invert else None
+        ring_buffer = [initial_short] * cls.RING_BUFFER_SIZE
+        ring_buffer_write_offset = 0
+        ring_index = {initial_short: 0}
+
+        # Hash chains over pairs of shorts. A pair key is exact, so any
+        # chain entry is a match of at least two shorts.
+        chain_head = {}
+        chain_prev = [-1] * short_count
+
+        def insert_positions(start, end):
+            for pos in range(start, min(end, short_count - 1)):
+                key = (shorts[pos] << 16) | shorts[pos + 1]
+                chain_prev[pos] = chain_head.get(key, -1)
+                chain_head[key] = pos
+
+        def find_match(pos):
+            if not max_chain or pos + 1 >= short_count:
+                return 0, 0
+            best_len = 0
+            best_dist = 0
+            max_len = min(cls.MAX_RUN, short_count - pos)
+            candidate = chain_head.get(
+                (shorts[pos] << 16) | shorts[pos + 1], -1)
+            depth = max_chain
+            while candidate >= 0 and depth:
+                dist = pos - candidate
+                if dist > cls.MAX_LOOKBACK:
+                    break
+                # Quick reject: a longer match must extend past best_len
+                if best_len < max_len and \
+                        shorts[candidate + best_len] == shorts[pos + best_len]:
+                    match_len = 2
+                    while match_len < max_len and \
+                            shorts[candidate + match_len] == \
+                            shorts[pos + match_len]:
+                        match_len += 1
+                    if match_len > best_len:
+                        best_len = match_len
+                        best_dist = dist
+                        if match_len == max_len:
+                            break
+                candidate = chain_prev[candidate]
+                depth -= 1
+            return best_len, best_dist
+
+        literal_start = 0
+        literal_count = 0
+
+        def flush_literals():
+            if literal_count:
+                out.append(cls.CMD_LITERAL | ((literal_count - 1) << 2))
+                literal_bytes = padded[
+                    2 * literal_start:2 * (literal_start + literal_count)]
+                if invert_table:
+                    literal_bytes = literal_bytes.translate(invert_table)
+                out.extend(literal_bytes)
+
+        pos = 0
+        while pos < short_count:
+            value = shorts[pos]
+
+            # Repeats of the last short are the cheapest encoding
+            run = 0
+            if value == last_short:
+                run_limit = min(cls.MAX_RUN, short_count - pos)
+                while run < run_limit and shorts[pos + run] == value:
+                    run += 1
+
+            match_len, match_dist = find_match(pos)
+
+            # Lazy matching: if starting a match one short later would be
+            # noticeably longer, emit this short on its own instead.
+            if lazy and match_len >= 2 and run < match_len and \
+                    match_len < cls.MAX_RUN:
+                insert_positions(pos, pos + 1)
+                next_len, _ = find_match(pos + 1)
+                if next_len > match_len + 1:
+                    match_len = 0
+                advance_hashed = pos + 1
+            else:
+                advance_hashed = pos
+
+            if run and run >= match_len:
+                flush_literals()
+                literal_count = 0
+                out.append(cls.CMD_RLE | ((run - 1) << 2))
+                advance = run
+            elif match_len >= 2:
+                flush_literals()
+                literal_count = 0
+                out.append(cls.CMD_BACKREF | ((match_len - 1) << 2))
+                out.append(match_dist - 1)
+                advance = match_len
+                last_short = shorts[pos + match_len - 1]
+            elif ring_index.get(value) is not None and \
+                    ring_buffer[ring_index[value]] == value:
+                flush_literals()
+                literal_count = 0
+                out.append(cls.CMD_RINGBUF | (ring_index[value] << 2))
+                advance = 1
+                last_short = value
+            else:
+                # Extend (or start) the pending literal run. The decoder
+                # sees the literal before any later command, so the ring
+                # buffer can be updated immediately.
+                if literal_count == cls.MAX_RUN:
+                    flush_literals()
+                    literal_count = 0
+                if not literal_count:
+                    literal_start = pos
+                literal_count += 1
+                ring_buffer[ring_buffer_write_offset] = value
+                ring_index[value] = ring_buffer_write_offset
+                ring_buffer_write_offset = \
+                    (ring_buffer_write_offset + 1) % cls.RING_BUFFER_SIZE
+                advance = 1
+                last_short = value
+
+            insert_positions(advance_hashed, pos + advance)
+            pos += advance
+
+        flush_literals()
+        return bytes(out)
+
     @classmethod
     def decompress(cls, data, invert=True):
         # Check header
         (magic, decompressed_size) = struct.unpack("<4sI", data[0:8])
         assert magic == b"MZX0", magic
 
+        # Output buffer, allocated up front. Every command writes whole
+        # shorts at the write cursor, so no seeking is ever needed.
+        ret = bytearray(decompressed_size + cls.MAX_CMD_OUTPUT)
+        write_offset = 0
+
+        # Last written short
+        last_short = b'\xff\xff' if invert else b'\x00\x00'
+
+        # Prev data ringbuffer
+        ring_buffer_write_offset = 0
+        ring_buffer = [b'\xff\xff' if invert else b'\x00\x00'] * 64
+
+        # Input file read index. Start after the fixed-size header.
+        read_offset = 8
+        invert_table = cls._INVERT_TABLE if invert else None
+
+        # While we have not decompressed all data
+        while write_offset < decompressed_size:
+            # Read the cmd/len from the next input byte
+            len_cmd = data[read_offset]
+            read_offset += 1
+
+            # Extract the actual command and length
+            cmd = len_cmd & 0b11
+            length = len_cmd >> 2
+
+            if cmd == cls.CMD_RLE:
+                # Repeat last 2 bytes len+1 times
+                copy_size = 2 * (length + 1)
+                ret[write_offset:write_offset + copy_size] = \
+                    last_short * (length + 1)
+                write_offset += copy_size
+
+            elif cmd == cls.CMD_BACKREF:
+                # How far back are we referencing
+                lookback_dist = 2 * (data[read_offset] + 1)
+                read_offset += 1
+                copy_start = write_offset - lookback_dist
+                if copy_start < 0:
+                    raise ValueError(
+                        f"Backreference before start of output at "
+                        f"input offset {read_offset - 2}"
+                    )
+
+                # Copy len shorts from backreference. If the source overlaps
+                # the destination, the referenced window repeats.
+                copy_size = 2 * (length + 1)
+                if copy_size <= lookback_dist:
+                    ret[write_offset:write_offset + copy_size] = \
+                        ret[copy_start:copy_start + copy_size]
+                else:
+                    window = ret[copy_start:write_offset]
+                    repeats = copy_size // lookback_dist + 1
+                    ret[write_offset:write_offset + copy_size] = \
+                        (window * repeats)[:copy_size]
+                write_offset += copy_size
+                last_short = bytes(ret[write_offset - 2:write_offset])
+
+            elif cmd == cls.CMD_RINGBUF:
+                last_short = ring_buffer[length]
+                ret[write_offset:write_offset + 2] = last_short
+                write_offset += 2
+
+            else:
+                # Read the run of short literals from input in one slice
+                copy_size = 2 * (length + 1)
+                literals = bytes(data[read_offset:read_offset + copy_size])
+                read_offset += copy_size
+                if invert_table:
+                    literals = literals.translate(invert_table)
+
+                # Update ring buffer with each short of the run
+                for i in range(0, copy_size, 2):
+                    ring_buffer[ring_buffer_write_offset] = literals[i:i + 2]
+                    ring_buffer_write_offset = \
+                        (ring_buffer_write_offset + 1) % 64
+                last_short = literals[-2:]
+
+                # Write data to output
+                ret[write_offset:write_offset + copy_size] = literals
+                write_offset += copy_size
+
+        del ret[decompressed_size:]
+        return bytes(ret)
+
+    @classmethod
+    def decompress_reference(cls, data, invert=True):
+        # Original BytesIO-based decoder. Slower than decompress(), but kept
+        # as the reference implementation that the fast path is checked
+        # against.
+        # Check header
+        (magic, decompressed_size) = struct.unpack("<4sI", data[0:8])
+        assert magic == b"MZX0", magic
+
         # Output buffer
         ret = BytesIO()
 
@@ -0,0 +1,174 @@
+import mmap
+import multiprocessing
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+from libs.deepLuna.luna.mrg_parser import Mzp
+from libs.deepLuna.luna.mzx import Mzx
+
+
+def _decompress_chunk(job):
+    # Worker side: map the archive, decompress each entry in the chunk
+    # and write the result straight into the shared output block.
+    archive_path, shm_name, invert, entries = job
+    output = shared_memory.SharedMemory(name=shm_name)
+    try:
+        with open(archive_path, 'rb') as archive:
+            mapped = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            for in_offset, in_size, out_offset, out_size in entries:
+                # Release each slice even if decompression fails, or the
+                # cleanup below raises BufferError over the real error
+                with view[in_offset:in_offset + in_size] as compressed:
+                    output.buf[out_offset:out_offset + out_size] = \
+                        Mzx.decompress(compressed, invert)
+        finally:
+            view.release()
+            mapped.close()
+    finally:
+        output.close()
+
+
+def _map_chunk(job):
+    # Worker side: map the archive, then decompress each entry in the chunk
+    # and hand it to func. Only func's (ideally compact) results are sent
+    # back to the parent.
+    archive_path, func, invert, spans = job
+    with open(archive_path, 'rb') as archive:
+        mapped = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        results = []
+        for offset, size in spans:
+            with view[offset:offset + size] as compressed:
+                data = Mzx.decompress(compressed, invert)
+            results.append(func(data))
+        return results
+    finally:
+        view.release()
+        mapped.close()
+
+
+class MzxPool:
+    """
+    Process pool for decompressing many MZX entries out of an archive file.
+    Workers map the archive themselves and read each compressed entry by
+    offset and length, then write the decompressed data into one shared
+    memory block at an offset assigned by the parent. Only small tuples of
+    offsets are pickled in either direction, instead of the entry data.
+
+    The worker processes live as long as the MzxPool, so a long-lived
+    instance can be reused across extractions. It can also be used as a
+    context manager for one-off use.
+    `context` is a multiprocessing start method. Pools started from a
+    multithreaded process should use 'spawn' or 'forkserver': a forked
+    worker inherits whatever locks other threads held at the time.
+    """
+
+    # Entries are small, so batch several into each task to amortise the
+    # IPC and shared memory attach costs, while still producing enough
+    # tasks per worker to balance the load.
+    TASKS_PER_WORKER = 4
+
+    def __init__(self, processes=None, context=None):
+        # Start the resource tracker before starting the workers, so they
+        # share it with the parent. Otherwise each worker starts its own
+        # tracker and reports the shared blocks it attached to as leaked.
+        resource_tracker.ensure_running()
+        self._processes = processes or multiprocessing.cpu_count()
+        self._pool = multiprocessing.get_context(context).Pool(
+            self._processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def chunk_entries(self, entries, weights):
+        # Split entries into contiguous chunks of roughly equal total
+        # weight (compressed size), TASKS_PER_WORKER chunks per worker.
+        chunk_count = max(1, min(
+            len(entries), self._processes * self.TASKS_PER_WORKER))
+        target_weight = sum(weights) / chunk_count
+        chunks = []
+        chunk = []
+        chunk_weight = 0
+        for entry, weight in zip(entries, weights):
+            chunk.append(entry)
+            chunk_weight += weight
+            if chunk_weight >= target_weight:
+                chunks.append(chunk)
+                chunk = []
+                chunk_weight = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def decompress_entries(self, archive_path, spans, invert=True):
+        # Decompress the MZX entries at the given (file offset, size) spans
+        # of an archive. Returns the decompressed data for each span.
+        with open(archive_path, 'rb') as archive:
+            with mmap.mmap(archive.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapped:
+                output_sizes = [
+                    struct.unpack_from("<4sI", mapped, offset)[1]
+                    for offset, _ in spans
+                ]
+
+        # Lay the outputs out back to back in one shared block
+        entries = []
+        output_offset = 0
+        for (offset, size), output_size in zip(spans, output_sizes):
+            entries.append((offset, size, output_offset, output_size))
+            output_offset += output_size
+
+        output = shared_memory.SharedMemory(
+            create=True, size=max(output_offset, 1))
+        try:
+            jobs = [
+                (archive_path, output.name, invert, chunk)
+                for chunk in self.chunk_entries(
+                    entries, [size for _, size in spans])
+            ]
+            self._pool.map(_decompress_chunk, jobs, chunksize=1)
+            return [
+                bytes(output.buf[out_offset:out_offset + out_size])
+                for _, _, out_offset, out_size in entries
+            ]
+        finally:
+            output.close()
+            output.unlink()
+
+    def map_entries(self, func, archive_path, spans, invert=True):
+        # Decompress the MZX entries at the given (file offset, size) spans
+        # and apply func to each in the workers. Returns func's results in
+        # span order. func must be picklable, e.g. a module-level function
+        # or a method of a module-level class.
+        jobs = [
+            (archive_path, func, invert, chunk)
+            for chunk in self.chunk_entries(
+                spans, [size for _, size in spans])
+        ]
+        results = []
+        for chunk_results in self._pool.map(_map_chunk, jobs, chunksize=1):
+            results.extend(chunk_results)
+        return results
+
+    def map_chunks(self, func, chunks):
+        # Run other CPU bound work on the same workers: func(chunk) for
+        # each chunk, e.g. from chunk_entries. Returns the results in chunk
+        # order. func must be picklable, as for map_entries.
+        return self._pool.map(func, chunks, chunksize=1)
+
+    def decompress_mzp(self, mzp_path, first=0, last=None, invert=True):
+        # Decompress entries [first, last) of an MZP archive
+        with Mzp(mzp_path, use_mmap=True) as mzp:
+            last = len(mzp) if last is None else last
+            spans = [mzp.entry_range(i) for i in range(first, last)]
+        return self.decompress_entries(mzp_path, spans, invert)
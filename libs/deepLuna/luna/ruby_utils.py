@@ -1,29 +1,84 @@
+import functools
+import re
+import time
+
 from libs.deepLuna.luna.constants import Constants
 
 class RubyUtils:
 
     ENABLE_PUA_CODES = False
 
-    @staticmethod
-    def unicode_aware_len(string):
-        # Any non-ASCII character takes up 2 spaces instead of one.
-        length = 0
-        for c in string:
-            # PUA codes are treated as single-width
-            if ord(c) >= 0xE000:
-                length += 1
-            # All non-EASCII is double-wide
-            elif ord(c) > 256:
-                length += 2
-            else:
-                length += 1
+    # Strings held by each of the noruby_len and remove_ruby_text caches
+    CACHE_SIZE = 1 << 14
+
+    class Widths:
+        # Display width of each code point range, as (first, last, width).
+        # PUA codes are treated as single-width, and all non-EASCII other
+        # than those is double-wide.
+        CLASSES = (
+            (0x0000, 0x0100, 1),
+            (0x0101, 0xDFFF, 2),
+            (0xE000, 0x10FFFF, 1),
+        )
+
+        # Matches each double-wide character. Widths are only ever 1 or 2,
+        # so the width of a string is its length plus the number of these.
+        WIDE = re.compile("[%s]" % ''.join(
+            f"\\U{first:08x}-\\U{last:08x}"
+            for first, last, width in CLASSES if width == 2
+        ))
+
+    class StringCache:
+        """
+        A bounded LRU of a function's results, keyed by the string it was
+        called on. Counts hits and misses and the time spent computing
+        misses, to tune the size by.
+        """
+
+        def __init__(self, func, max_size):
+            self._func = func
+            self.resize(max_size)
+
+        def _compute(self, string):
+            start = time.perf_counter()
+            try:
+                return self._func(string)
+            finally:
+                self._compute_seconds += time.perf_counter() - start
+
+        def resize(self, max_size):
+            # Starts over with an empty cache
+            self._compute_seconds = 0.0
+            self.get = functools.lru_cache(max_size)(self._compute)
+
+        def clear(self):
+            self.get.cache_clear()
+            self._compute_seconds = 0.0
+
+        def stats(self):
+            info = self.get.cache_info()
+            lookups = info.hits + info.misses
+            return {
+                'hits': info.hits,
+                'misses': info.misses,
+                'hit_rate': info.hits / lookups if lookups else None,
+                'size': info.currsize,
+                'max_size': info.maxsize,
+                'compute_seconds': self._compute_seconds,
+            }
 
-        return length
+    @classmethod
+    def unicode_aware_len(cls, string):
+        # Any non-ASCII character takes up 2 spaces instead of one, except
+        # for PUA codes; see Widths.
+        if string.isascii():
+            return len(string)
+        return len(string) + len(cls.Widths.WIDE.findall(string))
 
     @classmethod
     def noruby_len(cls, line):
         # Get the length of a line as if it did not contain any ruby text
-        return cls.unicode_aware_len(cls.remove_ruby_text(line))
+        return cls._noruby_len_cache.get(line)
 
     @staticmethod
     def contains_ruby(line):
@@ -69,11 +124,20 @@ class RubyUtils:
 
         return ret
 
-    @staticmethod
-    def remove_ruby_text(line):
+    @classmethod
+    def remove_ruby_text(cls, line):
         # Ruby text consists of <bottom|top> text.
         # This function strips formatting characters and top text to get only
         # the baseline-level characters in a sentence.
+        return cls._remove_ruby_cache.get(line)
+
+    @classmethod
+    def strip_ruby_text(cls, line):
+        # Uncached remove_ruby_text. Lines without ruby are returned as-is,
+        # unless they have a stray midline, which the parser reports.
+        if not cls.contains_ruby(line) and '|' not in line:
+            return line
+
         ret = ""
         processing_ruby = False
         seen_midline = False
@@ -116,6 +180,77 @@ class RubyUtils:
 
         return ret
 
+    _noruby_len_cache = StringCache(
+        lambda line: RubyUtils.unicode_aware_len(
+            RubyUtils.strip_ruby_text(line)),
+        CACHE_SIZE)
+    _remove_ruby_cache = StringCache(
+        lambda line: RubyUtils.strip_ruby_text(line), CACHE_SIZE)
+
+    @classmethod
+    def cache_stats(cls):
+        # Hit rates and timings of the width and ruby-strip caches, as
+        # {'noruby_len': stats, 'remove_ruby_text': stats}; see StringCache
+        return {
+            'noruby_len': cls._noruby_len_cache.stats(),
+            'remove_ruby_text': cls._remove_ruby_cache.stats(),
+        }
+
+    @classmethod
+    def set_cache_size(cls, max_size):
+        # Resize (and empty) both caches. None means unbounded.
+        cls._noruby_len_cache.resize(max_size)
+        cls._remove_ruby_cache.resize(max_size)
+
+    @classmethod
+    def clear_caches(cls):
+        cls._noruby_len_cache.clear()
+        cls._remove_ruby_cache.clear()
+
+    class ControlCodes:
+        # Precompiled tables for apply_control_codes.
+        #
+        # The pattern matches the % escapes which split text into literal
+        # runs. An escape is any run of %s followed by either:
+        # - {code}: a control code. A code cut short by another % or by the
+        #   end of the text is dropped.
+        # - any other character, which is kept literally along with a
+        #   single % and is never offset into a glyph region
+        # - the end of the text, in which case it is dropped
+        PATTERN = re.compile(r"%+(?:\{([^%}]*)(\})?|(.)|\Z)", re.DOTALL)
+
+        PUA_OFFSET = 0xE000
+
+        # Codes that just emit some text
+        TEXT = {
+            'n': "\n",  # Forced newline
+            's': " ",  # Forced space
+            'no_break': "",  # Handled in translation_db, not here
+            'nothing': "",  # Used as a token to allow empty lines
+            'force_glue': "",  # Handled in tl_db, non-printing
+            'e_35': "\ue200",  # Custom ^-35 exponent character
+        }
+
+        # Codes that offset ascii glyphs into a PUA font region, as
+        # code: (region start, name used in the nesting error)
+        GLYPH_REGIONS = {
+            'i': (PUA_OFFSET + 128 * 0, 'i'),  # Italics
+            'r': (PUA_OFFSET + 128 * 1, 'r'),  # Reverso
+            'ri': (PUA_OFFSET + 128 * 2, 'ri'),  # Reversed italics
+            'g': (PUA_OFFSET + 128 * 3, 'g'),  # Antiqua
+            'flip_vertical': (PUA_OFFSET + 128 * 5, 'g'),  # Vertical flip
+        }
+
+        # Per region, a str.translate table mapping non-whitespace ASCII
+        # into that region
+        GLYPH_TABLES = {
+            code: {
+                c: region_start + c
+                for c in range(128) if chr(c) not in ' \n'
+            }
+            for code, (region_start, _) in GLYPH_REGIONS.items()
+        }
+
     @classmethod
     def apply_control_codes(cls, text, enable_asserts=False):
         # Convert any custom control codes into the appropriate
@@ -128,6 +263,108 @@ class RubyUtils:
         # %{r}/%{/r}: Begin/end reverse
         # %{ri}/%{/ri}: Begin/end reverse italics
         # %{g}/%{/g}: Begin/end Antiqua font
+
+        # No escapes, nothing to do
+        if '%' not in text:
+            return text
+
+        codes = cls.ControlCodes
+        enable_pua = cls.ENABLE_PUA_CODES
+
+        # Splitting gives the leading literal run, then for each escape its
+        # code, code end, escaped character and the literal run after it
+        parts = iter(codes.PATTERN.split(text))
+        out = [next(parts)]
+        glyph_table = None  # Translate table for the open glyph region
+        should_center = False
+        should_align_right = False
+        for cc, cc_end, escaped, literal in zip(parts, parts, parts, parts):
+            if escaped is not None:
+                # A % that didn't open a control code was literal
+                out.append("%" + escaped)
+            elif not cc_end:
+                # Unterminated control codes and trailing %s are dropped
+                pass
+            elif cc in codes.TEXT:
+                out.append(codes.TEXT[cc])
+            elif cc in codes.GLYPH_REGIONS:
+                assert not enable_asserts or glyph_table is None, \
+                    f"Illegal nested {codes.GLYPH_REGIONS[cc][1]} " \
+                    f"in line {text}"
+                if enable_pua:
+                    glyph_table = codes.GLYPH_TABLES[cc]
+            elif cc == 'center':
+                # Try and center this afterwards
+                should_center = True
+            elif cc == 'align_right':
+                # Try and right-align this afterwards
+                should_align_right = True
+            elif cc[0] == '/':
+                is_in_tag = not enable_pua or glyph_table is not None
+                assert not enable_asserts or is_in_tag, \
+                    f"Unmatched closing tag {cc} in line {text}"
+                glyph_table = None
+            else:
+                assert False, \
+                    f"Unhandled control code '{cc}' in line '{text}'"
+
+            # Literal text, mapped into the current font region if any
+            if literal:
+                out.append(
+                    literal.translate(glyph_table) if glyph_table
+                    else literal)
+
+        assert not enable_asserts or glyph_table is None, \
+            f"Unclosed tag on line {text}"
+
+        processed_line = ''.join(out)
+
+        # If this line is supposed to be centered, try and do it now.
+        if should_center:
+            # If the line doesn't fit, complain
+            assert '\n' not in processed_line
+            assert cls.noruby_len(processed_line) <= Constants.CHARS_PER_LINE
+
+            # How many chars are we short by?
+            padding_chars = int((
+                Constants.CHARS_PER_LINE - cls.noruby_len(processed_line)
+            ) / 2)
+
+            # Pad the front with spaces to center-align
+            processed_line = (' ' * padding_chars) + processed_line
+
+        # If this line should be right-justified, try and do it now
+        if should_align_right:
+            # If the line doesn't fit, complain
+            assert '\n' not in processed_line
+            assert cls.noruby_len(processed_line) <= Constants.CHARS_PER_LINE
+
+            # How many chars to add?
+            padding_chars = int(
+                Constants.CHARS_PER_LINE - cls.noruby_len(processed_line)
+            )
+
+            # Pad the front with spaces
+            processed_line = (' ' * padding_chars) + processed_line
+
+        return processed_line
+
+    @classmethod
+    def apply_control_codes_reference(cls, text, enable_asserts=False):
+        # Original character-at-a-time translator. Slower than
+        # apply_control_codes(), but kept as the reference implementation
+        # that the fast path is checked against.
+        #
+        # Convert any custom control codes into the appropriate
+        # characters/control modes.
+        #
+        # %{n}: Force newline
+        # %{s}: Force space
+        # %{center}: Attempt to center text in-line
+        # %{i}/%{/i}: Begin/end italics
+        # %{r}/%{/r}: Begin/end reverse
+        # %{ri}/%{/ri}: Begin/end reverse italics
+        # %{g}/%{/g}: Begin/end Antiqua font
         PUA_OFFSET = 0xE000
 
         processed_line = ""
@@ -282,6 +519,115 @@ class RubyUtils:
         if cls.noruby_len(line) + start_cursor_pos <= max_linelen:
             return(line)
 
+        # Split the line into a list of words, where ruby groups count
+        # as a single word. Measure each word once up front: ruby groups
+        # never span words, so the width of a run of words is the sum of
+        # their widths plus one per joining space, and the width of the
+        # current line can be kept as we go instead of re-measuring it.
+        splitLine = cls.ruby_aware_split_words(line)
+        word_widths = [cls.noruby_len(word) for word in splitLine]
+
+        # Actually break up the line
+        broken_lines = []
+        acc = ""
+        acc_width = 0
+        first_word = True
+        for word, word_width in zip(splitLine, word_widths):
+            # Is the next word so long that it's literally impossible to break?
+            if word_width > max_linelen:
+                # Is it unbreakable but _also_ a ruby'd line?
+                if cls.contains_ruby(word):
+                    assert False, \
+                        f"Cannot linebreak ruby '{word}' in line '{line}'"
+
+                # If it is, then just jam newlines into the word so that the
+                # game doesn't pitch a fit
+                while word:
+                    # How many more chars can we get on this line
+                    chars_remaining = (
+                        max_linelen - (acc_width + 1)
+                        if acc
+                        else max_linelen
+                    )
+
+                    # Stick those on the accumulator
+                    chunk = word[:chars_remaining]
+                    if acc:
+                        acc += ' ' + chunk
+                        acc_width += 1 + cls.unicode_aware_len(chunk)
+                    else:
+                        acc = chunk
+                        acc_width = cls.unicode_aware_len(chunk)
+
+                    # If this filled the line, break it
+                    if acc_width >= max_linelen:
+                        broken_lines.append(acc)
+                        acc = ""
+                        acc_width = 0
+                        start_cursor_pos = 0
+                        first_word = False
+
+                    # Strip them from the start of the word and loop
+                    word = word[chars_remaining:]
+
+                # We're done handling this word, loop.
+                continue
+
+            # If adding the next word would overflow, break the line.
+            # (The joining space is counted even for the first word.)
+            len_if_added = acc_width + 1 + word_width + start_cursor_pos
+            if len_if_added > max_linelen:
+                broken_lines.append(acc)
+                # If we line break _right_ at 55 chars, and the next char is
+                # a _forced_ linebreak, we'd end up double-breaking.
+                if word == "\n":
+                    acc = ""
+                    acc_width = 0
+                    first_word = True
+                else:
+                    acc = word
+                    acc_width = word_width
+                    first_word = False
+                start_cursor_pos = 0
+                continue
+
+            # If we run into a raw \n, that directly breaks the line
+            if word == '\n':
+                broken_lines.append(acc)
+                acc = ""
+                acc_width = 0
+                start_cursor_pos = 0
+                first_word = True
+                continue
+
+            # If we did't just break, then append this word to the line
+            if first_word:
+                acc = word
+                acc_width = word_width
+            else:
+                acc += ' ' + word
+                acc_width += 1 + word_width
+            first_word = False
+
+        # If there is a trailing accumulator, append it now.
+        # If the final character in the string was a newline, the accumulator
+        # will be empty but still meaningful, so keep it.
+        if acc or splitLine[-1] == '\n':
+            broken_lines.append(acc)
+
+        # Join our line fragments back together with \n
+        ret = '\n'.join(broken_lines)
+        return ret
+
+    @classmethod
+    def linebreak_text_reference(cls, line, max_linelen, start_cursor_pos=0):
+        # Original breaker, which re-measures the whole line for every
+        # word. Slower than linebreak_text(), but kept as the reference
+        # implementation that the fast path is checked against.
+        # If the line is already shorter than the desired length, just return
+        if cls.noruby_len(line) + start_cursor_pos <= max_linelen:
+            return(line)
+
         # Split the line into a list of words, where ruby groups count
         # as a single word
         splitLine = cls.ruby_aware_split_words(line)
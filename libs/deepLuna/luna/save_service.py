@@ -0,0 +1,114 @@
+import threading
+import time
+
+
+class DbSaveService:
+    """
+    Saves a TranslationDb to its file on a background thread.
+    Each save writes a snapshot of the DB, taken as the save starts, with
+    TranslationDb.to_file, which writes a temporary file and atomically
+    renames it over the DB file, so a crash mid-save leaves the previous
+    save intact. Save requests made while a save is running collapse into
+    a single follow-up save, which picks up everything edited meanwhile.
+    """
+
+    def __init__(self, path, snapshot, on_saved=None, on_finished=None):
+        # snapshot is called on the save thread for the TranslationDb to
+        # write. on_saved is called there after each successful save, and
+        # on_finished(error) after every save, failed or not.
+        self._path = path
+        self._snapshot = snapshot
+        self._on_saved = on_saved
+        self._on_finished = on_finished
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pending = False
+        # Saves are numbered as they start. Requests are answered with the
+        # number of the save that will cover them.
+        self._started = 0
+        self._finished = 0
+
+        self._save_count = 0
+        self._last_finished = None
+        self._last_duration = None
+        self._last_error = None
+
+    def request_save(self):
+        # Returns immediately, with a ticket to wait() on
+        with self._cond:
+            if self._thread is not None:
+                # Fold into the follow-up of the running save
+                self._pending = True
+                return self._started + 1
+
+            self._started += 1
+            self._thread = threading.Thread(
+                target=self._save_loop, name="DbSaveService", daemon=True)
+            self._thread.start()
+            return self._started
+
+    def save(self):
+        # Save now and wait for it. Raises if the save failed.
+        self.wait(self.request_save())
+        with self._cond:
+            if self._last_error is not None:
+                raise self._last_error
+
+    def wait(self, ticket=None, timeout=None):
+        # Wait for the save covering a request_save() ticket, or for all
+        # saves when there is no ticket. Returns False on timeout.
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._thread is None or (
+                    ticket is not None and self._finished >= ticket),
+                timeout)
+
+    def is_idle(self):
+        with self._cond:
+            return self._thread is None
+
+    def status(self):
+        # Times are seconds since the epoch, durations in seconds
+        with self._cond:
+            return {
+                'saving': self._thread is not None,
+                'pending': self._pending,
+                'save_count': self._save_count,
+                'last_finished': self._last_finished,
+                'last_duration': self._last_duration,
+                'last_error':
+                    str(self._last_error) if self._last_error else None,
+            }
+
+    def _save_loop(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                self._snapshot().to_file(self._path)
+                if self._on_saved:
+                    self._on_saved()
+                error = None
+            except Exception as e:
+                error = e
+            if self._on_finished:
+                self._on_finished(error)
+            duration = time.perf_counter() - start
+
+            with self._cond:
+                self._finished = self._started
+                self._last_error = error
+                if error is None:
+                    self._save_count += 1
+                    self._last_finished = time.time()
+                    self._last_duration = duration
+
+                if self._pending:
+                    self._pending = False
+                    self._started += 1
+                else:
+                    self._thread = None
+
+                self._cond.notify_all()
+                if self._thread is None:
+                    return
@@ -0,0 +1,526 @@
+import contextlib
+import json
+import pathlib
+import sqlite3
+import threading
+import types
+from collections.abc import Mapping
+
+from libs.deepLuna.luna.translation_db import TranslationDb
+
+
+class SqliteTranslationDb(TranslationDb):
+    """
+    TranslationDb stored in an SQLite database instead of being held in
+    memory and rewritten to disk in full on every save.
+    Scenes, lines and overrides are indexed tables which are queried on
+    demand, and every edit is written (and committed) as a single row, so
+    saving one translation does not rewrite the whole DB.
+    All the regular TranslationDb methods work on top of it. Note that
+    TLLine/TextCommand objects handed out are copies of the stored rows:
+    edits must go through the setter methods to be saved.
+    """
+
+    MAGIC = b"SQLite format 3\0"
+    EXTENSION = ".sqlite"
+    SCHEMA_VERSION = 1
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS scenes (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS lines (
+            jp_hash TEXT PRIMARY KEY,
+            jp_text TEXT,
+            en_text TEXT,
+            comment TEXT
+        );
+        CREATE TABLE IF NOT EXISTS commands (
+            scene_id INTEGER NOT NULL REFERENCES scenes(id),
+            idx INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            jp_hash TEXT NOT NULL,
+            page_number INTEGER NOT NULL,
+            has_ruby INTEGER NOT NULL,
+            is_glued INTEGER NOT NULL,
+            is_choice INTEGER NOT NULL,
+            modifiers TEXT,
+            has_forced_newline INTEGER,
+            PRIMARY KEY (scene_id, idx)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS commands_by_offset ON commands(offset);
+        CREATE INDEX IF NOT EXISTS commands_by_hash ON commands(jp_hash);
+        CREATE TABLE IF NOT EXISTS overrides (
+            offset INTEGER PRIMARY KEY,
+            jp_text TEXT,
+            en_text TEXT,
+            comment TEXT
+        );
+    """
+
+    COMMAND_COLUMNS = (
+        "offset, jp_hash, page_number, has_ruby, is_glued, is_choice, "
+        "modifiers, has_forced_newline"
+    )
+
+    def __init__(self, path, read_only=False):
+        self._path = path
+        # Autocommit mode: each statement commits on its own, unless it
+        # runs inside batch()
+        if read_only:
+            self._conn = sqlite3.connect(
+                pathlib.Path(path).absolute().as_uri() + "?mode=ro",
+                uri=True, isolation_level=None, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(
+                path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.RLock()
+        if not read_only:
+            with self._lock:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn.executescript(self.SCHEMA)
+                self._set_meta('schema_version', self.SCHEMA_VERSION)
+
+        # The base class methods read through these. The charswap map is
+        # read from meta as well, see _charswap_map below.
+        super().__init__(
+            self.SceneMap(self), self.LineMap(self), self.OverrideMap(self),
+            None, self._get_meta('source_hashes', {}))
+        # Edits lock the connection as a whole
+        self.edit_lock = self._lock
+
+    def path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Group several edits into one transaction. Nested batches join
+        # the outermost one.
+        with self._lock:
+            if self._conn.in_transaction:
+                yield
+                return
+
+            self._conn.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).rowcount
+
+    def _get_meta(self, key, default=None):
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def _set_meta(self, key, value):
+        self._execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, json.dumps(value)))
+
+    @property
+    def _charswap_map(self):
+        # Not cached, so changes made through another connection to the
+        # same file are seen
+        return self._get_meta('charswap_map', {})
+
+    @_charswap_map.setter
+    def _charswap_map(self, swap_map):
+        # Only the base class initializer assigns this. The stored value is
+        # the one in meta, which only set_charswap_map and imports write.
+        pass
+
+    @classmethod
+    def _command_from_row(cls, row):
+        (offset, jp_hash, page_number, has_ruby, is_glued, is_choice,
+         modifiers, has_forced_newline) = row
+        return cls.TextCommand(
+            offset,
+            jp_hash,
+            page_number,
+            bool(has_ruby),
+            bool(is_glued),
+            bool(is_choice),
+            json.loads(modifiers) if modifiers else None,
+            None if has_forced_newline is None else bool(has_forced_newline)
+        )
+
+    @staticmethod
+    def _command_row(scene_id, idx, cmd):
+        return (
+            scene_id,
+            idx,
+            cmd.offset,
+            cmd.jp_hash,
+            cmd.page_number,
+            int(bool(cmd.has_ruby)),
+            int(bool(cmd.is_glued)),
+            int(bool(cmd.is_choice)),
+            json.dumps(cmd.modifiers) if cmd.modifiers else None,
+            None if cmd.has_forced_newline is None
+            else int(bool(cmd.has_forced_newline)),
+        )
+
+    class SceneMap(Mapping):
+        # Read-only scene name -> [TextCommand] view of the scene tables
+        def __init__(self, db):
+            self._db = db
+
+        def __getitem__(self, scene_name):
+            rows = self._db._query(
+                f"SELECT {self._db.COMMAND_COLUMNS} FROM commands "
+                f"WHERE scene_id = (SELECT id FROM scenes WHERE name = ?) "
+                f"ORDER BY idx",
+                (scene_name,))
+            if not rows and scene_name not in self:
+                raise KeyError(scene_name)
+            return [self._db._command_from_row(row) for row in rows]
+
+        def __contains__(self, scene_name):
+            return bool(self._db._query(
+                "SELECT 1 FROM scenes WHERE name = ?", (scene_name,)))
+
+        def __iter__(self):
+            return iter([
+                name for name, in
+                self._db._query("SELECT name FROM scenes ORDER BY id")
+            ])
+
+        def __len__(self):
+            return self._db._query("SELECT COUNT(*) FROM scenes")[0][0]
+
+        def items(self):
+            # One pass over the command table rather than a query per scene
+            scene_names = dict(
+                self._db._query("SELECT id, name FROM scenes ORDER BY id"))
+            scenes = {name: [] for name in scene_names.values()}
+            rows = self._db._query(
+                f"SELECT scene_id, {self._db.COMMAND_COLUMNS} FROM commands "
+                f"ORDER BY scene_id, idx")
+            for row in rows:
+                scenes[scene_names[row[0]]].append(
+                    self._db._command_from_row(row[1:]))
+            return scenes.items()
+
+        def values(self):
+            return [commands for _, commands in self.items()]
+
+    class LineMap(Mapping):
+        # Read-only hash -> TLLine view of the line table
+        def __init__(self, db):
+            self._db = db
+
+        def __getitem__(self, jp_hash):
+            rows = self._db._query(
+                "SELECT jp_text, en_text, comment FROM lines "
+                "WHERE jp_hash = ?", (jp_hash,))
+            if not rows:
+                raise KeyError(jp_hash)
+            return self._db.TLLine(*rows[0])
+
+        def __contains__(self, jp_hash):
+            return bool(self._db._query(
+                "SELECT 1 FROM lines WHERE jp_hash = ?", (jp_hash,)))
+
+        def __iter__(self):
+            return iter([
+                jp_hash for jp_hash, in
+                self._db._query("SELECT jp_hash FROM lines ORDER BY jp_hash")
+            ])
+
+        def __len__(self):
+            return self._db._query("SELECT COUNT(*) FROM lines")[0][0]
+
+        def items(self):
+            return [
+                (jp_hash, self._db.TLLine(jp_text, en_text, comment))
+                for jp_hash, jp_text, en_text, comment in self._db._query(
+                    "SELECT jp_hash, jp_text, en_text, comment FROM lines "
+                    "ORDER BY jp_hash")
+            ]
+
+        def values(self):
+            return [line for _, line in self.items()]
+
+    class OverrideMap(Mapping):
+        # Read-only offset -> TLLine view of the override table
+        def __init__(self, db):
+            self._db = db
+
+        def __getitem__(self, offset):
+            rows = self._db._query(
+                "SELECT jp_text, en_text, comment FROM overrides "
+                "WHERE offset = ?", (offset,))
+            if not rows:
+                raise KeyError(offset)
+            return self._db.TLLine(*rows[0])
+
+        def __contains__(self, offset):
+            return bool(self._db._query(
+                "SELECT 1 FROM overrides WHERE offset = ?", (offset,)))
+
+        def __iter__(self):
+            return iter([
+                offset for offset, in
+                self._db._query("SELECT offset FROM overrides ORDER BY offset")
+            ])
+
+        def __len__(self):
+            return self._db._query("SELECT COUNT(*) FROM overrides")[0][0]
+
+        def items(self):
+            return [
+                (offset, self._db.TLLine(jp_text, en_text, comment))
+                for offset, jp_text, en_text, comment in self._db._query(
+                    "SELECT offset, jp_text, en_text, comment FROM overrides "
+                    "ORDER BY offset")
+            ]
+
+        def values(self):
+            return [line for _, line in self.items()]
+
+    def scene_names(self, include_empty=False):
+        if include_empty:
+            return list(self._scene_map)
+
+        return [
+            name for name, in self._query(
+                "SELECT name FROM scenes WHERE EXISTS "
+                "(SELECT 1 FROM commands WHERE scene_id = scenes.id) "
+                "ORDER BY id")
+        ]
+
+    def generate_linebroken_text_map(self, perform_charswap=False, pool=None):
+        # This reads every line of the DB, so load it all at once rather
+        # than running a few queries per text command. The layout cache is
+        # ours, so unchanged scenes are still reused.
+        tl_db = self.to_translation_db()
+        tl_db._layout_cache = self._layout_cache
+        return tl_db.generate_linebroken_text_map(perform_charswap, pool)
+
+    # Edits: each is a single row write
+
+    def set_translation_and_comment_for_hash(self, jp_hash, en_text, comment):
+        # Write and notify as one step, so listeners see edits in the order
+        # they were committed
+        with self.batch():
+            if not self._execute(
+                    "UPDATE lines SET en_text = ?, comment = ? "
+                    "WHERE jp_hash = ?", (en_text, comment, jp_hash)):
+                raise KeyError(jp_hash)
+            self._notify_edit(
+                'set_translation_and_comment_for_hash',
+                jp_hash, en_text, comment)
+
+    def command_for_offset(self, offset):
+        # The commands table is indexed by offset already
+        rows = self._query(
+            f"SELECT scenes.name, idx, {self.COMMAND_COLUMNS} "
+            f"FROM commands JOIN scenes ON scenes.id = scene_id "
+            f"WHERE offset = ? ORDER BY scene_id, idx LIMIT 1", (offset,))
+        if not rows:
+            return None
+        scene_name, idx, *row = rows[0]
+        return scene_name, idx, self._command_from_row(row)
+
+    def offsets_for_hash(self, jp_hash):
+        rows = self._query(
+            "SELECT offset FROM commands WHERE jp_hash = ? "
+            "ORDER BY scene_id, idx", (jp_hash,))
+        return list(dict.fromkeys(offset for offset, in rows))
+
+    def override_translation_and_comment_for_offset(
+            self, offset, en_text, comment):
+        assert isinstance(offset, int)
+        with self.batch():
+            if self._execute(
+                    "UPDATE overrides SET en_text = ?, comment = ? "
+                    "WHERE offset = ?", (en_text, comment, offset)):
+                self._notify_edit(
+                    'override_translation_and_comment_for_offset',
+                    offset, en_text, comment)
+                return
+
+            # Default the override data to the proper hash line at this
+            # offset
+            jp_hash = self.tl_line_for_offset(offset)
+            if jp_hash not in self._line_by_hash:
+                print(f"Unknown hash {jp_hash}")
+                return
+            self._execute(
+                "INSERT INTO overrides (offset, jp_text, en_text, comment) "
+                "SELECT ?, jp_text, ?, ? FROM lines WHERE jp_hash = ?",
+                (offset, en_text, comment, jp_hash))
+            self._notify_edit(
+                'override_translation_and_comment_for_offset',
+                offset, en_text, comment)
+
+    def clear_offset_overrides(self):
+        with self.batch():
+            self._execute("DELETE FROM overrides")
+            self._notify_edit('clear_offset_overrides')
+
+    def translated_percent(self):
+        total_lines, translated_lines = self._query(
+            "SELECT COUNT(*), COUNT(NULLIF(en_text, '')) FROM lines")[0]
+        return float(translated_lines) * 100.0 / float(total_lines)
+
+    def progress(self):
+        # Counted by the DB on each call rather than maintained: the
+        # counts are a couple of indexed aggregate queries away
+        translated, total = self._query(
+            "SELECT COUNT(NULLIF(en_text, '')), COUNT(*) FROM lines")[0]
+        scenes = {
+            scene_name: (scene_translated, scene_total)
+            for scene_name, scene_translated, scene_total in self._query(
+                "SELECT scenes.name, COUNT(NULLIF(CASE "
+                "WHEN overrides.offset IS NOT NULL THEN overrides.en_text "
+                "ELSE lines.en_text END, '')), COUNT(commands.idx) "
+                "FROM scenes "
+                "LEFT JOIN commands ON commands.scene_id = scenes.id "
+                "LEFT JOIN lines ON lines.jp_hash = commands.jp_hash "
+                "LEFT JOIN overrides ON overrides.offset = commands.offset "
+                "GROUP BY scenes.id ORDER BY scenes.id")
+        }
+        return {
+            'translated': translated,
+            'total': total,
+            'scenes': types.MappingProxyType(scenes),
+        }
+
+    def set_charswap_map(self, swap_map):
+        with self.batch():
+            self._set_meta('charswap_map', swap_map)
+            self._notify_edit('set_charswap_map', swap_map)
+
+    def apply_diff(self, diff):
+        with self.batch():
+            super().apply_diff(diff)
+
+    def import_legacy_update_file(self, filename):
+        with self.batch():
+            super().import_legacy_update_file(filename)
+
+    def update_from_mrg(self, allscr_path, script_text_path, pool=None):
+        # Re-extraction touches most of the DB anyway, so run it on an
+        # in-memory copy and write the result back in one transaction
+        with self._lock:
+            tl_db = self.to_translation_db()
+            report = tl_db.update_from_mrg(
+                allscr_path, script_text_path, pool)
+            self._replace_contents(tl_db)
+            self._invalidate_offset_index()
+            self._notify_edit(
+                'update_from_mrg', allscr_path, script_text_path)
+        return report
+
+    # Import/export
+
+    def _replace_contents(self, tl_db):
+        with self.batch():
+            for table in ['commands', 'scenes', 'lines', 'overrides']:
+                self._execute(f"DELETE FROM {table}")
+
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT INTO lines (jp_hash, jp_text, en_text, comment) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (jp_hash, line.jp_text, line.en_text, line.comment)
+                        for jp_hash, line in tl_db._line_by_hash.items()
+                    ])
+                self._conn.executemany(
+                    "INSERT INTO overrides (offset, jp_text, en_text, comment) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (offset, line.jp_text, line.en_text, line.comment)
+                        for offset, line
+                        in tl_db._overrides_by_offset.items()
+                    ])
+                for scene_id, (scene_name, scene_commands) in enumerate(
+                        tl_db._scene_map.items()):
+                    self._conn.execute(
+                        "INSERT INTO scenes (id, name) VALUES (?, ?)",
+                        (scene_id, scene_name))
+                    self._conn.executemany(
+                        "INSERT INTO commands VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            self._command_row(scene_id, idx, cmd)
+                            for idx, cmd in enumerate(scene_commands)
+                        ])
+
+            # Bulk import, not an edit: write the charswap directly rather
+            # than through set_charswap_map, which notifies edit listeners
+            self._set_meta('charswap_map', tl_db.get_charswap_map())
+            self._set_meta('source_hashes', tl_db.get_source_hashes())
+            self._source_hashes = tl_db.get_source_hashes()
+
+    @classmethod
+    def from_translation_db(cls, path, tl_db):
+        # Create (or overwrite the contents of) the SQLite DB at path from
+        # any other TranslationDb
+        sqlite_db = cls(path)
+        sqlite_db._replace_contents(tl_db)
+        return sqlite_db
+
+    @classmethod
+    def import_file(cls, path, source_path):
+        # Import a JSON or binary DB file
+        return cls.from_translation_db(
+            path, TranslationDb.from_file(source_path))
+
+    def to_translation_db(self):
+        # Load the whole DB into a regular in-memory TranslationDb
+        return TranslationDb(
+            dict(self._scene_map.items()),
+            dict(self._line_by_hash.items()),
+            dict(self._overrides_by_offset.items()),
+            self._charswap_map,
+            self._source_hashes
+        )
+
+    def snapshot(self):
+        # Rather than copying the DB, open a read only connection of its
+        # own and start a read transaction on it: in WAL mode, it keeps
+        # seeing the DB as of now, whatever is committed later. Unlike
+        # in-memory snapshots, it can't be edited. The transaction ends
+        # when the snapshot is closed (or garbage collected).
+        with self._lock:
+            snapshot = type(self)(self._path, read_only=True)
+            snapshot._conn.execute("BEGIN")
+            # Transactions start on their first read
+            snapshot._query("SELECT COUNT(*) FROM meta")
+            return snapshot
+
+    def to_file(self, path, binary=None):
+        # Edits are already committed, so saving onto the DB itself is a
+        # no-op. Any other path gets an export.
+        if path == self._path:
+            return
+
+        super().to_file(path, binary)
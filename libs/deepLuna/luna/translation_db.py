@@ -1,16 +1,20 @@
 import io
-import copy
 import hashlib
+import itertools
 import json
-import multiprocessing
 import os
 import re
 import struct
 import sys
+import threading
+import types
+from array import array
 
+from libs.deepLuna.luna.columnar_scene import ColumnarScene, SceneTables
 from libs.deepLuna.luna.constants import Constants
+from libs.deepLuna.luna.db_format import BinaryDbFormat
 from libs.deepLuna.luna.mrg_parser import Mzp
-from libs.deepLuna.luna.mzx import Mzx
+from libs.deepLuna.luna.mzx_pool import MzxPool
 from libs.deepLuna.luna.readable_exporter import ReadableExporter
 from libs.deepLuna.luna.ruby_utils import RubyUtils
 
@@ -34,18 +38,41 @@ class TranslationDb:
             For these cases, allow storing overrides for a line.
     """
 
+    # to_file writes here first, then renames over the target
+    SAVE_TMP_SUFFIX = ".tmp"
+
     def __init__(self, scene_map, line_by_hash, overrides_by_offset,
-                 charswap_map=None):
+                 charswap_map=None, source_hashes=None):
         self._scene_map = scene_map
         self._line_by_hash = line_by_hash
         self._overrides_by_offset = overrides_by_offset
         self._charswap_map = charswap_map or {}
+        # Hashes of the MRG data this DB was extracted from, used to find
+        # what changed on re-extraction. See update_from_mrg.
+        self._source_hashes = source_hashes or {}
+        self._edit_listeners = []
+        # Held while an edit is applied and its listeners notified, so edits
+        # from several threads apply (and are reported) one at a time
+        self.edit_lock = threading.RLock()
+        # Set while the line and override tables are shared with a
+        # snapshot. See snapshot().
+        self._shared = False
+        # Linebroken output of each scene, see generate_linebroken_text_map
+        self._layout_cache = self.LayoutCache()
+        # Offset lookup indices and progress counters, built on first use
+        self._invalidate_offset_index()
 
     def scene_names(self, include_empty=False):
         all_scenes = list(self._scene_map.keys())
         if include_empty:
             return all_scenes
 
+        if isinstance(self._scene_map, BinaryDbFormat.LazySceneMap):
+            # Don't decode every scene just to see if it is empty
+            return [
+                scene for scene in all_scenes
+                if self._scene_map.command_count(scene)
+            ]
         return [scene for scene in all_scenes if self._scene_map[scene]]
 
     def lines_for_scene(self, scene_name):
@@ -58,59 +85,152 @@ class TranslationDb:
         assert isinstance(offset, int)
         return self._overrides_by_offset.get(offset)
 
+    def add_edit_listener(self, listener):
+        # listener(edit, args) is called after every edit to the DB, with
+        # the name of the edit method and the arguments it was called with.
+        # Replaying those calls in order reproduces the edits, except for
+        # 'update_from_mrg', which re-extracts from the MRG files: a
+        # listener that needs to reproduce the DB must take a snapshot then.
+        self._edit_listeners.append(listener)
+
+    def remove_edit_listener(self, listener):
+        self._edit_listeners.remove(listener)
+
+    def _notify_edit(self, edit, *args):
+        for listener in self._edit_listeners:
+            listener(edit, args)
+
     def set_translation_and_comment_for_hash(self, jp_hash, en_text, comment):
-        self._line_by_hash[jp_hash].en_text = en_text
-        self._line_by_hash[jp_hash].comment = comment
+        with self.edit_lock:
+            line = self._line_by_hash[jp_hash]
+            was_translated = bool(line.en_text)
+            # Lines are replaced rather than edited in place, as snapshots
+            # may share them
+            self._unshare()
+            self._line_by_hash[jp_hash] = self.TLLine(
+                line.jp_text, en_text, comment)
+            if self._progress is not None and \
+                    was_translated != bool(en_text):
+                self._progress.line_changed(
+                    jp_hash, bool(en_text) - was_translated)
+            self._notify_edit(
+                'set_translation_and_comment_for_hash',
+                jp_hash, en_text, comment)
 
     def tl_line_for_cmd(self, cmd):
         return self.tl_override_for_offset(cmd.offset) or \
             self.tl_line_with_hash(cmd.jp_hash)
 
     def tl_line_for_offset(self, offset):
-        # Not a hot path, so just iterate the scene map
-        for scene in self._scene_map.values():
-            for line in scene:
-                if line.offset == offset:
-                    return line.jp_hash
-
-        return None
+        location = self.command_for_offset(offset)
+        return location[2].jp_hash if location else None
+
+    def _build_offset_index(self):
+        # offset -> (scene name, index in scene, TextCommand), and
+        # hash -> [offsets]. The first scene emitting an offset wins.
+        command_by_offset = {}
+        offsets_by_hash = {}
+        for scene_name, scene_commands in self._scene_map.items():
+            for idx, cmd in enumerate(scene_commands):
+                if cmd.offset in command_by_offset:
+                    continue
+                command_by_offset[cmd.offset] = (scene_name, idx, cmd)
+                offsets_by_hash.setdefault(cmd.jp_hash, []).append(cmd.offset)
+
+        self._command_by_offset = command_by_offset
+        self._offsets_by_hash = offsets_by_hash
+
+    def _invalidate_offset_index(self):
+        # Call whenever the scene map is replaced
+        self._command_by_offset = None
+        self._offsets_by_hash = None
+        self._progress = None
+
+    def command_for_offset(self, offset):
+        # Returns (scene name, index in scene, TextCommand) for the command
+        # emitting a script_text offset, or None if no scene does
+        if self._command_by_offset is None:
+            self._build_offset_index()
+        return self._command_by_offset.get(offset)
+
+    def offsets_for_hash(self, jp_hash):
+        # All the script_text offsets with this JP text
+        if self._offsets_by_hash is None:
+            self._build_offset_index()
+        return list(self._offsets_by_hash.get(jp_hash, []))
 
     def override_translation_and_comment_for_offset(
             self, offset, en_text, comment):
         assert isinstance(offset, int)
-        if offset not in self._overrides_by_offset:
-            # Default the override data to the proper hash line at this offset
-            jp_hash = self.tl_line_for_offset(offset)
-            if jp_hash not in self._line_by_hash:
-                print(f"Unknown hash {jp_hash}")
-                return
-            base = copy.deepcopy(self._line_by_hash[jp_hash])
-            self._overrides_by_offset[offset] = base
-
-        self._overrides_by_offset[offset].en_text = en_text
-        self._overrides_by_offset[offset].comment = comment
+        with self.edit_lock:
+            line = self._overrides_by_offset.get(offset)
+            is_new_override = line is None
+            if is_new_override:
+                # Default the override data to the proper hash line at this
+                # offset
+                jp_hash = self.tl_line_for_offset(offset)
+                if jp_hash not in self._line_by_hash:
+                    print(f"Unknown hash {jp_hash}")
+                    return
+                line = self._line_by_hash[jp_hash]
+
+            was_translated = bool(line.en_text)
+            self._unshare()
+            self._overrides_by_offset[offset] = self.TLLine(
+                line.jp_text, en_text, comment)
+            if self._progress is not None:
+                self._progress.override_changed(
+                    offset, is_new_override, bool(en_text) - was_translated)
+            self._notify_edit(
+                'override_translation_and_comment_for_offset',
+                offset, en_text, comment)
 
     def clear_offset_overrides(self):
-        self._overrides_by_offset = {}
+        with self.edit_lock:
+            self._overrides_by_offset = {}
+            self._progress = None
+            self._notify_edit('clear_offset_overrides')
+
+    def progress(self):
+        # Translation progress, from counters kept up to date by the edit
+        # methods (built on first use). Returns
+        #   {'translated': n, 'total': n, 'scenes': {scene: (n, total)}}
+        # where the top level counts distinct lines (by hash), and each
+        # scene counts its text commands, taking overrides into account.
+        # 'scenes' is a live read-only view.
+        with self.edit_lock:
+            if self._progress is None:
+                self._progress = self.ProgressCounters(self)
+            return self._progress.summary()
 
     def translated_percent(self):
-        total_lines = 0
-        translated_lines = 0
-        for line in self._line_by_hash.values():
-            total_lines += 1
-            if line.en_text:
-                translated_lines += 1
-
-        return float(translated_lines) * 100.0 / float(total_lines)
+        progress = self.progress()
+        return float(progress['translated']) * 100.0 / \
+            float(progress['total'])
 
     def get_charswap_map(self):
         return self._charswap_map
 
     def set_charswap_map(self, swap_map):
-        self._charswap_map = swap_map
+        with self.edit_lock:
+            self._charswap_map = swap_map
+            self._notify_edit('set_charswap_map', swap_map)
+
+    def get_source_hashes(self):
+        return self._source_hashes
+
+    def materialize(self):
+        # Decode whatever a lazily loaded DB has not decoded yet, and stop
+        # referring to the DB file. Lines and scenes already handed out
+        # stay in use.
+        if isinstance(self._scene_map, BinaryDbFormat.LazySceneMap):
+            self._scene_map = self._scene_map.materialize()
+        if isinstance(self._line_by_hash, BinaryDbFormat.LazyLineMap):
+            self._line_by_hash = self._line_by_hash.materialize()
 
     def as_json(self):
-        return json.dumps({
+        self.materialize()
+        ret = {
             'scene_map': {
                 k: [e.as_json() for e in v]
                 for k, v in self._scene_map.items()
@@ -122,7 +242,13 @@ class TranslationDb:
                 k: v.as_json() for k, v in self._overrides_by_offset.items()
             },
             'charswap_map': self._charswap_map
-        }, sort_keys=True, indent=2)
+        }
+
+        # Only DBs extracted from MRG files carry source hashes
+        if self._source_hashes:
+            ret['source_hashes'] = self._source_hashes
+
+        return json.dumps(ret, sort_keys=True, indent=2)
 
     @classmethod
     def from_json(cls, jsonb):
@@ -130,8 +256,9 @@ class TranslationDb:
             k: [cls.TextCommand.from_json(e) for e in v]
             for k, v in jsonb['scene_map'].items()
         }
+        # Intern the hashes so the text commands share the key strings
         line_by_hash = {
-            k: cls.TLLine.from_json(v)
+            sys.intern(k): cls.TLLine.from_json(v)
             for k, v in jsonb['line_by_hash'].items()
         }
         overrides_by_offset = {
@@ -139,8 +266,10 @@ class TranslationDb:
             for k, v in jsonb.get('override_by_offset', {}).items()
         }
         charswap_map = jsonb.get('charswap_map')
+        source_hashes = jsonb.get('source_hashes')
 
-        return cls(scene_map, line_by_hash, overrides_by_offset, charswap_map)
+        return cls(scene_map, line_by_hash, overrides_by_offset, charswap_map,
+                   source_hashes)
 
     def export_scene(self, scene_name, output_basedir):
         if scene_name not in self.scene_names():
@@ -180,190 +309,323 @@ class TranslationDb:
                 ).encode('utf-8')
             )
 
-    def generate_script_text_mrg(self, perform_charswap=False):
-        offset_to_string = self.generate_linebroken_text_map(perform_charswap)
+    def generate_script_text_mrg(self, perform_charswap=False, pool=None):
+        offset_to_string = self.generate_linebroken_text_map(
+            perform_charswap, pool)
         return self.pack_linebroken_text_to_mrg(offset_to_string)
 
-    def generate_linebroken_text_map(self, perform_charswap=False):
+    def write_script_text_mrg(self, target, perform_charswap=False,
+                              pool=None):
+        # Stream the generated script_text MZP to a writable binary target
+        # instead of building it in memory.
+        offset_to_string = self.generate_linebroken_text_map(
+            perform_charswap, pool)
+        return self.write_linebroken_text_to_mrg(offset_to_string, target)
+
+    @staticmethod
+    def scene_columns(scene_commands):
+        # (offsets, jp hashes, page numbers, glued flags) of the commands
+        # in a scene, read straight from the columns of columnar scenes
+        if isinstance(scene_commands, ColumnarScene):
+            return (
+                scene_commands.offsets,
+                scene_commands.jp_hashes(),
+                scene_commands.pages,
+                scene_commands.glued()
+            )
+
+        return (
+            [cmd.offset for cmd in scene_commands],
+            [cmd.jp_hash for cmd in scene_commands],
+            [cmd.page_number for cmd in scene_commands],
+            [cmd.is_glued for cmd in scene_commands]
+        )
+
+    def use_columnar_scenes(self):
+        # Switch the scene map over to ColumnarScenes, which hold the
+        # commands as compact arrays and only build TextCommands on demand
+        self.materialize()
+        tables = SceneTables()
+        self._scene_map = {
+            scene_name: ColumnarScene.from_commands(
+                scene_commands, tables, self.TextCommand)
+            for scene_name, scene_commands in self._scene_map.items()
+        }
+        self._invalidate_offset_index()
+
+    def generate_linebroken_text_map(self, perform_charswap=False, pool=None):
         # Iterate each scene in the translation DB, apply line breaking
         # and control codes and stick the result into a map of offset -> string
+        # Scenes are laid out independently, so given an MzxPool they are
+        # laid out in its workers, with the same result.
+        # Work from a snapshot: edits made meanwhile on other threads
+        # neither disturb the iteration nor half show up in the output
+        snapshot = self.snapshot()
+        line_by_hash = snapshot._line_by_hash
+        overrides_by_offset = snapshot._overrides_by_offset
+        charswap_map = snapshot._charswap_map if perform_charswap else None
         offset_to_string = {}
 
-        for scene_name, scene_commands in self._scene_map.items():
-            cursor_position = 0
-            prev_page_number = None
-            scene_is_qa = scene_name.startswith('QA')
-            # We need some amount of lookahead for glue lines, so iterate
-            # by offset here
-            for cmd_offset in range(len(scene_commands)):
-                command = scene_commands[cmd_offset]
-
-                # Pull the translated text for this line from the SHA-addressed
-                # translation table
-                tl_line = self._line_by_hash[command.jp_hash]
-
-                # If there is an explicit override for this line, pull that
-                # instead
-                if command.offset in self._overrides_by_offset:
-                    tl_line = self._overrides_by_offset[command.offset]
-
-                # If the line is not actually translated, fall back to the
-                # original JP text instead.
-                if not tl_line.en_text:
-                    offset_to_string[command.offset] = tl_line.jp_text
-                    continue
+        # Layout never carries over from one scene to the next, so each
+        # scene's output is cached, and only recomputed when anything it
+        # depends on changes
+        layout_cache = self._layout_cache
+        charswap_key = tuple(sorted(charswap_map.items())) \
+            if charswap_map is not None else None
+        scene_results = []
+        dirty_jobs = []
+        for scene_name, scene_commands in snapshot._scene_map.items():
+            # Only a few command fields are needed here, so read them as
+            # columns rather than going through each command
+            offsets, jp_hashes, page_numbers, glued = \
+                self.scene_columns(scene_commands)
+
+            # The text of the line each command emits: its override if it
+            # has one, otherwise the SHA-addressed line
+            texts = []
+            for offset, jp_hash in zip(offsets, jp_hashes):
+                tl_line = overrides_by_offset.get(offset) or \
+                    line_by_hash[jp_hash]
+                texts.append((tl_line.jp_text, tl_line.en_text))
+
+            key = layout_cache.key(
+                offsets, page_numbers, glued, texts, charswap_key)
+            scene_strings = layout_cache.get(scene_name, key)
+            if scene_strings is None:
+                dirty_jobs.append((
+                    scene_name, list(offsets), list(page_numbers),
+                    list(glued), texts))
+            scene_results.append((scene_name, key, scene_strings))
+
+        # Lay out the scenes that changed
+        if pool is None or len(dirty_jobs) < 2:
+            laid_out = [
+                self.layout_scene(*job, charswap_map=charswap_map)
+                for job in dirty_jobs
+            ]
+        else:
+            # Chunked by line count, to balance the workers
+            chunks = pool.chunk_entries(
+                dirty_jobs, [len(job[1]) for job in dirty_jobs])
+            laid_out = []
+            for chunk_result in pool.map_chunks(
+                    self.layout_scene_chunk,
+                    [(RubyUtils.ENABLE_PUA_CODES, charswap_map, chunk)
+                     for chunk in chunks]):
+                laid_out.extend(chunk_result)
+
+        # Merge in scene order, exactly as if laid out one by one
+        laid_out = iter(laid_out)
+        for scene_name, key, scene_strings in scene_results:
+            if scene_strings is None:
+                scene_strings = next(laid_out)
+                layout_cache.put(scene_name, key, scene_strings)
+            offset_to_string.update(scene_strings)
+
+        layout_cache.prune(snapshot._scene_map)
+        layout_cache.report(
+            len(snapshot._scene_map), [job[0] for job in dirty_jobs])
+        return offset_to_string
 
-                # Get the english text.
-                tl_text = tl_line.en_text
-
-                # The translation text may contain linebreaks, as allowed by
-                # the import/export format. Remove these now. Linebreaks
-                # intended for display in-game must be coded for using %{n}
-                tl_text = tl_text.replace('\n', '')
-
-                # If this line is not glued to the line that came before it,
-                # reset the accumulated cursor position
-                # However, if this is a QA scene, _all_ lines count as glued
-                # due to modifications to the allscr.
-                force_glue = '%{force_glue}' in tl_text
-                if not (command.is_glued or force_glue) and not scene_is_qa:
-                    cursor_position = 0
-
-                # If we have turned the page, we also want to rezero the
-                # cursor position
-                if command.page_number != prev_page_number:
-                    prev_page_number = command.page_number
-                    cursor_position = 0
-
-                # Before processing the line for control codes, check to
-                # see if it has any flags we care about here
-                skip_linebreak = '%{no_break}' in tl_text
-
-                # Reify any custom control codes present in the line
-                coded_text = RubyUtils.apply_control_codes(tl_text)
-
-                # If we are performing a charswap, do so now
-                if perform_charswap:
-                    coded_text = ''.join([
-                        self._charswap_map.get(c, c) for c in coded_text
-                    ])
-
-                # If this line is glued, and would start with a space, but the
-                # preceding line ended in a newline, drop the leading space.
-                if coded_text and command.is_glued and cmd_offset - 1 >= 0:
-                    prev_cmd = scene_commands[cmd_offset-1]
-                    # Need to strip the padding \r\n from lines
-                    prev_broken_line = offset_to_string[
-                        prev_cmd.offset].replace("\r\n", "")
-                    if prev_broken_line and \
-                       prev_broken_line[-1] == '\n' and \
-                       coded_text[0] == ' ':
-                        coded_text = coded_text[1:]
-
-                # Break the text, unless this is a QA scene in which case
-                # it's all manual
-                linebroken_text = (
-                    coded_text if (scene_is_qa or skip_linebreak) else
-                    RubyUtils.linebreak_text(
-                        coded_text,
-                        Constants.CHARS_PER_LINE,
-                        start_cursor_pos=cursor_position
-                    )
+    def add_layout_stats_listener(self, listener):
+        # listener(stats) is called after each generation of the linebroken
+        # text map, with the layout cache hits and misses. See LayoutCache.
+        self._layout_cache.add_stats_listener(listener)
+
+    def remove_layout_stats_listener(self, listener):
+        self._layout_cache.remove_stats_listener(listener)
+
+    @classmethod
+    def layout_scene_chunk(cls, job):
+        # Lay out a list of (scene name, offsets, page numbers, glue flags,
+        # texts) scenes in a pool worker. The layout settings are sent
+        # along, as the worker's may predate them.
+        enable_pua_codes, charswap_map, scenes = job
+        RubyUtils.ENABLE_PUA_CODES = enable_pua_codes
+        return [
+            cls.layout_scene(*scene, charswap_map=charswap_map)
+            for scene in scenes
+        ]
+
+    @staticmethod
+    def layout_scene(scene_name, offsets, page_numbers, glued, texts,
+                     charswap_map=None):
+        # Apply line breaking and control codes to the lines of one scene.
+        # texts holds the (jp_text, en_text) of the line each command
+        # emits, and the charswap is applied if a charswap_map is given.
+        # Returns a map of offset -> string.
+        offset_to_string = {}
+        cursor_position = 0
+        prev_page_number = None
+        scene_is_qa = scene_name.startswith('QA')
+        # We need some amount of lookahead for glue lines, so iterate
+        # by offset here
+        for cmd_offset in range(len(offsets)):
+            offset = offsets[cmd_offset]
+            is_glued = glued[cmd_offset]
+
+            # The translated text for this line, already resolved from
+            # the SHA-addressed translation table or an explicit override
+            jp_text, en_text = texts[cmd_offset]
+
+            # If the line is not actually translated, fall back to the
+            # original JP text instead.
+            if not en_text:
+                offset_to_string[offset] = jp_text
+                continue
+
+            # Get the english text.
+            tl_text = en_text
+
+            # The translation text may contain linebreaks, as allowed by
+            # the import/export format. Remove these now. Linebreaks
+            # intended for display in-game must be coded for using %{n}
+            tl_text = tl_text.replace('\n', '')
+
+            # If this line is not glued to the line that came before it,
+            # reset the accumulated cursor position
+            # However, if this is a QA scene, _all_ lines count as glued
+            # due to modifications to the allscr.
+            force_glue = '%{force_glue}' in tl_text
+            if not (is_glued or force_glue) and not scene_is_qa:
+                cursor_position = 0
+
+            # If we have turned the page, we also want to rezero the
+            # cursor position
+            if page_numbers[cmd_offset] != prev_page_number:
+                prev_page_number = page_numbers[cmd_offset]
+                cursor_position = 0
+
+            # Before processing the line for control codes, check to
+            # see if it has any flags we care about here
+            skip_linebreak = '%{no_break}' in tl_text
+
+            # Reify any custom control codes present in the line
+            coded_text = RubyUtils.apply_control_codes(tl_text)
+
+            # If we are performing a charswap, do so now
+            if charswap_map is not None:
+                coded_text = ''.join([
+                    charswap_map.get(c, c) for c in coded_text
+                ])
+
+            # If this line is glued, and would start with a space, but the
+            # preceding line ended in a newline, drop the leading space.
+            if coded_text and is_glued and cmd_offset - 1 >= 0:
+                # Need to strip the padding \r\n from lines
+                prev_broken_line = offset_to_string[
+                    offsets[cmd_offset-1]].replace("\r\n", "")
+                if prev_broken_line and \
+                   prev_broken_line[-1] == '\n' and \
+                   coded_text[0] == ' ':
+                    coded_text = coded_text[1:]
+
+            # Break the text, unless this is a QA scene in which case
+            # it's all manual
+            linebroken_text = (
+                coded_text if (scene_is_qa or skip_linebreak) else
+                RubyUtils.linebreak_text(
+                    coded_text,
+                    Constants.CHARS_PER_LINE,
+                    start_cursor_pos=cursor_position
                 )
+            )
 
-                # Check if the broken text contains any newlines, and update
-                # the new cursor position accordingly
-                did_break_line = len(linebroken_text.split('\n')) > 1
-                final_broken_line = linebroken_text.split('\n')[-1]
-                old_cursor_position = cursor_position
-                if did_break_line:
-                    cursor_position = RubyUtils.noruby_len(final_broken_line)
-                else:
-                    cursor_position += RubyUtils.noruby_len(final_broken_line)
-
-                # Wrap the cursor position if necessary
-                cursor_position = \
-                    cursor_position % Constants.CHARS_PER_LINE
-
-                # Test to see if the next line is glued
-                if cmd_offset + 1 < len(scene_commands):
-                    next_cmd = scene_commands[cmd_offset+1]
-                    if next_cmd.is_glued and linebroken_text:
-                        # Need to check if glueing this line screws anything up
-                        # - If next line starts with space, and current line is
-                        #   precicely 55 chars, force newline at the end of
-                        #   this current line
-                        next_line = self._line_by_hash[next_cmd.jp_hash]
-                        if next_cmd.offset in self._overrides_by_offset:
-                            next_line = \
-                                self._overrides_by_offset[next_cmd.offset]
-                        next_tl = next_line.en_text or tl_line.jp_text
-                        if next_tl and next_tl[0] == ' ' \
-                                and linebroken_text[-1] != '\n':
-                            if cursor_position == 0:
-                                linebroken_text += "\n"
-                                cursor_position = 0
-
-                        # If next line does not start with a space, re-break
-                        # this line accounting for the glue characters as
-                        # part of the final word IF it would cause a linebreak
-                        # when added
-                        next_word_len = RubyUtils.noruby_len(
-                            RubyUtils.apply_control_codes(
-                                next_tl.split(' ')[0]
-                            )
+            # Check if the broken text contains any newlines, and update
+            # the new cursor position accordingly
+            did_break_line = len(linebroken_text.split('\n')) > 1
+            final_broken_line = linebroken_text.split('\n')[-1]
+            old_cursor_position = cursor_position
+            if did_break_line:
+                cursor_position = RubyUtils.noruby_len(final_broken_line)
+            else:
+                cursor_position += RubyUtils.noruby_len(final_broken_line)
+
+            # Wrap the cursor position if necessary
+            cursor_position = \
+                cursor_position % Constants.CHARS_PER_LINE
+
+            # Test to see if the next line is glued
+            if cmd_offset + 1 < len(offsets):
+                if glued[cmd_offset+1] and linebroken_text:
+                    # Need to check if glueing this line screws anything up
+                    # - If next line starts with space, and current line is
+                    #   precicely 55 chars, force newline at the end of
+                    #   this current line
+                    next_tl = texts[cmd_offset+1][1] or jp_text
+                    if next_tl and next_tl[0] == ' ' \
+                            and linebroken_text[-1] != '\n':
+                        if cursor_position == 0:
+                            linebroken_text += "\n"
+                            cursor_position = 0
+
+                    # If next line does not start with a space, re-break
+                    # this line accounting for the glue characters as
+                    # part of the final word IF it would cause a linebreak
+                    # when added
+                    next_word_len = RubyUtils.noruby_len(
+                        RubyUtils.apply_control_codes(
+                            next_tl.split(' ')[0]
                         )
-                        next_word_would_break = False
-                        if did_break_line:
-                            next_word_would_break = \
-                                RubyUtils.noruby_len(final_broken_line) + \
-                                next_word_len > Constants.CHARS_PER_LINE
+                    )
+                    next_word_would_break = False
+                    if did_break_line:
+                        next_word_would_break = \
+                            RubyUtils.noruby_len(final_broken_line) + \
+                            next_word_len > Constants.CHARS_PER_LINE
+                    else:
+                        next_word_would_break = \
+                            old_cursor_position + \
+                            RubyUtils.noruby_len(final_broken_line) + \
+                            next_word_len > Constants.CHARS_PER_LINE
+                    if next_tl and next_tl[0] != ' ' \
+                            and linebroken_text[-1] != '\n' \
+                            and next_word_would_break:
+                        # If the broken line contains spaces, change
+                        # the final space to a newline
+                        if ' ' in linebroken_text:
+                            fragments = linebroken_text.split(' ')
+                            linebroken_text = ' '.join(
+                                fragments[:-2] +
+                                ['\n'.join(fragments[-2:])])
                         else:
-                            next_word_would_break = \
-                                old_cursor_position + \
-                                RubyUtils.noruby_len(final_broken_line) + \
-                                next_word_len > Constants.CHARS_PER_LINE
-                        if next_tl and next_tl[0] != ' ' \
-                                and linebroken_text[-1] != '\n' \
-                                and next_word_would_break:
-                            # If the broken line contains spaces, change
-                            # the final space to a newline
-                            if ' ' in linebroken_text:
-                                fragments = linebroken_text.split(' ')
-                                linebroken_text = ' '.join(
-                                    fragments[:-2] +
-                                    ['\n'.join(fragments[-2:])])
-                            else:
-                                # If there's no space we can repurpose,
-                                # we would have to go back to the _previous_
-                                # line to find a natural break. We can't, so
-                                # crash here and force the editor to go put in
-                                # a manual %{n} or %{s} somewhere.
-                                raise RuntimeError(
-                                    f"Fixing glue for offset {command.offset} "
-                                    "requires too much backtracking. "
-                                    "Insert extra whitespace to allow first "
-                                    "order line breaks."
-                                )
-
-                            # Re-calc new cursor position
-                            final_broken_line = linebroken_text.split('\n')[-1]
-                            cursor_position = RubyUtils.noruby_len(
-                                final_broken_line)
-
-                # Append trailing \r\n if the original text had it
-                processed_string = linebroken_text + (
-                    "\r\n"
-                    if tl_line.jp_text.endswith("\r\n")
-                    and not linebroken_text.endswith("\r\n")
-                    else "")
-
-                # Stick the processed string into our map
-                offset_to_string[command.offset] = processed_string
+                            # If there's no space we can repurpose,
+                            # we would have to go back to the _previous_
+                            # line to find a natural break. We can't, so
+                            # crash here and force the editor to go put in
+                            # a manual %{n} or %{s} somewhere.
+                            raise RuntimeError(
+                                f"Fixing glue for offset {offset} "
+                                "requires too much backtracking. "
+                                "Insert extra whitespace to allow first "
+                                "order line breaks."
+                            )
+
+                        # Re-calc new cursor position
+                        final_broken_line = linebroken_text.split('\n')[-1]
+                        cursor_position = RubyUtils.noruby_len(
+                            final_broken_line)
+
+            # Append trailing \r\n if the original text had it
+            processed_string = linebroken_text + (
+                "\r\n"
+                if jp_text.endswith("\r\n")
+                and not linebroken_text.endswith("\r\n")
+                else "")
+
+            # Stick the processed string into our map
+            offset_to_string[offset] = processed_string
 
         return offset_to_string
 
     def pack_linebroken_text_to_mrg(self, offset_to_string):
+        return Mzp.pack(self.script_text_mrg_sections(offset_to_string))
+
+    def write_linebroken_text_to_mrg(self, offset_to_string, target):
+        return Mzp.pack_to(
+            self.script_text_mrg_sections(offset_to_string), target)
+
+    def script_text_mrg_sections(self, offset_to_string):
         # Now that we have processed all the strings, iterate from 0 to
         # max_offset and write each string entry into an MZP.
         max_offset = max(offset_to_string.keys())
@@ -388,10 +650,8 @@ class TranslationDb:
         offset_table.write(struct.pack(">I", string_table.tell()))
         offset_table.write(struct.pack(">I", 0xFFFFFFFF))
 
-        offset_table.seek(0, io.SEEK_SET)
-        string_table.seek(0, io.SEEK_SET)
-        offset_table_str = offset_table.read()
-        string_table_str = string_table.read()
+        offset_table_str = offset_table.getvalue()
+        string_table_str = string_table.getvalue()
 
         # For whatever reason, the MZP also contains 4 offset/string table
         # pairs consisting of just '  \r\n' . Regenerate these tables too
@@ -409,10 +669,8 @@ class TranslationDb:
         newline_offset_table.write(struct.pack(">I", newline_string_table_end))
         newline_offset_table.write(struct.pack(">I", 0xFFFFFFFF))
 
-        newline_offset_table.seek(0, io.SEEK_SET)
-        newline_string_table.seek(0, io.SEEK_SET)
-        newline_offset_table_str = newline_offset_table.read()
-        newline_string_table_str = newline_string_table.read()
+        newline_offset_table_str = newline_offset_table.getvalue()
+        newline_string_table_str = newline_string_table.getvalue()
 
         # Space tables
         space_offset_table = io.BytesIO()
@@ -428,13 +686,11 @@ class TranslationDb:
         space_offset_table.write(struct.pack(">I", space_string_table_end))
         space_offset_table.write(struct.pack(">I", 0xFFFFFFFF))
 
-        space_offset_table.seek(0, io.SEEK_SET)
-        space_string_table.seek(0, io.SEEK_SET)
-        space_offset_table_str = space_offset_table.read()
-        space_string_table_str = space_string_table.read()
+        space_offset_table_str = space_offset_table.getvalue()
+        space_string_table_str = space_string_table.getvalue()
 
-        # Pack the MZP
-        return Mzp.pack([
+        # MZP sections, in archive order
+        return [
             # Actual translation data
             offset_table_str, string_table_str,
             # 4 copies of newlines
@@ -442,17 +698,114 @@ class TranslationDb:
             space_offset_table_str, space_string_table_str,
             space_offset_table_str, space_string_table_str,
             space_offset_table_str, space_string_table_str,
-        ])
+        ]
+
+    @classmethod
+    def from_binary(cls, data, columnar=False, lazy=False):
+        # With columnar, scenes load straight into ColumnarScenes. With
+        # lazy, scenes and lines of a segmented DB are only decoded from
+        # data on first access, and data must stay unchanged until then.
+        return cls(*BinaryDbFormat.unpack(
+            data, cls.TextCommand, cls.TLLine, columnar, lazy))
+
+    def as_binary(self, segmented=True):
+        self.materialize()
+        pack = BinaryDbFormat.pack_segmented if segmented \
+            else BinaryDbFormat.pack
+        return pack(
+            self._scene_map,
+            self._line_by_hash,
+            self._overrides_by_offset,
+            self._charswap_map,
+            self._source_hashes
+        )
 
     @classmethod
-    def from_file(cls, path):
+    def from_file(cls, path, columnar=False, lazy=True):
+        # Segmented binary DBs load lazily unless told otherwise, straight
+        # from a mapping of the file
+        from libs.deepLuna.luna.sqlite_db import SqliteTranslationDb
         with open(path, 'rb') as input_file:
-            raw_db = input_file.read()
-        return cls.from_json(json.loads(raw_db))
+            # SQLite DBs are queried in place rather than loaded
+            magic = input_file.read(len(SqliteTranslationDb.MAGIC))
+            if magic == SqliteTranslationDb.MAGIC:
+                return SqliteTranslationDb(path)
+
+            if lazy and BinaryDbFormat.is_segmented_db(magic):
+                input_file.seek(0)
+                return cls.from_binary(
+                    BinaryDbFormat.map_file(input_file), columnar, lazy)
+
+            raw_db = magic + input_file.read()
+
+        # Either of the other formats can be loaded, sniff which one
+        if BinaryDbFormat.is_binary_db(raw_db):
+            return cls.from_binary(raw_db, columnar)
+
+        tl_db = cls.from_json(json.loads(raw_db))
+        if columnar:
+            tl_db.use_columnar_scenes()
+        return tl_db
+
+    def to_file(self, path, binary=None):
+        # Unless told otherwise, pick the format from the extension: the
+        # binary format for .ldb files, SQLite for .sqlite files and JSON
+        # for anything else
+        from libs.deepLuna.luna.sqlite_db import SqliteTranslationDb
+        if binary is None and path.endswith(SqliteTranslationDb.EXTENSION):
+            SqliteTranslationDb.from_translation_db(path, self).close()
+            return
+
+        if binary is None:
+            binary = path.endswith(BinaryDbFormat.EXTENSION)
+
+        data = self.as_binary() if binary else self.as_json().encode('utf-8')
+
+        # Write a temporary file and only rename it over the target once
+        # it is on disk, so a crash mid-save leaves the previous file intact
+        tmp_path = path + self.SAVE_TMP_SUFFIX
+        with open(tmp_path, 'wb') as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(tmp_path, path)
+
+        # Make the rename itself durable
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(
+                os.path.dirname(os.path.abspath(path)), os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def snapshot(self):
+        # Frozen copy of the DB, for long readers (script generation,
+        # exports, saves) to work from while edits continue. Taking one is
+        # O(1): the tables are shared, and copied by whichever DB is edited
+        # next (see _unshare). Lines are never edited in place and neither
+        # is the scene map, so those are shared as is.
+        # Subclasses keep their own type, or store the DB differently and
+        # override this (see SqliteTranslationDb.snapshot).
+        with self.edit_lock:
+            self.materialize()
+            snapshot = type(self)(
+                self._scene_map,
+                self._line_by_hash,
+                self._overrides_by_offset,
+                self._charswap_map,
+                self._source_hashes
+            )
+            self._shared = snapshot._shared = True
+            return snapshot
 
-    def to_file(self, path):
-        with open(path, 'wb+') as output:
-            output.write(self.as_json().encode('utf-8'))
+    def _unshare(self):
+        # Copy on write. Call with edit_lock held, before editing the line
+        # or override tables.
+        if self._shared:
+            self._line_by_hash = dict(self._line_by_hash)
+            self._overrides_by_offset = dict(self._overrides_by_offset)
+            self._shared = False
 
     def import_update_file(self, filename):
         # Parse diff
@@ -553,77 +906,111 @@ class TranslationDb:
                 scene_line.jp_hash, tl_text, comment_text
             )
 
+    # Script commands are of the form _OPCODE(arg,arg,...)
+    SCRIPT_CMD_REGEX = re.compile(
+        r"_(\w+)\(([\w 　a-zA-Z0-9-,`@$:.+^_]*)\)\Z")
+
+    # Tokens within a text command argument, as (dollar, digits, modifier)
+    # groups: $offset text references, @x modifiers and ^ forced newlines.
+    # A $ without digits is not a text reference, but still bounds the
+    # forced newline search. The original search stopped short of the
+    # last character of the argument, so a final ^ is not a token.
+    TEXT_ARG_TOKEN_REGEX = re.compile(r"(\$)(\d*)|(@\w)|\^(?!\Z)")
+
+    # Flag bits of tokenized text commands
+    TOKEN_GLUED = 1
+    TOKEN_CHOICE = 2
+    TOKEN_FORCED_NEWLINE = 4
+
     @classmethod
-    def parse_script_cmds(cls, script, strings_by_content_hash,
-                          content_hash_by_offset):
-        # Split script into commands
-        raw_cmds = [
-            cmd.strip() for cmd in script.decode('utf-8').split(';')
-            if cmd.strip()
-        ]
+    def tokenize_script(cls, script):
+        # Walk a decompressed script once and extract the text emission
+        # commands as compact (offset, page number, flags, modifiers)
+        # tuples. These carry everything parse_script_cmds needs apart from
+        # the string table lookups.
+        match_cmd = cls.SCRIPT_CMD_REGEX.match
+        find_arg_tokens = cls.TEXT_ARG_TOKEN_REGEX.findall
+        glued_flag = cls.TOKEN_GLUED
+        forced_newline_flag = cls.TOKEN_FORCED_NEWLINE
+
+        tokens = []
+        page_number = 0
+        seen_offsets = set()
+        # Page and forced newline state of the previous text command
+        prev_page_number = None
+        prev_has_forced_newline = False
 
-        # Regex to parse command name/args
-        command_regex = re.compile(
-            r"_(\w+)\(([\w 　a-zA-Z0-9-,`@$:.+^_]*)\)\Z")
+        for raw_cmd in script.decode('utf-8').split(';'):
+            cmd = raw_cmd.strip()
+            if not cmd:
+                continue
 
-        # Parse each script command
-        script_commands = []
-        for cmd in raw_cmds:
             # Try and match regex
-            match = command_regex.match(cmd)
+            match = match_cmd(cmd)
             if not match:
                 sys.stderr.write(f"Failed to parse command {cmd}\n")
                 continue
 
-            groups = match.groups()
-            script_commands.append(
-                cls.AllscrCmd(groups[0])
-                if len(groups) == 1
-                else cls.AllscrCmd(groups[0], groups[1].split(','))
-            )
+            opcode, raw_args = match.groups()
 
-        # Now iterate the script commands and extract any that reference
-        # script lines
-        text_offsets = []
-        visited_offsets = set()
-        page_number = 0
-        seen_offsets = set()
-        for cmd in script_commands:
             # If it's a PGST, take argv0 the page counter
-            if cmd.opcode == 'PGST':
-                page_number = int(cmd.arguments[0])
+            if opcode == 'PGST':
+                page_number = int(raw_args.split(',')[0])
                 continue
 
-            # If it's not a text scripting command, ignore
-            is_zm = cmd.opcode.startswith('ZM')
-            is_msad = cmd.opcode == 'MSAD'
-            is_selr = cmd.opcode == 'SELR'
-            if not any([is_zm, is_msad, is_selr]):
+            # If it's not a text scripting command, or it has no text
+            # references at all, ignore
+            is_msad = opcode == 'MSAD'
+            is_selr = opcode == 'SELR'
+            if not (is_msad or is_selr or opcode.startswith('ZM')):
                 continue
-
-            # If it has no arguments, ignore
-            if not cmd.arguments:
+            if '$' not in raw_args:
                 continue
+            choice_flag = cls.TOKEN_CHOICE if is_selr else 0
 
             # If it does have args, match all instances of text references
-            for arg in cmd.arguments:
-                text_refs = re.compile(r"(\$\d+)").findall(arg)
-                text_modifiers = re.compile(r"(\@\w)").findall(arg)
-                offsets = [int(ref[1:]) for ref in text_refs]
-                for offset in offsets:
+            for arg in raw_args.split(','):
+                if '$' not in arg:
+                    continue
+
+                arg_tokens = find_arg_tokens(arg)
+                text_modifiers = [
+                    modifier for _, _, modifier in arg_tokens if modifier]
+                has_x_modifier = '@x' in text_modifiers
+
+                # Token order only matches the original string search for
+                # canonical 6 digit references; anything else falls back
+                # to searching for the formatted offset.
+                canonical_refs = True
+                for _, digits, _ in arg_tokens:
+                    if digits and (len(digits) != 6 or not digits.isascii()):
+                        canonical_refs = False
+                        break
+
+                for token_idx, (_, digits, _) in enumerate(arg_tokens):
+                    if not digits:
+                        continue
+                    offset = int(digits)
+
                     # If we already saw this offset in the file, just skip
                     if offset in seen_offsets:
                         continue
 
                     # Does this offset have a forced linebreak after it?
-                    # Get the position of the offset in the full cmd line
-                    fmt_off = f"${offset:06}"
-                    offset_pos = arg.find(fmt_off)
                     # If there is a ^ between this offset and the $ of a
                     # subsequent offset, we have a trailing newline.
-                    next_offset_pos = arg.find("$", offset_pos + len(fmt_off))
-                    caret_pos = arg.find("^", offset_pos, next_offset_pos)
-                    has_forced_newline = caret_pos != -1
+                    if canonical_refs:
+                        has_forced_newline = False
+                        for dollar, _, modifier in \
+                                arg_tokens[token_idx + 1:]:
+                            if dollar:
+                                break
+                            if not modifier:
+                                has_forced_newline = True
+                                break
+                    else:
+                        has_forced_newline = cls._arg_has_forced_newline(
+                            arg, offset)
 
                     # Work out whether this line is glued to the previous
                     # line. A line is glued if any of:
@@ -632,112 +1019,181 @@ class TranslationDb:
                     # and NONE of the following are true:
                     #  - The previous text command contains an explicit
                     #    linebreak (^) control code after it
-                    has_x_modifier = '@x' in text_modifiers
                     prev_line_forces_break = (
-                        # Is there a previous line
-                        bool(text_offsets)
-                        # Is it on the same page as this
-                        and text_offsets[-1].page_number == page_number
-                        # Does it contain a forced newline at the end
-                        and text_offsets[-1].has_forced_newline
+                        prev_has_forced_newline
+                        and prev_page_number == page_number
                     )
                     is_glued = (
                         (is_msad or has_x_modifier)
                         and not prev_line_forces_break
                     )
 
-                    # Does the line contain any ruby text?
-                    jp_line = strings_by_content_hash[
-                        content_hash_by_offset[offset]]
-                    jp_text = jp_line.jp_text
-                    has_ruby = '<' in jp_text
-
                     seen_offsets.add(offset)
-                    text_offsets.append(cls.TextCommand(
+                    tokens.append((
                         offset,
-                        content_hash_by_offset[offset],
                         page_number,
-                        has_ruby=has_ruby,
-                        is_glued=is_glued,
-                        is_choice=is_selr,
-                        modifiers=text_modifiers,
-                        has_forced_newline=has_forced_newline
+                        (glued_flag if is_glued else 0) | choice_flag |
+                        (forced_newline_flag if has_forced_newline else 0),
+                        text_modifiers
                     ))
-                    visited_offsets.add(offset)
+                    prev_page_number = page_number
+                    prev_has_forced_newline = has_forced_newline
+
+        return tokens
+
+    @staticmethod
+    def _arg_has_forced_newline(arg, offset):
+        # String search on the formatted offset, for non-canonical
+        # references where token positions may not line up with it
+        fmt_off = f"${offset:06}"
+        offset_pos = arg.find(fmt_off)
+        next_offset_pos = arg.find("$", offset_pos + len(fmt_off))
+        return arg.find("^", offset_pos, next_offset_pos) != -1
+
+    @classmethod
+    def text_commands_from_tokens(cls, tokens, strings_by_content_hash,
+                                  content_hash_by_offset):
+        # Resolve tokenized text commands against the string tables
+        text_offsets = []
+        for offset, page_number, flags, modifiers in tokens:
+            jp_hash = content_hash_by_offset[offset]
+
+            # Does the line contain any ruby text?
+            jp_text = strings_by_content_hash[jp_hash].jp_text
+            has_ruby = '<' in jp_text
+
+            text_offsets.append(cls.TextCommand(
+                offset,
+                jp_hash,
+                page_number,
+                has_ruby=has_ruby,
+                is_glued=bool(flags & cls.TOKEN_GLUED),
+                is_choice=bool(flags & cls.TOKEN_CHOICE),
+                modifiers=modifiers,
+                has_forced_newline=bool(flags & cls.TOKEN_FORCED_NEWLINE)
+            ))
 
         return text_offsets
 
     @classmethod
-    def from_mrg(cls, allscr_path, script_text_path):
-        script_text_mzp = Mzp(script_text_path)
+    def parse_script_cmds(cls, script, strings_by_content_hash,
+                          content_hash_by_offset):
+        return cls.text_commands_from_tokens(
+            cls.tokenize_script(script),
+            strings_by_content_hash,
+            content_hash_by_offset
+        )
 
-        # First script text MZP entry is the string offsets, second is
-        # the string data
-        string_offsets_raw = script_text_mzp.data[0]
-        string_table_raw = script_text_mzp.data[1]
+    # array typecode for a native 32 bit unsigned int
+    _UINT32_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
 
-        # For each 32 bit offset in the offset table, extract the associated
+    @classmethod
+    def decode_string_table(cls, string_offsets_raw, string_table_raw):
+        # Decode the whole big-endian offset table in one pass
+        offsets = array(cls._UINT32_TYPECODE)
+        with memoryview(string_offsets_raw) as offset_table:
+            offsets.frombytes(offset_table[:len(offset_table) // 4 * 4])
+        if sys.byteorder == 'little':
+            offsets.byteswap()
+
+        # For each consecutive pair of offsets, extract the associated
         # JP text
-        offset_count = len(string_offsets_raw) // 4
         strings_by_offset = {}
-        for i in range(offset_count):
-            (data_start,) = struct.unpack('>I', string_offsets_raw[i*4:i*4+4])
-            (data_end,) = struct.unpack(
-                '>I', string_offsets_raw[(i+1)*4:(i+1)*4+4])
+        with memoryview(string_table_raw) as string_table:
+            for i, (data_start, data_end) in enumerate(
+                    zip(offsets, itertools.islice(offsets, 1, None))):
+                # Zero-len string marks end of offset table
+                if data_start == data_end:
+                    break
+
+                # If it's non-zero, extract the associated string data
+                strings_by_offset[i] = str(
+                    string_table[data_start:data_end], 'utf-8')
+
+        return strings_by_offset
 
-            # Zero-len string marks end of offset table
-            if data_start == data_end:
-                break
+    @classmethod
+    def read_script_text_mrg(cls, script_text_path):
+        # Returns (hash of the string table, offset -> JP text)
+        # Map the archive rather than reading it: only a few entries are
+        # needed, and those are sliced out of the mapping on demand. The
+        # slices are released before the archive is unmapped and closed, so
+        # the file isn't held open (and, on Windows, locked) afterwards.
+        with Mzp(script_text_path, use_mmap=True) as script_text_mzp:
+            # First script text MZP entry is the string offsets, second is
+            # the string data
+            with script_text_mzp.data[0] as string_offsets_raw, \
+                    script_text_mzp.data[1] as string_table_raw:
+                string_table_hash = hashlib.sha1(string_offsets_raw)
+                string_table_hash.update(string_table_raw)
+
+                return (
+                    string_table_hash.hexdigest(),
+                    cls.decode_string_table(
+                        string_offsets_raw, string_table_raw)
+                )
 
-            # If it's non-zero, extract the associated string data
-            data = string_table_raw[data_start:data_end]
-            strings_by_offset[i] = data.decode('utf-8')
+    @classmethod
+    def read_allscr_index(cls, allscr_path):
+        # Returns (script names, file (offset, size) span of each script,
+        # hash of each compressed script)
+        with Mzp(allscr_path, use_mmap=True) as allscr_mzp:
+            # Zeroth entry is the script filenames. Each 32 byte chunk is
+            # one string, delete excess \0 chars and arrayize
+            with allscr_mzp.data[0] as script_nam_view:
+                script_nam_raw = bytes(script_nam_view)
+            script_names = [
+                script_nam_raw[i:i + 32].decode('utf-8')
+                .replace('\0', '').strip()
+                for i in range(0, len(script_nam_raw), 32)
+            ]
 
-        # Hash those strings to build initial content table and
+            # Entries 1/2 are unknown, 3+ are the game script files. The
+            # pool workers read them straight from the archive file.
+            script_spans = [
+                allscr_mzp.entry_range(i) for i in range(3, len(allscr_mzp))
+            ]
+            script_hashes = []
+            for i in range(3, len(allscr_mzp)):
+                with allscr_mzp.data[i] as entry:
+                    script_hashes.append(hashlib.sha1(entry).hexdigest())
+
+        return script_names, script_spans, script_hashes
+
+    @classmethod
+    def tokenize_allscr_scripts(cls, allscr_path, script_spans, pool=None):
+        # Decompress and tokenize each script in the pool workers, so
+        # only the compact text command tokens come back
+        if pool is None:
+            with MzxPool() as temp_pool:
+                return temp_pool.map_entries(
+                    cls.tokenize_script, allscr_path, script_spans)
+
+        return pool.map_entries(cls.tokenize_script, allscr_path, script_spans)
+
+    @classmethod
+    def hash_strings(cls, strings_by_offset):
+        # Hash strings to build initial content table and
         # offset -> hash table
         content_hash_by_offset = {}
         strings_by_content_hash = {}
         for offset, jp_text in strings_by_offset.items():
             tl_line = cls.TLLine(jp_text)
-            content_hash_by_offset[offset] = tl_line.content_hash()
-            strings_by_content_hash[tl_line.content_hash()] = tl_line
-
-        # Parse the scene map from allscr
-        allscr_mzp = Mzp(allscr_path)
-
-        # Zeroth entry is the script filenames. Each 32 byte chunk is one
-        # string, delete excess \0 chars and arrayize
-        script_nam_raw = allscr_mzp.data[0]
-        script_names = [
-            script_nam_raw[i:i + 32].decode('utf-8').replace('\0', '').strip()
-            for i in range(0, len(script_nam_raw), 32)
-        ]
+            content_hash = sys.intern(tl_line.content_hash())
+            content_hash_by_offset[offset] = content_hash
+            strings_by_content_hash[content_hash] = tl_line
 
-        # Entries 1/2 are unknown, 3+ are the game script files
-        compressed_script_files = allscr_mzp.data[3:]
+        return content_hash_by_offset, strings_by_content_hash
 
-        # Decompress all the script files
-        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-            decompressed_script_files = pool.map(
-                Mzx.decompress,
-                compressed_script_files
-            )
-
-        # For each scene, extract the list of text offsets
-        scene_map = {}
+    @classmethod
+    def orphaned_commands(cls, scene_map, content_hash_by_offset):
+        # Reparent any text lines that exist but aren't referenced by the
+        # allscr scripts
         visited_offsets = set()
-        for scene_name, script \
-                in zip(script_names, decompressed_script_files):
-            scene_map[scene_name] = cls.parse_script_cmds(
-                script,
-                strings_by_content_hash,
-                content_hash_by_offset
-            )
-            for cmd in scene_map[scene_name]:
+        for scene_commands in scene_map.values():
+            for cmd in scene_commands:
                 visited_offsets.add(cmd.offset)
 
-        # Reparent any text lines that exist but aren't referenced by the
-        # allscr scripts
         orphan_lines = []
         for offset, sha in content_hash_by_offset.items():
             if offset in visited_offsets:
@@ -745,22 +1201,257 @@ class TranslationDb:
 
             orphan_lines.append(cls.TextCommand(offset, sha, -1))
 
-        scene_map['ORPHANED_LINES'] = orphan_lines
+        return orphan_lines
+
+    @classmethod
+    def from_mrg(cls, allscr_path, script_text_path, pool=None):
+        # Script decompression and parsing run on an MzxPool. Pass a
+        # long-lived pool to reuse its worker processes, otherwise a
+        # temporary one is created.
+        string_table_hash, strings_by_offset = \
+            cls.read_script_text_mrg(script_text_path)
+        content_hash_by_offset, strings_by_content_hash = \
+            cls.hash_strings(strings_by_offset)
+
+        # Parse the scene map from allscr
+        script_names, script_spans, script_hashes = \
+            cls.read_allscr_index(allscr_path)
+        script_tokens = cls.tokenize_allscr_scripts(
+            allscr_path, script_spans, pool)
+
+        # For each scene, resolve the text commands against the string
+        # tables
+        scene_map = {}
+        for scene_name, tokens in zip(script_names, script_tokens):
+            scene_map[scene_name] = cls.text_commands_from_tokens(
+                tokens,
+                strings_by_content_hash,
+                content_hash_by_offset
+            )
+
+        scene_map['ORPHANED_LINES'] = cls.orphaned_commands(
+            scene_map, content_hash_by_offset)
+
+        source_hashes = {
+            'string_table': string_table_hash,
+            'scripts': dict(zip(script_names, script_hashes)),
+        }
+
+        return cls(scene_map, strings_by_content_hash, {},
+                   source_hashes=source_hashes)
+
+    class ExtractReport:
+        """
+        Summary of an incremental re-extraction (see update_from_mrg).
+        Offsets are script_text string offsets:
+            - added/removed: offsets that appeared or disappeared
+            - moved: offsets now emitted by a different scene (or
+              none, i.e. orphaned)
+            - changed: offsets whose JP text changed
+        dropped_translations holds the hashes of translated lines whose JP
+        text no longer exists, and dropped_overrides the offsets of
+        overrides whose offset no longer exists. stale_overrides holds the
+        offsets of overrides kept for a changed offset: their JP text is
+        refreshed, but their translation is of the old text.
+        """
+
+        def __init__(self):
+            self.rescanned_scenes = []
+            self.string_table_changed = False
+            self.added = []
+            self.removed = []
+            self.moved = []
+            self.changed = []
+            self.dropped_translations = []
+            self.dropped_overrides = []
+            self.stale_overrides = []
+
+        def __repr__(self):
+            return (
+                f"Rescanned {len(self.rescanned_scenes)} scene(s)"
+                f"{', string table changed' if self.string_table_changed else ''}"
+                f"\n\tAdded offsets: {self.added}"
+                f"\n\tRemoved offsets: {self.removed}"
+                f"\n\tMoved offsets: {self.moved}"
+                f"\n\tChanged offsets: {self.changed}"
+                f"\n\tDropped translations: {self.dropped_translations}"
+                f"\n\tDropped overrides: {self.dropped_overrides}"
+                f"\n\tStale overrides: {self.stale_overrides}"
+            )
+
+    def update_from_mrg(self, allscr_path, script_text_path, pool=None):
+        # Incrementally re-extract the DB from updated MRG files.
+        # Only the scripts whose compressed allscr entry changed since the
+        # last extraction are decompressed and re-parsed; the rest keep
+        # their existing commands. Existing translations, comments and
+        # overrides are carried over. Returns an ExtractReport.
+        # Edit listeners are notified with an 'update_from_mrg' edit.
+        self.materialize()
+        report = self.ExtractReport()
+        old_hashes = self._source_hashes
+        old_scripts = old_hashes.get('scripts', {})
+
+        # Read the archives and parse the dirty scripts without holding
+        # edit_lock, so edits can continue meanwhile
+        string_table_hash, strings_by_offset = \
+            self.read_script_text_mrg(script_text_path)
+        report.string_table_changed = \
+            string_table_hash != old_hashes.get('string_table')
+
+        # Work out which scripts need to be parsed again
+        script_names, script_spans, script_hashes = \
+            self.read_allscr_index(allscr_path)
+        dirty = [
+            i for i, (scene_name, script_hash)
+            in enumerate(zip(script_names, script_hashes))
+            if old_scripts.get(scene_name) != script_hash
+            or scene_name not in self._scene_map
+        ]
+        dirty_tokens = dict(zip(dirty, self.tokenize_allscr_scripts(
+            allscr_path, [script_spans[i] for i in dirty], pool)))
+        report.rescanned_scenes = [script_names[i] for i in dirty]
+
+        # Merge with the current tables and swap the result in, as one edit
+        with self.edit_lock:
+            self._merge_extraction(
+                report, string_table_hash, strings_by_offset,
+                script_names, script_hashes, dirty_tokens)
+            self._notify_edit(
+                'update_from_mrg', allscr_path, script_text_path)
+
+        return report
+
+    def _merge_extraction(self, report, string_table_hash, strings_by_offset,
+                          script_names, script_hashes, dirty_tokens):
+        # Second half of update_from_mrg. Call with edit_lock held.
+        # Where every offset was, before the update
+        old_scene_by_offset = {}
+        old_hash_by_offset = {}
+        for scene_name, scene_commands in self._scene_map.items():
+            for cmd in scene_commands:
+                old_hash_by_offset[cmd.offset] = cmd.jp_hash
+                if scene_name != 'ORPHANED_LINES':
+                    old_scene_by_offset[cmd.offset] = scene_name
+
+        # Reuse the existing line table if the string table is unchanged,
+        # otherwise rebuild it and carry the translations over by hash.
+        if report.string_table_changed:
+            content_hash_by_offset, line_by_hash = \
+                self.hash_strings(strings_by_offset)
+            for jp_hash in line_by_hash:
+                if jp_hash in self._line_by_hash:
+                    line_by_hash[jp_hash] = self._line_by_hash[jp_hash]
+            report.dropped_translations = sorted(
+                jp_hash for jp_hash, line in self._line_by_hash.items()
+                if jp_hash not in line_by_hash and line.en_text
+            )
+        else:
+            content_hash_by_offset = old_hash_by_offset
+            line_by_hash = self._line_by_hash
+
+        scene_map = {}
+        for i, scene_name in enumerate(script_names):
+            if i in dirty_tokens:
+                tokens = dirty_tokens[i]
+            elif report.string_table_changed:
+                # Clean script, but the lines it references may have
+                # changed, so re-resolve its existing commands
+                tokens = [
+                    (cmd.offset, cmd.page_number,
+                     (self.TOKEN_GLUED if cmd.is_glued else 0) |
+                     (self.TOKEN_CHOICE if cmd.is_choice else 0) |
+                     (self.TOKEN_FORCED_NEWLINE
+                      if cmd.has_forced_newline else 0),
+                     cmd.modifiers)
+                    for cmd in self._scene_map[scene_name]
+                ]
+            else:
+                scene_map[scene_name] = self._scene_map[scene_name]
+                continue
+
+            scene_map[scene_name] = self.text_commands_from_tokens(
+                tokens, line_by_hash, content_hash_by_offset)
+
+        scene_map['ORPHANED_LINES'] = self.orphaned_commands(
+            scene_map, content_hash_by_offset)
+
+        # Compare offsets before and after
+        new_scene_by_offset = {}
+        for scene_name, scene_commands in scene_map.items():
+            if scene_name == 'ORPHANED_LINES':
+                continue
+            for cmd in scene_commands:
+                new_scene_by_offset[cmd.offset] = scene_name
+        report.added = sorted(
+            set(content_hash_by_offset) - set(old_hash_by_offset))
+        report.removed = sorted(
+            set(old_hash_by_offset) - set(content_hash_by_offset))
+        report.moved = sorted(
+            offset for offset in content_hash_by_offset
+            if offset in old_hash_by_offset
+            and old_scene_by_offset.get(offset) !=
+            new_scene_by_offset.get(offset)
+        )
+        report.changed = sorted(
+            offset for offset, jp_hash in content_hash_by_offset.items()
+            if offset in old_hash_by_offset
+            and old_hash_by_offset[offset] != jp_hash
+        )
+
+        # Overrides only survive if their offset still exists. Those whose
+        # JP text changed get the new text, but their translation is of the
+        # old one, so they are reported for review.
+        changed = set(report.changed)
+        overrides_by_offset = {}
+        for offset, line in self._overrides_by_offset.items():
+            if offset not in content_hash_by_offset:
+                report.dropped_overrides.append(offset)
+                continue
+            if offset in changed:
+                line = self.TLLine(
+                    strings_by_offset[offset], line.en_text, line.comment)
+                report.stale_overrides.append(offset)
+            overrides_by_offset[offset] = line
+        report.dropped_overrides.sort()
+        report.stale_overrides.sort()
 
-        return cls(scene_map, strings_by_content_hash, {})
+        self._scene_map = scene_map
+        self._invalidate_offset_index()
+        self._line_by_hash = line_by_hash
+        self._overrides_by_offset = overrides_by_offset
+        self._source_hashes = {
+            'string_table': string_table_hash,
+            'scripts': dict(zip(script_names, script_hashes)),
+        }
 
     class TextCommand:
+        # A full game DB holds tens of thousands of these, so keep them
+        # small: no per-instance __dict__, and the hash strings and
+        # modifier tuples are interned so equal values share storage.
+        __slots__ = (
+            'offset', 'jp_hash', 'page_number', 'has_ruby', 'is_glued',
+            'is_choice', 'modifiers', 'has_forced_newline'
+        )
+
+        # Interned modifier tuples
+        _modifiers_by_value = {(): ()}
+
         def __init__(self, offset, jp_hash, page_number, has_ruby=False,
                      is_glued=False, is_choice=False, modifiers=None,
                      has_forced_newline=False):
             self.offset = offset
-            self.jp_hash = jp_hash
+            self.jp_hash = sys.intern(jp_hash)
             self.page_number = page_number
             self.has_ruby = has_ruby
             self.is_glued = is_glued
             self.is_choice = is_choice
-            self.modifiers = modifiers or []
-            self.has_forced_newline = has_forced_newline
+            self.modifiers = self.intern_modifiers(modifiers)
+            self.has_forced_newline = bool(has_forced_newline)
+
+        @classmethod
+        def intern_modifiers(cls, modifiers):
+            modifiers = tuple(modifiers) if modifiers else ()
+            return cls._modifiers_by_value.setdefault(modifiers, modifiers)
 
         def __eq__(self, other):
             # Default impl doesn't work for whatever reason
@@ -804,7 +1495,7 @@ class TranslationDb:
                 ret['is_choice'] = True
 
             if self.modifiers:
-                ret['modifiers'] = self.modifiers
+                ret['modifiers'] = list(self.modifiers)
 
             if self.has_forced_newline:
                 ret['has_forced_newline'] = self.has_forced_newline
@@ -824,6 +1515,132 @@ class TranslationDb:
                 f"{self.has_forced_newline}"
             )
 
+    class ProgressCounters:
+        """
+        Translated/total counters for the DB as a whole and for each scene,
+        updated incrementally as lines and overrides are edited.
+        """
+
+        def __init__(self, tl_db):
+            line_by_hash = tl_db._line_by_hash
+            overrides_by_offset = tl_db._overrides_by_offset
+
+            self._total = len(line_by_hash)
+            self._translated = sum(
+                1 for line in line_by_hash.values() if line.en_text)
+
+            # hash -> {scene: number of its non-overridden commands}, and
+            # offset -> [(scene, hash) of each command emitting it]
+            self._scene_counts_by_hash = {}
+            self._commands_by_offset = {}
+            self._scene_progress = {}
+            for scene_name, scene_commands in tl_db._scene_map.items():
+                offsets, jp_hashes, _, _ = \
+                    tl_db.scene_columns(scene_commands)
+                translated = 0
+                for offset, jp_hash in zip(offsets, jp_hashes):
+                    self._commands_by_offset.setdefault(
+                        offset, []).append((scene_name, jp_hash))
+                    if offset in overrides_by_offset:
+                        line = overrides_by_offset[offset]
+                    else:
+                        line = line_by_hash[jp_hash]
+                        scene_counts = self._scene_counts_by_hash.setdefault(
+                            jp_hash, {})
+                        scene_counts[scene_name] = \
+                            scene_counts.get(scene_name, 0) + 1
+                    if line.en_text:
+                        translated += 1
+                self._scene_progress[scene_name] = (
+                    translated, len(offsets))
+            self._scenes_view = types.MappingProxyType(self._scene_progress)
+
+        def _add_to_scene(self, scene_name, delta):
+            translated, total = self._scene_progress[scene_name]
+            self._scene_progress[scene_name] = (translated + delta, total)
+
+        def line_changed(self, jp_hash, delta):
+            # The line with this hash became translated (+1) or not (-1)
+            self._translated += delta
+            for scene_name, count in \
+                    self._scene_counts_by_hash.get(jp_hash, {}).items():
+                self._add_to_scene(scene_name, delta * count)
+
+        def override_changed(self, offset, is_new_override, delta):
+            # The commands emitting this offset became translated (+1), not
+            # (-1), or stayed the same (0). A new override also stops them
+            # following their hash line.
+            for scene_name, jp_hash in self._commands_by_offset.get(
+                    offset, []):
+                if is_new_override:
+                    self._scene_counts_by_hash[jp_hash][scene_name] -= 1
+                self._add_to_scene(scene_name, delta)
+
+        def summary(self):
+            return {
+                'translated': self._translated,
+                'total': self._total,
+                'scenes': self._scenes_view,
+            }
+
+    class LayoutCache:
+        """
+        The linebroken output of each scene, as of the last generation that
+        laid it out. Entries are keyed on everything the layout reads: the
+        scene's command offsets, pages and glue flags, the text of every
+        line the scene emits (which covers the glue lookahead, as glue never
+        crosses scenes), the charswap and the layout settings.
+        """
+
+        def __init__(self):
+            self._entries = {}
+            self._stats_listeners = []
+            self.last_stats = None
+
+        @staticmethod
+        def key(offsets, page_numbers, glued, texts, charswap_key):
+            return (
+                tuple(offsets), tuple(page_numbers), tuple(glued),
+                tuple(texts), charswap_key,
+                Constants.CHARS_PER_LINE, RubyUtils.ENABLE_PUA_CODES
+            )
+
+        def get(self, scene_name, key):
+            entry = self._entries.get(scene_name)
+            if entry is not None and entry[0] == key:
+                return entry[1]
+            return None
+
+        def put(self, scene_name, key, scene_strings):
+            self._entries[scene_name] = (key, scene_strings)
+
+        def prune(self, scene_names):
+            # Forget scenes which no longer exist
+            for scene_name in list(self._entries):
+                if scene_name not in scene_names:
+                    self._entries.pop(scene_name, None)
+
+        def clear(self):
+            self._entries.clear()
+
+        def add_stats_listener(self, listener):
+            self._stats_listeners.append(listener)
+
+        def remove_stats_listener(self, listener):
+            self._stats_listeners.remove(listener)
+
+        def report(self, scene_count, dirty_scenes):
+            # Stats for one generation:
+            #   {'hits': n, 'misses': n, 'dirty_scenes': [scene names]}
+            stats = {
+                'hits': scene_count - len(dirty_scenes),
+                'misses': len(dirty_scenes),
+                'dirty_scenes': dirty_scenes,
+            }
+            self.last_stats = stats
+            for listener in self._stats_listeners:
+                listener(stats)
+
     class AllscrCmd:
         def __init__(self, opcode, arguments=None):
             # Opcode is the text keyword for this command, e.g. WKST or PGST
@@ -854,6 +1671,8 @@ class TranslationDb:
             }
 
     class TLLine:
+        __slots__ = ('jp_text', 'en_text', 'comment')
+
         def __init__(self, jp_text, en_text=None, comment=None):
             self.jp_text = jp_text
             self.en_text = en_text
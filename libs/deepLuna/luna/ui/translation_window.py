@@ -86,20 +86,14 @@ class TranslationWindow:
             return
 
         # How many lines are actually TLd
-        scene_lines = self._translation_db.lines_for_scene(self._loaded_scene)
-        idx = 0
-        translated_count = 0
-        for line in scene_lines:
-            tl_info = self._translation_db.tl_line_with_hash(line.jp_hash)
-            if tl_info.en_text:
-                translated_count += 1
-            idx += 1
+        translated_count, line_count = \
+            self._translation_db.progress()['scenes'][self._loaded_scene]
 
         # Update UI
         self.percent_translated_day.delete("1.0", tk.END)
         self.percent_translated_day.insert(
             "1.0",
-            str(round(translated_count*100/max(idx, 1), 1))+"%")
+            str(round(translated_count*100/max(line_count, 1), 1))+"%")
         self._name_day.set(self._loaded_scene + ": ")
 
     def on_close(self):
@@ -399,15 +393,12 @@ class TranslationWindow:
             output.write(self._translation_db.as_json().encode('utf-8'))
 
     def insert_translation(self):
-        # Export the script as an MZP
-        mzp_data = self._translation_db.generate_script_text_mrg(
-            perform_charswap=self.var_swapText.get())
-
-        # Write to file
+        # Export the script as an MZP, streaming it straight to the file
         current_time = time.strftime('%Y%m%d-%H%M%S')
         output_filename = f"script_text_translated{current_time}.mrg"
         with open(output_filename, 'wb+') as f:
-            f.write(mzp_data)
+            self._translation_db.write_script_text_mrg(
+                f, perform_charswap=self.var_swapText.get())
 
         print(f"Exported translation to {output_filename}")
 
@@ -6,6 +6,7 @@ import sys
 import time
 
 from luna.constants import Constants
+from luna.mzx_pool import MzxPool
 from luna.translation_db import TranslationDb
 from luna.ruby_utils import RubyUtils
 
@@ -35,7 +36,7 @@ def parse_args():
         '--db-path',
         dest='db_path',
         action='store',
-        help="Path to translation DB file",
+        help="Path to translation DB file (JSON, or .ldb binary or .sqlite)",
         default=Constants.DATABASE_PATH
     )
 
@@ -45,6 +46,13 @@ def parse_args():
         action='store_true',
         help="Regenerate DB from MRG files"
     )
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        action='store_true',
+        help="With --extract-mrg, update the existing DB in place, only "
+             "re-parsing the scripts that changed"
+    )
 
     parser.add_argument(
         '--import',
@@ -95,6 +103,13 @@ def parse_args():
         action='store',
         help="Output path for the injected script text"
     )
+    parser.add_argument(
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help="Number of processes to lay out scenes in when injecting"
+    )
     parser.add_argument(
         '--enable-pua',
         dest='enable_pua',
@@ -290,12 +305,13 @@ def perform_inject(tl_db, args):
     output_filename = \
         args.inject_output or f"script_text_translated{current_time}.mrg"
 
-    # Export the script as an MZP
-    mzp_data = tl_db.generate_script_text_mrg()
-
-    # Write to file
+    # Export the script as an MZP, streaming it straight to the file
     with open(output_filename, 'wb+') as f:
-        f.write(mzp_data)
+        if args.jobs > 1:
+            with MzxPool(args.jobs) as pool:
+                tl_db.write_script_text_mrg(f, pool=pool)
+        else:
+            tl_db.write_script_text_mrg(f)
 
     print(f"Wrote script to '{output_filename}'")
 
@@ -310,7 +326,11 @@ def main():
 
     # Do we need to extract the DB?
     tl_db = None
-    if args.do_extract:
+    if args.do_extract and args.incremental:
+        tl_db = TranslationDb.from_file(args.db_path)
+        report = tl_db.update_from_mrg("allscr.mrg", "script_text.mrg")
+        print(report)
+    elif args.do_extract:
         tl_db = TranslationDb.from_mrg("allscr.mrg", "script_text.mrg")
     else:
         tl_db = TranslationDb.from_file(args.db_path)
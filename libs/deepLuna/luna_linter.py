@@ -1168,6 +1168,12 @@ class LintDupedWord:
 
 
 def paginate(script_cmds):
+    # Columnar scenes can split on their page column directly
+    if hasattr(script_cmds, 'page_spans'):
+        return [
+            script_cmds[start:end] for start, end in script_cmds.page_spans()
+        ]
+
     pages = []
     page_acc = []
     current_page = None
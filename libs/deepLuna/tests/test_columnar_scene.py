@@ -0,0 +1,90 @@
+import pickle
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.columnar_scene import ColumnarScene, SceneTables
+from luna.translation_db import TranslationDb
+
+
+class ColumnarSceneTests(unittest.TestCase):
+
+    TC = TranslationDb.TextCommand
+
+    def setUp(self):
+        self.commands = [
+            self.TC(10, 'a' * 40, 0, modifiers=['@n']),
+            self.TC(11, 'b' * 40, 0, is_glued=True, has_forced_newline=True),
+            self.TC(12, 'a' * 40, 1, has_ruby=True, is_choice=True,
+                    modifiers=['@k', '@e']),
+            self.TC(13, 'c' * 40, 3),
+        ]
+        self.scene = ColumnarScene.from_commands(
+            self.commands, SceneTables(), self.TC)
+
+    def test_views(self):
+        self.assertEqual(len(self.scene), 4)
+        self.assertEqual(list(self.scene), self.commands)
+        self.assertEqual(self.scene, self.commands)
+        self.assertEqual(self.scene[-1], self.commands[-1])
+        self.assertEqual(self.scene[1:3], self.commands[1:3])
+        with self.assertRaises(IndexError):
+            self.scene[4]
+
+    def test_columns(self):
+        self.assertEqual(list(self.scene.offsets), [10, 11, 12, 13])
+        self.assertEqual(list(self.scene.pages), [0, 0, 1, 3])
+        self.assertEqual(self.scene.glued(), [False, True, False, False])
+        self.assertEqual(
+            self.scene.jp_hashes(), [cmd.jp_hash for cmd in self.commands])
+        # Shared values are stored once
+        self.assertEqual(len(self.scene.tables.hashes), 3)
+        self.assertEqual(self.scene.hash_ids[0], self.scene.hash_ids[2])
+
+    def test_large_page_numbers(self):
+        commands = [self.TC(10, 'a' * 40, 40000), self.TC(11, 'b' * 40, 70000)]
+        scene = ColumnarScene.from_commands(commands, SceneTables(), self.TC)
+        self.assertEqual(list(scene), commands)
+
+    def test_page_spans(self):
+        self.assertEqual(self.scene.page_spans(), [(0, 2), (2, 3), (3, 4)])
+        self.assertEqual(ColumnarScene.empty(SceneTables(), self.TC)
+                         .page_spans(), [])
+
+
+class ColumnarDbTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = SyntheticCorpus.translated_db(
+            seed=17, scene_count=6, lines_per_scene=30)
+        cls.columnar_db = TranslationDb.from_binary(
+            cls.db.as_binary(), columnar=True)
+
+    def test_binary_load(self):
+        self.assertEqual(self.columnar_db.as_json(), self.db.as_json())
+        for name in self.db.scene_names(include_empty=True):
+            scene = self.columnar_db.lines_for_scene(name)
+            self.assertEqual(type(scene).__name__, 'ColumnarScene')
+            self.assertEqual(list(scene), self.db.lines_for_scene(name))
+
+    def test_use_columnar_scenes(self):
+        db = TranslationDb.from_binary(self.db.as_binary())
+        db.use_columnar_scenes()
+        self.assertEqual(db.as_json(), self.db.as_json())
+        cmd = self.db.lines_for_scene(self.db.scene_names()[2])[5]
+        self.assertEqual(db.command_for_offset(cmd.offset)[2], cmd)
+
+    def test_script_text_mrg(self):
+        self.assertEqual(
+            self.columnar_db.generate_script_text_mrg(),
+            self.db.generate_script_text_mrg())
+
+    def test_pickle(self):
+        scene_map = self.columnar_db._scene_map
+        unpickled = pickle.loads(pickle.dumps(scene_map))
+        self.assertEqual(
+            {k: list(v) for k, v in unpickled.items()},
+            {k: list(v) for k, v in scene_map.items()})
+        self.assertLess(
+            len(pickle.dumps(scene_map)),
+            len(pickle.dumps(self.db._scene_map)))
@@ -0,0 +1,162 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.journal import DbJournal
+from luna.mrg_parser import Mzp
+from luna.translation_db import TranslationDb
+
+
+class DbJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "db.ldb")
+        self.expected = SyntheticCorpus.translated_db(
+            seed=13, scene_count=4, lines_per_scene=15)
+        self.journal = DbJournal.create(
+            self.path, self.expected, sync_interval=0)
+        self.addCleanup(self.journal.close)
+        self.hashes = list(self.expected._line_by_hash)
+
+    def edit(self, db, i):
+        db.set_translation_and_comment_for_hash(
+            self.hashes[i % len(self.hashes)], f"edit {i}", f"comment {i}")
+
+    def apply_edits(self, count):
+        for i in range(count):
+            self.edit(self.journal.tl_db, i)
+            self.edit(self.expected, i)
+        self.journal.tl_db.override_translation_and_comment_for_offset(
+            3, "override", None)
+        self.expected.override_translation_and_comment_for_offset(
+            3, "override", None)
+
+    def reopen(self):
+        self.journal.close()
+        self.journal = DbJournal(self.path, sync_interval=0)
+        return self.journal.tl_db
+
+    def test_replay(self):
+        self.apply_edits(10)
+        self.assertGreater(os.path.getsize(self.journal.journal_path()), 0)
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+
+        # Edits after a reopen land in the same journal
+        self.edit(self.journal.tl_db, 20)
+        self.edit(self.expected, 20)
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+
+    def test_torn_record_ignored(self):
+        self.apply_edits(5)
+        self.journal.close()
+        journal_path = self.journal.journal_path()
+        intact_size = os.path.getsize(journal_path)
+        with open(journal_path, 'ab') as f:
+            f.write(DbJournal.pack_record(
+                'clear_offset_overrides', ())[:-2])
+
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+        self.assertEqual(os.path.getsize(journal_path), intact_size)
+
+    def test_unapplicable_record_skipped(self):
+        # e.g. an edit to a line that a re-extraction dropped
+        self.apply_edits(5)
+        self.journal.close()
+        with open(self.journal.journal_path(), 'ab') as f:
+            f.write(DbJournal.pack_record(
+                'set_translation_and_comment_for_hash',
+                ("no such hash", "edit", None)))
+            f.write(DbJournal.pack_record(
+                'set_charswap_map', ({'a': 'b'},)))
+        self.expected.set_charswap_map({'a': 'b'})
+
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+
+    def test_compaction(self):
+        self.journal.close()
+        self.journal = DbJournal(
+            self.path, sync_interval=0, compact_threshold=1024)
+        self.apply_edits(50)
+        self.journal.wait_for_compaction()
+
+        self.assertFalse(os.path.exists(self.journal.old_journal_path()))
+        # The snapshot has caught up with (at least) the early edits
+        snapshot = TranslationDb.from_file(self.path)
+        self.assertEqual(
+            snapshot.tl_line_with_hash(self.hashes[0]).en_text, "edit 0")
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+
+    def test_interrupted_compaction(self):
+        # Snapshot written but the old journal left behind: replaying both
+        # journals over the new snapshot gives the same result
+        self.apply_edits(10)
+        self.journal.sync()
+        with open(self.journal.journal_path(), 'rb') as f:
+            old_journal = f.read()
+        self.journal.compact()
+        with open(self.journal.old_journal_path(), 'wb') as f:
+            f.write(old_journal)
+
+        self.edit(self.journal.tl_db, 30)
+        self.edit(self.expected, 30)
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+
+        # The next compaction picks up the leftover journal too
+        self.journal.compact()
+        self.assertFalse(os.path.exists(self.journal.old_journal_path()))
+        self.assertEqual(
+            TranslationDb.from_file(self.path).as_json(),
+            self.expected.as_json())
+
+    def test_update_from_mrg(self):
+        # Re-extraction can't be replayed, so it is snapshotted instead,
+        # and later edits replay over that snapshot
+        allscr_path, script_text_path = SyntheticCorpus.write_game(
+            self.tmpdir.name, seed=6, scene_count=3, lines_per_scene=10)
+        self.journal.close()
+        tl_db = TranslationDb.from_mrg(allscr_path, script_text_path)
+        self.journal = DbJournal.create(self.path, tl_db, sync_interval=0)
+        self.hashes = list(self.journal.tl_db._line_by_hash)
+        self.edit(self.journal.tl_db, 0)
+
+        names, scripts, strings = SyntheticCorpus.game(
+            seed=6, scene_count=3, lines_per_scene=10)
+        strings[1] = "a changed line"
+        with open(script_text_path, 'wb') as f:
+            f.write(Mzp.pack(list(SyntheticCorpus.pack_string_table(strings))))
+        self.journal.tl_db.update_from_mrg(allscr_path, script_text_path)
+        self.assertEqual(os.path.getsize(self.journal.journal_path()), 0)
+
+        jp_hash = self.journal.tl_db.lines_for_scene(names[0])[1].jp_hash
+        self.journal.tl_db.set_translation_and_comment_for_hash(
+            jp_hash, "new line", None)
+        expected = self.journal.tl_db.as_json()
+        self.assertEqual(self.reopen().as_json(), expected)
+
+    def test_interrupted_update_from_mrg(self):
+        # The staged snapshot only replaces the DB once the journal of
+        # edits before the re-extraction is gone
+        self.apply_edits(5)
+        self.journal.close()
+        staged_path = self.journal.staged_snapshot_path()
+        staged = SyntheticCorpus.translated_db(
+            seed=14, scene_count=2, lines_per_scene=5)
+
+        staged.to_file(staged_path, binary=True)
+        with open(self.journal.journal_path(), 'rb') as f:
+            journal = f.read()
+        with open(self.journal.old_journal_path(), 'wb') as f:
+            f.write(journal)
+        self.assertEqual(self.reopen().as_json(), self.expected.as_json())
+        self.assertFalse(os.path.exists(staged_path))
+
+        self.journal.close()
+        staged.to_file(staged_path, binary=True)
+        for path in [self.journal.journal_path(),
+                     self.journal.old_journal_path()]:
+            os.remove(path)
+        self.assertEqual(self.reopen().as_json(), staged.as_json())
+        self.assertFalse(os.path.exists(staged_path))
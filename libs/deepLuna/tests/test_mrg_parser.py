@@ -0,0 +1,99 @@
+import io
+import os
+import tempfile
+import unittest
+
+from luna.mrg_parser import Mzp
+
+
+class MzpTests(unittest.TestCase):
+
+    SECTIONS = [b"first", b"", b"\xff" * 0x900, b"last section"]
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmpdir.name, "test.mrg")
+        with open(self.path, 'wb') as f:
+            f.write(Mzp.pack(self.SECTIONS))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_read(self):
+        mzp = Mzp(self.path)
+        self.assertEqual(mzp.data, self.SECTIONS)
+        self.assertEqual(len(mzp), len(self.SECTIONS))
+        self.assertEqual(list(mzp), self.SECTIONS)
+
+    def test_mmap_matches_read(self):
+        with Mzp(self.path, use_mmap=True) as mzp:
+            self.assertEqual(len(mzp), len(self.SECTIONS))
+            self.assertEqual(len(mzp.data), len(self.SECTIONS))
+            for i, section in enumerate(self.SECTIONS):
+                with mzp[i] as entry:
+                    self.assertIsInstance(entry, memoryview)
+                    self.assertEqual(entry, section)
+
+            entries = mzp.data[1:3]
+            self.assertEqual([bytes(e) for e in entries], self.SECTIONS[1:3])
+            for entry in entries:
+                entry.release()
+
+            entries = list(mzp)
+            self.assertEqual([bytes(e) for e in entries], self.SECTIONS)
+            for entry in entries:
+                entry.release()
+
+    def test_entry_range(self):
+        mzp = Mzp(self.path)
+        with open(self.path, 'rb') as f:
+            raw = f.read()
+        for i, section in enumerate(self.SECTIONS):
+            start, size = mzp.entry_range(i)
+            self.assertEqual(raw[start:start + size], section)
+
+    def test_pack_to_streams_same_archive(self):
+        target = io.BytesIO()
+        written = Mzp.pack_to(iter(self.SECTIONS), target)
+        self.assertEqual(target.getvalue(), Mzp.pack(self.SECTIONS))
+        self.assertEqual(written, len(target.getvalue()))
+        self.assertEqual(written % Mzp.FILE_ALIGNMENT, 0)
+
+    def assert_replaced(self, index, data, in_place):
+        expect = Mzp(self.path).data
+        expect[index] = data
+        size_before = os.path.getsize(self.path)
+        self.assertEqual(Mzp.replace_entry(self.path, index, data), in_place)
+        self.assertEqual(Mzp(self.path).data, expect)
+        self.assertEqual(os.path.getsize(self.path) % Mzp.FILE_ALIGNMENT, 0)
+        if in_place and index != len(self.SECTIONS) - 1:
+            self.assertEqual(os.path.getsize(self.path), size_before)
+
+    def test_replace_entry_in_place(self):
+        self.assert_replaced(0, b"1st", True)
+        self.assert_replaced(2, b"\x00" * 0x900, True)
+
+    def test_replace_entry_fills_alignment_slack(self):
+        # "first" is 5 bytes, so there are 11 bytes of padding to grow into
+        self.assert_replaced(0, b"first entry!", True)
+
+    def test_replace_entry_relocates_tail(self):
+        self.assert_replaced(1, b"now non-empty" * 200, False)
+        self.assert_replaced(0, b"x" * 0x10000, False)
+
+    def test_replace_last_entry(self):
+        self.assert_replaced(3, b"a much longer last section" * 10, True)
+        self.assert_replaced(3, b"", True)
+
+    def test_replace_entry_out_of_range(self):
+        with self.assertRaises(IndexError):
+            Mzp.replace_entry(self.path, len(self.SECTIONS), b"")
+
+    def test_replace_entry_small_chunks(self):
+        # Force the tail move to take several overlapping copies
+        old_chunk_size = Mzp.COPY_CHUNK_SIZE
+        Mzp.COPY_CHUNK_SIZE = 7
+        try:
+            self.assert_replaced(0, b"y" * 100, False)
+        finally:
+            Mzp.COPY_CHUNK_SIZE = old_chunk_size
@@ -0,0 +1,120 @@
+import random
+import struct
+import tempfile
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.mrg_parser import Mzp
+from luna.mzx import Mzx
+
+
+class DecompressTests(unittest.TestCase):
+
+    @staticmethod
+    def stream(decompressed_size, body):
+        return struct.pack("<4sI", b"MZX0", decompressed_size) + body
+
+    def assert_decoders_match(self, data, invert=True):
+        self.assertEqual(
+            Mzx.decompress(data, invert=invert),
+            Mzx.decompress_reference(data, invert=invert)
+        )
+
+    def test_literal(self):
+        data = self.stream(4, bytes([Mzx.CMD_LITERAL | (1 << 2)]) +
+                           bytes([0xBE, 0x9E, 0xBD, 0x9D]))
+        self.assertEqual(Mzx.decompress(data), b"AaBb")
+        self.assert_decoders_match(data)
+
+    def test_overlapping_backref(self):
+        # One literal short, then a backref one short back repeated 4 times
+        data = self.stream(10, bytes([
+            Mzx.CMD_LITERAL, 0xBE, 0xBD,
+            Mzx.CMD_BACKREF | (3 << 2), 0,
+        ]))
+        self.assertEqual(Mzx.decompress(data), b"AB" * 5)
+        self.assert_decoders_match(data)
+
+    def test_rle_and_ringbuf(self):
+        data = self.stream(9, bytes([
+            Mzx.CMD_RLE | (1 << 2),
+            Mzx.CMD_LITERAL | (1 << 2), 0xBE, 0xBD, 0x9E, 0x9D,
+            Mzx.CMD_RINGBUF,
+            Mzx.CMD_RINGBUF | (5 << 2),
+        ]))
+        self.assertEqual(
+            Mzx.decompress(data), b"\xff\xff\xff\xffABabA")
+        self.assert_decoders_match(data)
+
+    def test_no_invert(self):
+        data = self.stream(4, bytes([
+            Mzx.CMD_LITERAL, 0x41, 0x42,
+            Mzx.CMD_BACKREF, 0,
+        ]))
+        self.assertEqual(Mzx.decompress(data, invert=False), b"ABAB")
+        self.assert_decoders_match(data, invert=False)
+
+    def test_backref_before_start(self):
+        data = self.stream(4, bytes([Mzx.CMD_BACKREF, 0]))
+        with self.assertRaises(ValueError):
+            Mzx.decompress(data)
+
+    def test_matches_reference_on_random_streams(self):
+        rng = random.Random(1234)
+        for _ in range(50):
+            data = SyntheticCorpus.mzx_stream(rng, rng.randrange(1, 4096))
+            self.assert_decoders_match(data)
+
+
+class CompressTests(unittest.TestCase):
+
+    def assert_round_trip(self, data, invert=True, level=None):
+        levels = [level] if level is not None else Mzx.COMPRESSION_LEVELS
+        for lvl in levels:
+            compressed = Mzx.compress(data, invert=invert, level=lvl)
+            self.assertEqual(Mzx.decompress(compressed, invert=invert), data)
+            self.assertEqual(
+                Mzx.decompress_reference(compressed, invert=invert), data)
+
+    def test_empty(self):
+        self.assert_round_trip(b"")
+
+    def test_odd_length(self):
+        self.assert_round_trip(b"abcde")
+
+    def test_runs(self):
+        self.assert_round_trip(b"\xff" * 300 + b"ab" * 200 + b"\x00" * 3)
+
+    def test_no_invert(self):
+        self.assert_round_trip(b"\x00\x00" * 10 + b"abcabcabc" * 20,
+                               invert=False)
+
+    def test_random(self):
+        rng = random.Random(5678)
+        for size in [1, 2, 17, 255, 4096]:
+            data = bytes(rng.choice(b"ab\x00\xff") for _ in range(size))
+            self.assert_round_trip(data)
+
+    def test_higher_level_not_worse(self):
+        _, scripts, _ = SyntheticCorpus.game(seed=1, scene_count=4)
+        script = b''.join(scripts)
+        self.assertLessEqual(
+            len(Mzx.compress(script, level=9)),
+            len(Mzx.compress(script, level=0)))
+
+    def test_invalid_level(self):
+        with self.assertRaises(ValueError):
+            Mzx.compress(b"abcd", level=10)
+
+    def test_synthetic_archive_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            allscr_path, _ = SyntheticCorpus.write_game(
+                tmpdir, seed=2, scene_count=12, lines_per_scene=30)
+            _, scripts, _ = SyntheticCorpus.game(
+                seed=2, scene_count=12, lines_per_scene=30)
+
+            allscr = Mzp(allscr_path)
+            self.assertEqual(len(allscr.data) - 3, len(scripts))
+            for compressed, script in zip(allscr.data[3:], scripts):
+                self.assertEqual(Mzx.decompress(compressed), script)
+                self.assert_round_trip(script)
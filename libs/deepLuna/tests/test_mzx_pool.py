@@ -0,0 +1,87 @@
+import tempfile
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.mrg_parser import Mzp
+from luna.mzx import Mzx
+from luna.mzx_pool import MzxPool
+from luna.translation_db import TranslationDb
+
+
+class MzxPoolTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmpdir = tempfile.TemporaryDirectory()
+        cls.allscr_path, cls.script_text_path = SyntheticCorpus.write_game(
+            cls._tmpdir.name, seed=4, scene_count=20, lines_per_scene=20)
+        cls.pool = MzxPool(processes=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls._tmpdir.cleanup()
+
+    def test_matches_serial_decompress(self):
+        expect = [Mzx.decompress(e) for e in Mzp(self.allscr_path).data[3:]]
+        self.assertEqual(
+            self.pool.decompress_mzp(self.allscr_path, first=3), expect)
+
+    def test_parallel_layout(self):
+        tl_db = SyntheticCorpus.translated_db(
+            seed=9, scene_count=12, lines_per_scene=40)
+        tl_db.set_charswap_map({'e': 'E'})
+        for perform_charswap in [False, True]:
+            expect = tl_db.snapshot().generate_linebroken_text_map(
+                perform_charswap)
+            result = tl_db.snapshot().generate_linebroken_text_map(
+                perform_charswap, pool=self.pool)
+            self.assertEqual(list(result.items()), list(expect.items()))
+
+    def test_map_entries(self):
+        scripts = [
+            Mzx.decompress(e) for e in Mzp(self.allscr_path).data[3:]]
+        mzp = Mzp(self.allscr_path)
+        spans = [mzp.entry_range(i) for i in range(3, len(mzp))]
+        self.assertEqual(
+            self.pool.map_entries(
+                TranslationDb.tokenize_script, self.allscr_path, spans),
+            [TranslationDb.tokenize_script(script) for script in scripts])
+
+    def test_spawned_workers(self):
+        expect = [Mzx.decompress(e) for e in Mzp(self.allscr_path).data[3:]]
+        with MzxPool(processes=2, context='spawn') as pool:
+            self.assertEqual(
+                pool.decompress_mzp(self.allscr_path, first=3), expect)
+
+    def test_worker_errors_propagate(self):
+        # The MZP header is not an MZX stream. The decoder's own error must
+        # come back, not a BufferError from cleaning up after it.
+        spans = [(0, 16)]
+        with self.assertRaises(AssertionError):
+            self.pool.map_entries(len, self.allscr_path, spans)
+        with self.assertRaises(AssertionError):
+            self.pool.decompress_entries(self.allscr_path, spans)
+
+    def test_from_mrg_with_pool(self):
+        self.assertEqual(
+            TranslationDb.from_mrg(
+                self.allscr_path, self.script_text_path,
+                pool=self.pool).as_json(),
+            TranslationDb.from_mrg(
+                self.allscr_path, self.script_text_path).as_json())
+
+    def test_pool_reuse(self):
+        first = self.pool.decompress_mzp(self.allscr_path, first=3, last=6)
+        second = self.pool.decompress_mzp(self.allscr_path, first=3, last=6)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(first, second)
+
+    def test_no_entries(self):
+        self.assertEqual(self.pool.decompress_entries(self.allscr_path, []), [])
+
+    def test_chunk_entries(self):
+        entries = list(range(100))
+        chunks = self.pool.chunk_entries(entries, [1] * 100)
+        self.assertEqual(sum(chunks, []), entries)
+        self.assertEqual(len(chunks), 2 * MzxPool.TASKS_PER_WORKER)
@@ -1,5 +1,7 @@
+import random
 import unittest
 
+from benchmarks.synthetic import SyntheticCorpus
 from luna.ruby_utils import RubyUtils
 
 
@@ -111,3 +113,108 @@ class LinebreakTests(unittest.TestCase):
         )
         out_str = RubyUtils.linebreak_text(in_str, 55)
         self.assertEqual(expect_str, out_str)
+
+    def test_linebreak_matches_reference(self):
+        rng = random.Random(23)
+        for _ in range(200):
+            line = SyntheticCorpus.en_layout_line(rng, rng.randrange(1, 80))
+            start = rng.choice([0, 0, 10, 54, 55])
+            self.assertEqual(
+                RubyUtils.linebreak_text(line, 55, start),
+                RubyUtils.linebreak_text_reference(line, 55, start))
+
+
+class ControlCodeTests(unittest.TestCase):
+
+    # Fragments to build lines from, including malformed codes
+    PIECES = [
+        "%{n}", "%{s}", "%{center}", "%{align_right}", "%{nothing}",
+        "%{e_35}", "%{i}", "%{/i}", "%{ri}", "%{/ri}", "%{flip_vertical}",
+        "%{/}", "%{}", "%{x}", "%{", "%{ab%}", "%", "%%", "{", "}",
+        "word", " ", "\n", "\t", "Z!", "あ", "<a|b>",
+    ]
+
+    def setUp(self):
+        self.addCleanup(
+            setattr, RubyUtils, 'ENABLE_PUA_CODES', RubyUtils.ENABLE_PUA_CODES)
+
+    @staticmethod
+    def translate(translator, text, enable_asserts):
+        # The output, or the error raised
+        try:
+            return translator(text, enable_asserts)
+        except (AssertionError, IndexError) as e:
+            return type(e), str(e)
+
+    def test_glyph_regions(self):
+        RubyUtils.ENABLE_PUA_CODES = True
+        self.assertEqual(
+            RubyUtils.apply_control_codes("a %{i}b c%{/i} %{g}d!%{/g}"),
+            "a \ue062 \ue063 \ue1e4\ue1a1")
+        RubyUtils.ENABLE_PUA_CODES = False
+        self.assertEqual(
+            RubyUtils.apply_control_codes("a %{i}b c%{/i} 5%"), "a b c 5")
+
+    def test_nesting_errors(self):
+        RubyUtils.ENABLE_PUA_CODES = True
+        with self.assertRaisesRegex(AssertionError, "Illegal nested g"):
+            RubyUtils.apply_control_codes(
+                "%{i}a%{flip_vertical}", enable_asserts=True)
+        with self.assertRaisesRegex(AssertionError, "Unclosed tag"):
+            RubyUtils.apply_control_codes("%{r}a", enable_asserts=True)
+        with self.assertRaisesRegex(AssertionError, "Unhandled control"):
+            RubyUtils.apply_control_codes("%{bogus}")
+
+    def test_matches_reference(self):
+        rng = random.Random(24)
+        for enable_pua in (False, True):
+            RubyUtils.ENABLE_PUA_CODES = enable_pua
+            for _ in range(2000):
+                text = ''.join(
+                    rng.choice(self.PIECES)
+                    for _ in range(rng.randrange(12)))
+                for enable_asserts in (False, True):
+                    self.assertEqual(
+                        self.translate(
+                            RubyUtils.apply_control_codes,
+                            text, enable_asserts),
+                        self.translate(
+                            RubyUtils.apply_control_codes_reference,
+                            text, enable_asserts),
+                        text)
+
+
+class WidthTests(unittest.TestCase):
+
+    def setUp(self):
+        RubyUtils.set_cache_size(4)
+        self.addCleanup(RubyUtils.set_cache_size, RubyUtils.CACHE_SIZE)
+
+    def test_widths(self):
+        self.assertEqual(RubyUtils.unicode_aware_len("abc"), 3)
+        self.assertEqual(RubyUtils.unicode_aware_len("éĀ"), 2)
+        self.assertEqual(RubyUtils.unicode_aware_len("āあ"), 4)
+        self.assertEqual(RubyUtils.unicode_aware_len("\U0010ffff"), 2)
+        self.assertEqual(RubyUtils.noruby_len("<月姫|つきひめ> moon"), 9)
+        self.assertEqual(
+            RubyUtils.remove_ruby_text("a <b|c d> e"), "a b e")
+
+    def test_stray_midline_still_fails(self):
+        for _ in range(2):
+            with self.assertRaises(AssertionError):
+                RubyUtils.noruby_len("a|b")
+
+    def test_cache_stats(self):
+        for line in ["a", "b", "a", "c", "d", "e", "b"]:
+            RubyUtils.noruby_len(line)
+        stats = RubyUtils.cache_stats()['noruby_len']
+        # "b" was least recently used when "e" came in
+        self.assertEqual((stats['hits'], stats['misses']), (1, 6))
+        self.assertAlmostEqual(stats['hit_rate'], 1 / 7)
+        self.assertEqual((stats['size'], stats['max_size']), (4, 4))
+        self.assertGreaterEqual(stats['compute_seconds'], 0)
+
+        RubyUtils.clear_caches()
+        stats = RubyUtils.cache_stats()['noruby_len']
+        self.assertEqual((stats['hits'], stats['misses']), (0, 0))
+        self.assertIsNone(stats['hit_rate'])
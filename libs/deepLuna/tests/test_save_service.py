@@ -0,0 +1,80 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.save_service import DbSaveService
+from luna.translation_db import TranslationDb
+
+
+class DbSaveServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "db.json")
+        self.db = SyntheticCorpus.translated_db(
+            seed=5, scene_count=3, lines_per_scene=10)
+        self.jp_hash = self.db.lines_for_scene(
+            self.db.scene_names()[0])[0].jp_hash
+
+        # Snapshots block until released, to hold a save in progress
+        self.release = threading.Event()
+        self.snapshots = 0
+
+    def blocking_snapshot(self):
+        self.release.wait()
+        self.snapshots += 1
+        return self.db.snapshot()
+
+    def saved_translation(self):
+        return TranslationDb.from_file(self.path).tl_line_with_hash(
+            self.jp_hash).en_text
+
+    def test_save(self):
+        saver = DbSaveService(self.path, self.db.snapshot)
+        self.assertIsNone(saver.status()['last_finished'])
+        saver.save()
+        self.assertEqual(TranslationDb.from_file(self.path).as_json(),
+                         self.db.as_json())
+        self.assertEqual(os.listdir(self.tmpdir.name), ["db.json"])
+
+        status = saver.status()
+        self.assertFalse(status['saving'])
+        self.assertEqual(status['save_count'], 1)
+        self.assertIsNotNone(status['last_finished'])
+        self.assertGreaterEqual(status['last_duration'], 0)
+
+    def test_requests_coalesce(self):
+        saver = DbSaveService(self.path, self.blocking_snapshot)
+        first = saver.request_save()
+        self.assertTrue(saver.status()['saving'])
+
+        # Requests during the save fold into a single follow-up, which
+        # sees the edits made in the meantime
+        self.db.set_translation_and_comment_for_hash(
+            self.jp_hash, "latest", None)
+        tickets = {saver.request_save() for _ in range(5)}
+        self.assertEqual(tickets, {first + 1})
+        self.assertTrue(saver.status()['pending'])
+
+        self.release.set()
+        saver.wait(first + 1)
+        self.assertEqual(self.snapshots, 2)
+        self.assertEqual(saver.status()['save_count'], 2)
+        self.assertEqual(self.saved_translation(), "latest")
+
+    def test_failed_save_keeps_previous_file(self):
+        DbSaveService(self.path, self.db.snapshot).save()
+
+        def broken_snapshot():
+            raise RuntimeError("snapshot failed")
+
+        saver = DbSaveService(self.path, broken_snapshot)
+        with self.assertRaises(RuntimeError):
+            saver.save()
+        self.assertEqual(saver.status()['last_error'], "snapshot failed")
+        self.assertEqual(saver.status()['save_count'], 0)
+        self.assertEqual(TranslationDb.from_file(self.path).as_json(),
+                         self.db.as_json())
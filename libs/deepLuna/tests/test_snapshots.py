@@ -0,0 +1,121 @@
+import sys
+import threading
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.translation_db import TranslationDb
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SyntheticCorpus.translated_db(
+            seed=17, scene_count=4, lines_per_scene=40)
+        self.cmds = self.db.lines_for_scene(self.db.scene_names()[0])
+
+    def test_snapshot_is_frozen(self):
+        before = self.db.as_json()
+        snapshot = self.db.snapshot()
+        # Nothing is copied until the next edit
+        self.assertIs(snapshot._line_by_hash, self.db._line_by_hash)
+
+        self.db.set_translation_and_comment_for_hash(
+            self.cmds[0].jp_hash, "edited", None)
+        self.db.override_translation_and_comment_for_offset(
+            self.cmds[1].offset, "override", None)
+        self.db.set_charswap_map({'a': 'b'})
+        self.assertIsNot(snapshot._line_by_hash, self.db._line_by_hash)
+        self.assertEqual(snapshot.as_json(), before)
+        self.assertEqual(
+            self.db.tl_line_with_hash(self.cmds[0].jp_hash).en_text, "edited")
+
+        # Edits to a snapshot don't leak back either
+        snapshot.set_translation_and_comment_for_hash(
+            self.cmds[2].jp_hash, "snapshot edit", None)
+        self.assertNotEqual(
+            self.db.tl_line_with_hash(self.cmds[2].jp_hash).en_text,
+            "snapshot edit")
+
+    def test_snapshot_keeps_subclass(self):
+        class CustomDb(TranslationDb):
+            pass
+
+        db = CustomDb(
+            self.db._scene_map, self.db._line_by_hash,
+            self.db._overrides_by_offset)
+        self.assertIsInstance(db.snapshot(), CustomDb)
+
+    def test_concurrent_readers_and_writers(self):
+        # One writer retranslates a group of lines, one round at a time,
+        # while another churns overrides elsewhere. Readers generate from
+        # snapshots with no lock held, and must always see whole rounds.
+        group = sorted({cmd.jp_hash for cmd in self.cmds})
+        override_offsets = [
+            cmd.offset
+            for name in self.db.scene_names()[1:]
+            for cmd in self.db.lines_for_scene(name)
+        ][:50]
+        for jp_hash in group:
+            self.db.set_translation_and_comment_for_hash(
+                jp_hash, "round -1", None)
+        reads_per_reader = 20
+        reads = []
+        done = threading.Event()
+        errors = []
+
+        # Switch threads often, so reads overlap with rounds of edits
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def group_writer():
+            i = 0
+            while len(reads) < 2 * reads_per_reader and not errors:
+                with self.db.edit_lock:
+                    for jp_hash in group:
+                        self.db.set_translation_and_comment_for_hash(
+                            jp_hash, f"round {i}", None)
+                i += 1
+            return i
+
+        def override_writer():
+            i = 0
+            while not done.is_set():
+                for offset in override_offsets:
+                    self.db.override_translation_and_comment_for_offset(
+                        offset, f"override {i}", None)
+                self.db.clear_offset_overrides()
+                i += 1
+
+        def reader():
+            try:
+                for _ in range(reads_per_reader):
+                    snapshot = self.db.snapshot()
+                    texts = {
+                        snapshot.tl_line_with_hash(h).en_text for h in group
+                    }
+                    self.assertEqual(len(texts), 1)
+                    snapshot.generate_script_text_mrg()
+                    self.assertEqual(texts, {
+                        snapshot.tl_line_with_hash(h).en_text for h in group
+                    })
+                    self.db.generate_linebroken_text_map()
+                    reads.append(1)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=override_writer)] + [
+            threading.Thread(target=reader) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        try:
+            rounds = group_writer()
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            {self.db.tl_line_with_hash(h).en_text for h in group},
+            {f"round {rounds - 1}"})
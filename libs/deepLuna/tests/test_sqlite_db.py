@@ -0,0 +1,203 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from benchmarks.synthetic import SyntheticCorpus
+from luna.sqlite_db import SqliteTranslationDb
+from luna.translation_db import TranslationDb
+
+
+class SqliteDbTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "db.sqlite")
+        self.mem_db = SyntheticCorpus.translated_db(
+            seed=11, scene_count=5, lines_per_scene=20)
+        self.mem_db.set_charswap_map({'a': 'b'})
+        self.db = SqliteTranslationDb.from_translation_db(
+            self.path, self.mem_db)
+        self.addCleanup(self.db.close)
+
+    def reopen(self):
+        self.db.close()
+        self.db = SqliteTranslationDb(self.path)
+        return self.db
+
+    def test_json_round_trip(self):
+        self.assertEqual(self.db.as_json(), self.mem_db.as_json())
+        self.assertEqual(self.reopen().as_json(), self.mem_db.as_json())
+
+    def test_queries(self):
+        self.assertEqual(self.db.scene_names(), self.mem_db.scene_names())
+        for name in self.mem_db.scene_names(include_empty=True):
+            cmds = self.db.lines_for_scene(name)
+            self.assertEqual(cmds, self.mem_db.lines_for_scene(name))
+            for cmd in cmds:
+                self.assertEqual(
+                    self.db.tl_line_for_cmd(cmd).as_json(),
+                    self.mem_db.tl_line_for_cmd(cmd).as_json())
+                self.assertEqual(
+                    self.db.tl_line_for_offset(cmd.offset),
+                    self.mem_db.tl_line_for_offset(cmd.offset))
+                self.assertEqual(
+                    self.db.command_for_offset(cmd.offset),
+                    self.mem_db.command_for_offset(cmd.offset))
+                self.assertEqual(
+                    self.db.offsets_for_hash(cmd.jp_hash),
+                    self.mem_db.offsets_for_hash(cmd.jp_hash))
+        self.assertIsNone(self.db.command_for_offset(1 << 30))
+        self.assertAlmostEqual(
+            self.db.translated_percent(), self.mem_db.translated_percent())
+
+    def test_progress(self):
+        cmds = self.db.lines_for_scene(self.db.scene_names()[1])
+        for db in [self.db, self.mem_db]:
+            db.override_translation_and_comment_for_offset(
+                cmds[0].offset, None, None)
+            db.override_translation_and_comment_for_offset(
+                cmds[1].offset, "override", None)
+            db.set_translation_and_comment_for_hash(
+                cmds[2].jp_hash, "", None)
+
+        progress = self.db.progress()
+        mem_progress = self.mem_db.progress()
+        self.assertEqual(
+            (progress['translated'], progress['total']),
+            (mem_progress['translated'], mem_progress['total']))
+        self.assertEqual(
+            dict(progress['scenes']), dict(mem_progress['scenes']))
+
+    def test_set_translation_persists(self):
+        cmd = self.db.lines_for_scene(self.db.scene_names()[0])[0]
+        self.db.set_translation_and_comment_for_hash(
+            cmd.jp_hash, "new tl", "a comment")
+        line = self.reopen().tl_line_with_hash(cmd.jp_hash)
+        self.assertEqual((line.en_text, line.comment), ("new tl", "a comment"))
+
+    def test_set_translation_unknown_hash(self):
+        with self.assertRaises(KeyError):
+            self.db.set_translation_and_comment_for_hash('0' * 40, "x", None)
+
+    def test_overrides(self):
+        cmd = self.db.lines_for_scene(self.db.scene_names()[1])[2]
+        self.db.clear_offset_overrides()
+        self.db.override_translation_and_comment_for_offset(
+            cmd.offset, "override", None)
+        self.mem_db.clear_offset_overrides()
+        self.mem_db.override_translation_and_comment_for_offset(
+            cmd.offset, "override", None)
+        self.db.override_translation_and_comment_for_offset(
+            cmd.offset, "override 2", "c")
+        self.mem_db.override_translation_and_comment_for_offset(
+            cmd.offset, "override 2", "c")
+
+        self.assertEqual(
+            self.reopen().tl_override_for_offset(cmd.offset).as_json(),
+            self.mem_db.tl_override_for_offset(cmd.offset).as_json())
+        self.assertEqual(self.db.as_json(), self.mem_db.as_json())
+
+    def test_script_text_mrg(self):
+        self.assertEqual(
+            self.db.generate_script_text_mrg(perform_charswap=True),
+            self.mem_db.generate_script_text_mrg(perform_charswap=True))
+
+    def test_batch_rollback(self):
+        cmd = self.db.lines_for_scene(self.db.scene_names()[0])[0]
+        before = self.db.tl_line_with_hash(cmd.jp_hash).en_text
+        with self.assertRaises(KeyError):
+            with self.db.batch():
+                self.db.set_translation_and_comment_for_hash(
+                    cmd.jp_hash, "rolled back", None)
+                self.db.set_translation_and_comment_for_hash(
+                    '0' * 40, "x", None)
+        self.assertEqual(self.db.tl_line_with_hash(cmd.jp_hash).en_text, before)
+
+    def test_file_formats(self):
+        json_path = os.path.join(self.tmpdir.name, "db.json")
+        self.db.to_file(json_path)
+        with open(json_path, 'rb') as f:
+            self.assertEqual(json.loads(f.read()), json.loads(
+                self.mem_db.as_json()))
+
+        # Saving onto itself is a no-op, loading sniffs the format
+        self.db.to_file(self.path)
+        loaded = TranslationDb.from_file(self.path)
+        self.addCleanup(loaded.close)
+        self.assertEqual(type(loaded).__name__, "SqliteTranslationDb")
+        self.assertEqual(loaded.as_json(), self.mem_db.as_json())
+
+        imported_path = os.path.join(self.tmpdir.name, "imported.sqlite")
+        with SqliteTranslationDb.import_file(imported_path, json_path) as db:
+            self.assertEqual(db.as_json(), self.mem_db.as_json())
+
+        exported_path = os.path.join(self.tmpdir.name, "exported.sqlite")
+        self.mem_db.to_file(exported_path)
+        with SqliteTranslationDb(exported_path) as db:
+            self.assertEqual(db.as_json(), self.mem_db.as_json())
+
+    def test_base_state(self):
+        # Base class methods can rely on the base class state
+        self.assertFalse(self.db._shared)
+        self.assertIs(self.db.edit_lock, self.db._lock)
+        self.assertEqual(
+            self.db.command_for_offset(0), self.mem_db.command_for_offset(0))
+
+    def test_edits_notify_under_lock(self):
+        # Listeners must see edits in commit order: no other edit can get
+        # in between an edit's write and its notification
+        held = []
+
+        def try_acquire():
+            acquired = self.db.edit_lock.acquire(timeout=0)
+            if acquired:
+                self.db.edit_lock.release()
+            held.append(not acquired)
+
+        def listener(edit, args):
+            acquire = threading.Thread(target=try_acquire)
+            acquire.start()
+            acquire.join()
+
+        self.db.add_edit_listener(listener)
+        jp_hash = next(iter(self.mem_db._line_by_hash))
+        self.db.set_translation_and_comment_for_hash(jp_hash, "x", None)
+        self.db.clear_offset_overrides()
+        self.db.set_charswap_map({'c': 'd'})
+        self.assertEqual(held, [True] * 3)
+
+    def test_charswap_map_shared_between_connections(self):
+        other = SqliteTranslationDb(self.path)
+        self.addCleanup(other.close)
+        other.set_charswap_map({'c': 'd'})
+        self.assertEqual(self.db.get_charswap_map(), {'c': 'd'})
+        self.assertEqual(
+            json.loads(self.db.as_json())['charswap_map'], {'c': 'd'})
+
+    def test_snapshot(self):
+        # A read transaction rather than a copy: later edits don't show
+        before = self.db.as_json()
+        snapshot = self.db.snapshot()
+        self.addCleanup(snapshot.close)
+        self.assertIsInstance(snapshot, SqliteTranslationDb)
+
+        jp_hash = next(iter(self.mem_db._line_by_hash))
+        self.db.set_translation_and_comment_for_hash(jp_hash, "edited", None)
+        self.db.set_charswap_map({'c': 'd'})
+        self.assertEqual(snapshot.as_json(), before)
+        self.assertNotEqual(self.db.as_json(), before)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            snapshot.set_translation_and_comment_for_hash(
+                jp_hash, "snapshot edit", None)
+
+    def test_import_is_not_an_edit(self):
+        edits = []
+        self.db.add_edit_listener(lambda *edit: edits.append(edit))
+        self.db._replace_contents(self.mem_db)
+        self.assertEqual(edits, [])
+        self.assertEqual(self.reopen().get_charswap_map(), {'a': 'b'})
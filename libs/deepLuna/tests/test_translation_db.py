@@ -1,6 +1,16 @@
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
 import unittest
 from collections import defaultdict
 
+from benchmarks.synthetic import SyntheticCorpus
+from luna.db_format import BinaryDbFormat
+from luna.mrg_parser import Mzp
+from luna.mzx import Mzx
 from luna.translation_db import TranslationDb
 
 
@@ -69,6 +79,36 @@ class LinebreakTests(unittest.TestCase):
             ]
         )
 
+    def test_choice_and_page(self):
+        self.assert_parse_match(
+            "_PGST(3);_SELR(0,$000010,$000011@n);_WKST(1);",
+            [
+                self.TC(10, self.HASH, 3, is_choice=True),
+                self.TC(11, self.HASH, 3, is_choice=True, modifiers=["@n"]),
+            ]
+        )
+
+    def test_trailing_caret_not_forced_newline(self):
+        # A ^ as the final character of the argument is not picked up
+        self.assert_parse_match(
+            "_MSAD($000010^);_MSAD($000011);",
+            [
+                self.TC(10, self.HASH, 0, is_glued=True),
+                self.TC(11, self.HASH, 0, is_glued=True),
+            ]
+        )
+
+    def test_tokenize_script(self):
+        self.assertEqual(
+            TranslationDb.tokenize_script(
+                b"_ZMbc419($043897^$043898@n);_MSAD($014370);"),
+            [
+                (43897, 0, TranslationDb.TOKEN_FORCED_NEWLINE, ["@n"]),
+                (43898, 0, 0, ["@n"]),
+                (14370, 0, TranslationDb.TOKEN_GLUED, []),
+            ]
+        )
+
     def mock_db(self, lines, cmds):
         scene_map = {'test_scene': cmds}
         line_by_hash = {line.content_hash(): line for line in lines}
@@ -269,3 +309,485 @@ class LinebreakTests(unittest.TestCase):
         }
         result = db.generate_linebroken_text_map()
         self.assertEqual(result, expect)
+
+
+class StringTableTests(unittest.TestCase):
+
+    def test_decode_string_table(self):
+        strings = ["月姫\r\n", "a", "<遠野|とおの>\r\n", "b"]
+        offsets_raw, table_raw = SyntheticCorpus.pack_string_table(strings)
+        self.assertEqual(
+            TranslationDb.decode_string_table(offsets_raw, table_raw),
+            dict(enumerate(strings)))
+
+    def test_decode_string_table_stops_at_empty(self):
+        offsets_raw = struct.pack(">5I", 0, 1, 1, 2, 3)
+        self.assertEqual(
+            TranslationDb.decode_string_table(offsets_raw, b"abc"),
+            {0: "a"})
+
+
+class FromMrgTests(unittest.TestCase):
+
+    GAME_ARGS = dict(seed=3, scene_count=8, lines_per_scene=25)
+
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = SyntheticCorpus.write_game(tmpdir, **cls.GAME_ARGS)
+            cls.db = TranslationDb.from_mrg(*paths)
+        cls.names, cls.scripts, cls.strings = \
+            SyntheticCorpus.game(**cls.GAME_ARGS)
+
+    def test_scene_names(self):
+        self.assertEqual(
+            self.db.scene_names(include_empty=True),
+            self.names + ['ORPHANED_LINES'])
+
+    def test_lines(self):
+        lines = {
+            TranslationDb.TLLine(jp).content_hash(): jp
+            for jp in self.strings
+        }
+        self.assertEqual(
+            {h: self.db.tl_line_with_hash(h).jp_text for h in lines}, lines)
+
+    def test_scene_commands(self):
+        content_hash_by_offset = {
+            i: TranslationDb.TLLine(jp).content_hash()
+            for i, jp in enumerate(self.strings)
+        }
+        strings_by_content_hash = {
+            TranslationDb.TLLine(jp).content_hash(): TranslationDb.TLLine(jp)
+            for jp in self.strings
+        }
+        for name, script in zip(self.names, self.scripts):
+            self.assertEqual(
+                self.db.lines_for_scene(name),
+                TranslationDb.parse_script_cmds(
+                    script, strings_by_content_hash, content_hash_by_offset)
+            )
+
+        orphans = self.db.lines_for_scene('ORPHANED_LINES')
+        self.assertEqual(
+            [cmd.offset for cmd in orphans],
+            list(range(len(self.names) * 25, len(self.strings))))
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_archives_closed(self):
+        # The archives are memory-mapped while reading. Nothing may keep
+        # them open afterwards, as that locks them on Windows.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = SyntheticCorpus.write_game(tmpdir, **self.GAME_ARGS)
+            TranslationDb.read_script_text_mrg(paths[1])
+            TranslationDb.read_allscr_index(paths[0])
+            open_paths = {
+                os.path.realpath(os.path.join('/proc/self/fd', fd))
+                for fd in os.listdir('/proc/self/fd')
+            }
+            for path in paths:
+                self.assertNotIn(os.path.realpath(path), open_paths)
+
+    def test_write_script_text_mrg(self):
+        target = io.BytesIO()
+        self.db.write_script_text_mrg(target)
+        self.assertEqual(target.getvalue(), self.db.generate_script_text_mrg())
+
+
+class UpdateFromMrgTests(unittest.TestCase):
+
+    GAME_ARGS = dict(seed=5, scene_count=6, lines_per_scene=10)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.allscr_path, self.script_text_path = \
+            SyntheticCorpus.write_game(self.tmpdir.name, **self.GAME_ARGS)
+        self.names, self.scripts, self.strings = \
+            SyntheticCorpus.game(**self.GAME_ARGS)
+        self.db = TranslationDb.from_mrg(
+            self.allscr_path, self.script_text_path)
+
+    def replace_script(self, scene_idx, script):
+        Mzp.replace_entry(
+            self.allscr_path, 3 + scene_idx, Mzx.compress(script, level=1))
+
+    def assert_matches_full_extract(self):
+        full = TranslationDb.from_mrg(self.allscr_path, self.script_text_path)
+        self.assertEqual(
+            self.db.get_source_hashes(), full.get_source_hashes())
+        for name in full.scene_names(include_empty=True):
+            self.assertEqual(
+                self.db.lines_for_scene(name), full.lines_for_scene(name))
+
+    def test_source_hashes_round_trip(self):
+        hashes = self.db.get_source_hashes()
+        self.assertEqual(list(hashes['scripts']), self.names)
+        loaded = TranslationDb.from_json(json.loads(self.db.as_json()))
+        self.assertEqual(loaded.get_source_hashes(), hashes)
+
+    def test_unchanged(self):
+        scene_map = {
+            name: self.db.lines_for_scene(name) for name in self.names
+        }
+        report = self.db.update_from_mrg(
+            self.allscr_path, self.script_text_path)
+        self.assertEqual(report.rescanned_scenes, [])
+        self.assertFalse(report.string_table_changed)
+        for name in self.names:
+            self.assertIs(self.db.lines_for_scene(name), scene_map[name])
+
+    def test_changed_script(self):
+        # Move the first line of scene 1 into scene 0, and drop one line
+        # of scene 1 so it is orphaned
+        moved_offset = 10
+        removed_offset = 11
+        self.replace_script(
+            0, self.scripts[0] + f"_MSAD(${moved_offset:06d});".encode('utf-8'))
+        self.replace_script(1, self.scripts[1].replace(
+            f"${moved_offset:06d}".encode('utf-8'), b'').replace(
+            f"${removed_offset:06d}".encode('utf-8'), b''))
+
+        jp_hash = self.db.lines_for_scene(self.names[1])[0].jp_hash
+        self.db.set_translation_and_comment_for_hash(jp_hash, "kept", None)
+
+        self.assertEqual(
+            self.db.command_for_offset(moved_offset)[0], self.names[1])
+        report = self.db.update_from_mrg(
+            self.allscr_path, self.script_text_path)
+        self.assertEqual(
+            self.db.command_for_offset(moved_offset)[0], self.names[0])
+        self.assertEqual(report.rescanned_scenes, self.names[:2])
+        self.assertEqual(report.moved, [moved_offset, removed_offset])
+        self.assertEqual(report.added, [])
+        self.assertEqual(report.removed, [])
+        self.assertEqual(self.db.tl_line_with_hash(jp_hash).en_text, "kept")
+        self.assert_matches_full_extract()
+
+    def test_changed_string_table(self):
+        strings = list(self.strings)
+        strings[3] = "a changed line"
+        with open(self.script_text_path, 'wb') as f:
+            f.write(Mzp.pack(list(SyntheticCorpus.pack_string_table(strings))))
+
+        old_hash = self.db.lines_for_scene(self.names[0])[3].jp_hash
+        self.db.set_translation_and_comment_for_hash(old_hash, "gone", None)
+
+        self.db.override_translation_and_comment_for_offset(
+            3, "override", None)
+        edits = []
+        self.db.add_edit_listener(lambda *edit: edits.append(edit))
+
+        report = self.db.update_from_mrg(
+            self.allscr_path, self.script_text_path)
+        self.assertTrue(report.string_table_changed)
+        self.assertEqual(report.rescanned_scenes, [])
+        self.assertEqual(report.changed, [3])
+        self.assertEqual(report.dropped_translations, [old_hash])
+        self.assertEqual(edits, [(
+            'update_from_mrg', (self.allscr_path, self.script_text_path))])
+
+        # The override is kept, with the new JP text, and flagged
+        self.assertEqual(report.stale_overrides, [3])
+        override = self.db.tl_override_for_offset(3)
+        self.assertEqual(
+            (override.jp_text, override.en_text),
+            ("a changed line", "override"))
+        self.db.clear_offset_overrides()
+        self.assert_matches_full_extract()
+
+
+class OffsetIndexTests(unittest.TestCase):
+
+    TC = TranslationDb.TextCommand
+
+    def setUp(self):
+        self.db = TranslationDb(
+            {
+                'A': [self.TC(0, 'x', 0), self.TC(1, 'y', 0)],
+                'B': [self.TC(2, 'x', 0), self.TC(1, 'y', 1)],
+                'ORPHANED_LINES': [self.TC(3, 'z', -1)],
+            },
+            {h: TranslationDb.TLLine(h) for h in 'xyz'},
+            {}
+        )
+
+    def test_command_for_offset(self):
+        self.assertEqual(
+            self.db.command_for_offset(2), ('B', 0, self.TC(2, 'x', 0)))
+        # First scene wins, as with the old linear scan
+        self.assertEqual(
+            self.db.command_for_offset(1), ('A', 1, self.TC(1, 'y', 0)))
+        self.assertEqual(self.db.tl_line_for_offset(3), 'z')
+        self.assertIsNone(self.db.command_for_offset(4))
+        self.assertIsNone(self.db.tl_line_for_offset(4))
+
+    def test_offsets_for_hash(self):
+        self.assertEqual(self.db.offsets_for_hash('x'), [0, 2])
+        self.assertEqual(self.db.offsets_for_hash('y'), [1])
+        self.assertEqual(self.db.offsets_for_hash('missing'), [])
+
+    def test_override_uses_index(self):
+        self.db.override_translation_and_comment_for_offset(2, "tl", None)
+        self.assertEqual(self.db.tl_override_for_offset(2).jp_text, 'x')
+        self.db.clear_offset_overrides()
+        self.assertEqual(self.db.offsets_for_hash('x'), [0, 2])
+        self.assertIsNone(self.db.tl_override_for_offset(2))
+
+
+class ProgressTests(unittest.TestCase):
+
+    TC = TranslationDb.TextCommand
+
+    def setUp(self):
+        self.db = TranslationDb(
+            {
+                'A': [self.TC(0, 'x', 0), self.TC(1, 'y', 0),
+                      self.TC(4, 'x', 0)],
+                'B': [self.TC(2, 'x', 0), self.TC(1, 'y', 1)],
+                'ORPHANED_LINES': [self.TC(3, 'z', -1)],
+            },
+            {h: TranslationDb.TLLine(h) for h in 'xyz'},
+            {}
+        )
+
+    def recount(self):
+        # Progress computed from scratch, to check the counters against
+        db = self.db
+        scenes = {}
+        for scene_name in db.scene_names(include_empty=True):
+            cmds = db.lines_for_scene(scene_name)
+            scenes[scene_name] = (
+                sum(1 for cmd in cmds if db.tl_line_for_cmd(cmd).en_text),
+                len(cmds))
+        lines = [db.tl_line_with_hash(h) for h in 'xyz']
+        return {
+            'translated': sum(1 for line in lines if line.en_text),
+            'total': len(lines),
+            'scenes': scenes,
+        }
+
+    def assertCounted(self):
+        progress = self.db.progress()
+        self.assertEqual(
+            dict(progress, scenes=dict(progress['scenes'])), self.recount())
+
+    def test_initial(self):
+        self.assertEqual(self.db.progress()['scenes']['A'], (0, 3))
+        self.assertCounted()
+        self.assertEqual(self.db.translated_percent(), 0.0)
+
+    def test_set_translation(self):
+        self.db.progress()
+        self.db.set_translation_and_comment_for_hash('x', "x tl", None)
+        self.assertEqual(self.db.progress()['scenes']['A'], (2, 3))
+        self.assertCounted()
+        # Re-translating is not counted twice, clearing is
+        self.db.set_translation_and_comment_for_hash('x', "x tl 2", None)
+        self.assertCounted()
+        self.db.set_translation_and_comment_for_hash('x', "", None)
+        self.assertCounted()
+
+    def test_overrides(self):
+        self.db.progress()
+        self.db.override_translation_and_comment_for_offset(1, "y tl", None)
+        self.assertEqual(self.db.progress()['scenes']['B'], (1, 2))
+        self.assertCounted()
+
+        # Overridden commands no longer follow their hash line
+        self.db.set_translation_and_comment_for_hash('y', "y tl", None)
+        self.db.set_translation_and_comment_for_hash('y', None, None)
+        self.assertCounted()
+        self.db.override_translation_and_comment_for_offset(1, None, None)
+        self.assertCounted()
+
+        self.db.set_translation_and_comment_for_hash('x', "x tl", None)
+        self.db.override_translation_and_comment_for_offset(4, "", None)
+        self.assertCounted()
+        self.db.clear_offset_overrides()
+        self.assertCounted()
+
+
+class LayoutCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SyntheticCorpus.translated_db(
+            seed=19, scene_count=6, lines_per_scene=30)
+        self.db.set_charswap_map({'e': 'E'})
+        self.stats = []
+        self.db.add_layout_stats_listener(self.stats.append)
+
+    def assertFresh(self, perform_charswap=False):
+        # Matches an uncached generation
+        self.assertEqual(
+            self.db.generate_linebroken_text_map(perform_charswap),
+            self.db.snapshot().generate_linebroken_text_map(perform_charswap))
+
+    def test_unchanged_scenes_hit(self):
+        self.assertFresh()
+        scene_count = len(self.db.scene_names(include_empty=True))
+        self.assertEqual(self.stats[-1]['misses'], scene_count)
+        self.assertFresh()
+        self.assertEqual(self.stats[-1]['hits'], scene_count)
+
+    def test_edits_dirty_their_scenes(self):
+        self.assertFresh()
+        scene_name = self.db.scene_names()[2]
+        cmd = self.db.lines_for_scene(scene_name)[4]
+        scenes_with_hash = {
+            self.db.command_for_offset(offset)[0]
+            for offset in self.db.offsets_for_hash(cmd.jp_hash)
+        }
+
+        self.db.set_translation_and_comment_for_hash(
+            cmd.jp_hash, "A new translation", None)
+        self.assertFresh()
+        self.assertEqual(set(self.stats[-1]['dirty_scenes']), scenes_with_hash)
+
+        self.db.override_translation_and_comment_for_offset(
+            cmd.offset, "An override", None)
+        self.assertFresh()
+        self.assertEqual(self.stats[-1]['dirty_scenes'], [scene_name])
+
+    def test_charswap_and_settings(self):
+        self.assertFresh()
+        self.assertFresh(perform_charswap=True)
+        self.assertEqual(self.stats[-1]['hits'], 0)
+        self.db.set_charswap_map({'a': 'A'})
+        self.assertFresh(perform_charswap=True)
+        self.assertEqual(self.stats[-1]['hits'], 0)
+
+        # The RubyUtils the DB's module uses
+        ruby_utils = sys.modules[type(self.db).__module__].RubyUtils
+        self.addCleanup(setattr, ruby_utils, 'ENABLE_PUA_CODES',
+                        ruby_utils.ENABLE_PUA_CODES)
+        ruby_utils.ENABLE_PUA_CODES = not ruby_utils.ENABLE_PUA_CODES
+        self.assertFresh(perform_charswap=True)
+        self.assertEqual(self.stats[-1]['hits'], 0)
+
+
+class BinaryFormatTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = SyntheticCorpus.translated_db(
+            seed=7, scene_count=6, lines_per_scene=20)
+        cls.db.set_charswap_map({'a': 'b'})
+
+    def test_round_trip_json(self):
+        loaded = TranslationDb.from_binary(self.db.as_binary())
+        self.assertEqual(loaded.as_json(), self.db.as_json())
+
+    def test_matches_json_load(self):
+        from_json = TranslationDb.from_json(json.loads(self.db.as_json()))
+        from_binary = TranslationDb.from_binary(self.db.as_binary())
+        for name in from_json.scene_names(include_empty=True):
+            self.assertEqual(
+                from_binary.lines_for_scene(name),
+                from_json.lines_for_scene(name))
+
+    def test_file_formats(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, "db.json")
+            binary_path = os.path.join(tmpdir, "db.ldb")
+            self.db.to_file(json_path)
+            self.db.to_file(binary_path)
+            with open(binary_path, 'rb') as f:
+                self.assertTrue(f.read().startswith(BinaryDbFormat.MAGIC))
+            self.assertEqual(
+                TranslationDb.from_file(json_path).as_json(),
+                TranslationDb.from_file(binary_path).as_json())
+
+    def test_empty_values(self):
+        db = TranslationDb(
+            {'SCENE': [
+                TranslationDb.TextCommand(0, '0' * 40, -1, modifiers=['']),
+                TranslationDb.TextCommand(1, '1' * 40, 2, has_ruby=True,
+                                          is_glued=True, is_choice=True,
+                                          has_forced_newline=True,
+                                          modifiers=['@n', '@k']),
+            ]},
+            {'0' * 40: TranslationDb.TLLine('', '', None)},
+            {}
+        )
+        loaded = TranslationDb.from_binary(db.as_binary())
+        self.assertEqual(loaded.as_json(), db.as_json())
+        self.assertEqual(
+            loaded.lines_for_scene('SCENE'),
+            TranslationDb.from_json(
+                json.loads(db.as_json())).lines_for_scene('SCENE'))
+
+    def test_rejects_non_sha1_keys(self):
+        db = TranslationDb({}, {'not a hash': TranslationDb.TLLine('a')}, {})
+        with self.assertRaises(ValueError):
+            db.as_binary()
+
+    def test_rejects_bad_version(self):
+        data = bytearray(self.db.as_binary())
+        data[len(BinaryDbFormat.MAGIC)] = 0xFF
+        with self.assertRaises(ValueError):
+            TranslationDb.from_binary(data)
+
+
+class LazyLoadTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = SyntheticCorpus.translated_db(
+            seed=13, scene_count=8, lines_per_scene=300)
+        cls.data = cls.db.as_binary()
+
+    def test_decodes_on_access(self):
+        db = TranslationDb.from_binary(self.data, lazy=True)
+        self.assertEqual(db.scene_names(), self.db.scene_names())
+        self.assertEqual(db._scene_map.decoded_count(), 0)
+
+        name = self.db.scene_names()[3]
+        self.assertEqual(db.lines_for_scene(name),
+                         self.db.lines_for_scene(name))
+        self.assertEqual(db._scene_map.decoded_count(), 1)
+
+        cmd = self.db.lines_for_scene(name)[5]
+        self.assertEqual(db.tl_line_for_cmd(cmd).as_json(),
+                         self.db.tl_line_for_cmd(cmd).as_json())
+        self.assertEqual(db._line_by_hash.decoded_count(),
+                         BinaryDbFormat.LINES_PER_SEGMENT)
+        self.assertNotIn('0' * 40, db._line_by_hash)
+        self.assertNotIn('not a hash', db._line_by_hash)
+        with self.assertRaises(KeyError):
+            db.tl_line_with_hash('0' * 40)
+
+    def test_edits_survive_materialize(self):
+        db = TranslationDb.from_binary(self.data, lazy=True)
+        eager = TranslationDb.from_binary(self.data)
+        cmd = self.db.lines_for_scene(self.db.scene_names()[1])[0]
+        for tl_db in [db, eager]:
+            tl_db.set_translation_and_comment_for_hash(
+                cmd.jp_hash, "edited", "comment")
+            tl_db.override_translation_and_comment_for_offset(
+                cmd.offset + 1, "override", None)
+        self.assertEqual(db.as_json(), eager.as_json())
+        self.assertEqual(type(db._scene_map), dict)
+
+    def test_formats(self):
+        flat = TranslationDb.from_binary(
+            self.db.as_binary(segmented=False), lazy=True)
+        self.assertEqual(flat.as_json(), self.db.as_json())
+
+        columnar = TranslationDb.from_binary(
+            self.data, columnar=True, lazy=True)
+        name = self.db.scene_names()[0]
+        self.assertEqual(type(columnar.lines_for_scene(name)).__name__,
+                         "ColumnarScene")
+        self.assertEqual(columnar.generate_script_text_mrg(),
+                         self.db.generate_script_text_mrg())
+
+    def test_save_over_own_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "db.ldb")
+            self.db.to_file(path)
+            db = TranslationDb.from_file(path)
+            self.assertEqual(type(db._line_by_hash).__name__, "LazyLineMap")
+            db.to_file(path)
+            self.assertEqual(TranslationDb.from_file(path).as_json(),
+                             self.db.as_json())
@@ -1,14 +1,27 @@
 from translation import TranslationUtils
 from flask import Flask, send_file, request
-from io import StringIO, BytesIO
+from io import StringIO
 from itertools import chain
+from tempfile import TemporaryFile
 from utils import create_logger
 
+import atexit
+import os
 import pandas as pd
 import pygsheets
 
 app = Flask(__name__)
-tl = TranslationUtils(database_path="assets/database.json")
+
+# Translations are loaded from assets/database.json, which is never written: saves go to ./database.json.
+# Set DEEPLUNA_JOURNAL=1 to also journal edits to ./database.json.journal as they are pulled. The server then
+# resumes from ./database.json and its journal on restart, and only starts over from assets/database.json
+# if ./database.json doesn't exist.
+# Set DEEPLUNA_LAYOUT_PROCESSES=N to lay scenes out in N processes when generating the MRG. Each server worker
+# starts its own pool on its first generation, so keep N * workers within the available cores.
+tl = TranslationUtils(database_path="assets/database.json", save_path="database.json",
+                      journal=os.environ.get("DEEPLUNA_JOURNAL") == "1",
+                      layout_processes=int(os.environ.get("DEEPLUNA_LAYOUT_PROCESSES", "1")))
+atexit.register(tl.close)
 gs = pygsheets.authorize(service_file="assets/certificate.json")
 
 
@@ -73,13 +86,18 @@ def save_database():
     Save the current translation state in a database file.
 
     Returns:
-        str: "Success" if the operation succeeds, "Internal Server Error" if there's an issue.
+        str: "Success" if the save was started, "Internal Server Error" if there's an issue.
 
     Description:
-        This function is used to save the current translation state into a database file. It calls
-        `tl.generate_db_file()` to perform the saving operation. If the operation is successful,
-        it returns "Success" with a status code 200. Otherwise, if an exception occurs during the process,
-        it returns "Internal Server Error" with a status code 503.
+        This function is used to save the current translation state into a database file, `./database.json`
+        (`assets/database.json` is left as it is). It calls `tl.generate_db_file()`, which starts the save in the
+        background and returns straight away. With DEEPLUNA_JOURNAL=1, edits are already persisted to
+        `./database.json.journal` as they are pulled, so this just folds the journal into `./database.json`.
+        The database is written to a temporary file and renamed over `./database.json`, so a crash mid-save
+        leaves the previous save intact. Saves requested while one is running are merged into a single follow-up
+        save. Use `/api/database/save/status` to see when the last save finished.
+        If the operation is successful, it returns "Success" with a status code 200. Otherwise, if an exception
+        occurs during the process, it returns "Internal Server Error" with a status code 503.
     """
     try:
         tl.generate_db_file()
@@ -87,6 +105,39 @@ def save_database():
     except Exception as error:
         return "Internal Server Error", 503
 
+@app.route('/api/database/save/status', methods=['GET'])
+def save_database_status():
+    """
+    Report the state of background database saves.
+
+    Returns:
+        JSON: Whether a save is running or queued, how many saves have completed, when the last one finished
+        (seconds since the epoch) and how long it took (seconds), and the error of the last save if it failed.
+    """
+    try:
+        return tl.save_status(), 200
+    except Exception as error:
+        print(error)
+        return "Internal Server Error", 503
+
+@app.route('/api/progress', methods=['GET'])
+def get_progress():
+    """
+    Report translation progress.
+
+    Returns:
+        JSON: Translated and total line counts overall, and for each scene.
+
+    Description:
+        The counts are maintained by the database as lines are edited, so this is cheap to poll.
+        The overall counts are of distinct lines, the per scene counts are of the scene's text lines.
+    """
+    try:
+        return tl.progress(), 200
+    except Exception as error:
+        print(error)
+        return "Internal Server Error", 503
+
 @app.route('/api/mrg/gen', methods=['GET'])
 def generate_mrg():
     """
@@ -100,20 +151,20 @@ def generate_mrg():
                    status code 503.
 
     Description:
-        This function generates an 'mrg' file with translated lines using `tl.generate_script_mrg()`. The generated
-        content is written to a BytesIO buffer and returned as a downloadable attachment using Flask's `send_file`
-        function. If any exceptions occur during the generation process, the function catches them and returns
+        This function generates an 'mrg' file with translated lines using `tl.write_script_mrg()`. The archive
+        is streamed into a temporary file rather than built in memory, and that file is returned as a downloadable
+        attachment using Flask's `send_file` function, which closes (and so deletes) it once the response is sent.
+        If any exceptions occur during the generation process, the function catches them and returns
         "Internal Server Error" with a status code 503.
     """
+    buffer = TemporaryFile()
     try:
-        buffer = BytesIO()
-        file_name, file_data = tl.generate_script_mrg()
-
-        buffer.write(file_data)
+        file_name = tl.write_script_mrg(buffer)
         buffer.seek(0)
 
         return send_file(buffer, download_name=file_name, as_attachment=True)
     except Exception as error:
+        buffer.close()
         print(error)
         return "Internal Server Error", 503
 
@@ -137,7 +188,8 @@ def upload_csv():
         for fileName in request.files:
             csv_file = request.files[fileName]
             tl.process_scene_csv(csv_file, fileName)
-        
+
+        tl.persist_edits()
         return "Success", 200, {'Content-Type': 'text/plain; charset=utf8'}
     except Exception as e:
         return "Error", 500
@@ -169,6 +221,7 @@ def pull_sheet(sheet_id):
             lines = df.to_csv(header=False, index=False)
             tl.process_scene_csv(StringIO(lines), cell_id, logger)
 
+        tl.persist_edits()
         return stream.getvalue(), 200, {'Content-Type': 'text/plain; charset=utf8'}
     except Exception as e:
         return "Error", 500
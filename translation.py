@@ -1,9 +1,14 @@
 from libs.deepLuna.luna.translation_db import TranslationDb, ReadableExporter, RubyUtils
 from libs.deepLuna.luna.constants import Constants
+from libs.deepLuna.luna.journal import DbJournal
+from libs.deepLuna.luna.mzx_pool import MzxPool
+from libs.deepLuna.luna.save_service import DbSaveService
 
 from math import isnan
 from textwrap import wrap
 
+import atexit
+import os
 import pandas as pd
 import time
 
@@ -45,14 +50,59 @@ class Utils:
 
 class TranslationUtils:
     "Utils for translation"
-    def __init__(self, all_src_path = "allscr.mrg", script_text_path = "script_text.mrg", database_path = None):
+    def __init__(self, all_src_path = "allscr.mrg", script_text_path = "script_text.mrg", database_path = None, journal = False, layout_processes = None, save_path = "database.json"):
         RubyUtils.ENABLE_PUA_CODES = True
 
-        if (database_path is not None):
+        # With layout processes, MRG generation lays scenes out in parallel.
+        # The pool is only started by the first generation, so processes
+        # that never generate an MRG don't pay for it. That happens on a
+        # server thread, so the workers are spawned rather than forked
+        self.layout_processes = layout_processes
+        self.layout_pool = None
+
+        # Saves write save_path; database_path is only ever read.
+        # With a journal, every edit is also appended to <save_path>.journal
+        # as it happens, so edits persist without rewriting the database, and
+        # saves fold the journal into save_path. A journaled database starts
+        # out as a copy of database_path, and is resumed from save_path (and
+        # its journal) from then on.
+        self.save_path = save_path
+        self.journal = None
+
+        if (journal and os.path.exists(save_path)):
+            self.journal = DbJournal(save_path)
+            self.db_tl = self.journal.tl_db
+        elif (database_path is not None):
             self.db_tl = TranslationDb.from_file(database_path)
         else:
             self.db_tl = TranslationDb.from_mrg(all_src_path, script_text_path)
 
+        if (journal and self.journal is None):
+            self.journal = DbJournal.create(save_path, self.db_tl)
+            self.db_tl = self.journal.tl_db
+
+        # Without a journal, saves write the whole database in the background
+        self.saver = None
+        if self.journal is None:
+            self.saver = DbSaveService(save_path, self.db_tl.snapshot)
+
+    def close(self):
+        "Finish any background save, close the journal and stop the layout pool"
+        if self.journal:
+            self.journal.close()
+        else:
+            self.saver.wait()
+        if self.layout_pool:
+            atexit.unregister(self.layout_pool.close)
+            self.layout_pool.close()
+            self.layout_pool = None
+
+    def _layout_pool(self):
+        if (self.layout_pool is None and self.layout_processes is not None and self.layout_processes > 1):
+            self.layout_pool = MzxPool(self.layout_processes, context='spawn')
+            atexit.register(self.layout_pool.close)
+        return self.layout_pool
+
     def get_scene(self, scene_name: str):
         scenes = self.db_tl.scene_names()
         
@@ -108,16 +158,54 @@ class TranslationUtils:
             print(ex)
                 
 
+    def persist_edits(self):
+        "Make edits so far durable, if journaled"
+        if self.journal:
+            self.journal.sync()
+
+    def progress(self):
+        "Translation progress, overall and per scene"
+        progress = self.db_tl.progress()
+        return {
+            "translated": progress["translated"],
+            "total": progress["total"],
+            "scenes": {
+                scene: {"translated": translated, "total": total}
+                for scene, (translated, total) in progress["scenes"].items()
+            },
+        }
+
     def generate_db_file(self):
-        "Regenerate database"
-        self.db_tl.to_file("database.json")
+        "Regenerate database, in the background"
+        if self.journal:
+            # Fold the journal into a fresh snapshot of the database
+            self.journal.request_compaction()
+        else:
+            self.saver.request_save()
+
+    def save_status(self):
+        "When the database was last saved, and whether a save is running"
+        if self.journal:
+            return self.journal.compaction_status()
+        return self.saver.status()
+
+    @staticmethod
+    def script_mrg_name():
+        current_time = time.strftime('%Y%m%d-%H%M%S')
+        return f"script_text_translated{current_time}.mrg"
 
     def generate_script_mrg(self):
         "Generate Translated MRG file"
-        current_time = time.strftime('%Y%m%d-%H%M%S')
-        output_name = f"script_text_translated{current_time}.mrg"
-        mzp_data = self.db_tl.generate_script_text_mrg()
+        output_name = self.script_mrg_name()
+        mzp_data = self.db_tl.generate_script_text_mrg(pool=self._layout_pool())
         return [output_name, mzp_data]
+
+    def write_script_mrg(self, target):
+        "Stream Translated MRG file to a writable binary target"
+        output_name = self.script_mrg_name()
+        self.db_tl.write_script_text_mrg(target, pool=self._layout_pool())
+        return output_name
     
     def export_current_tl_scene(self, scene_name):
-        return ReadableExporter.export_text(self.db_tl, scene_name).encode('utf-8')
\ No newline at end of file
+        # Export from a snapshot, so sheet pulls can't change the scene halfway through
+        return ReadableExporter.export_text(self.db_tl.snapshot(), scene_name).encode('utf-8')
\ No newline at end of file